@@ -0,0 +1,136 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+# Benchmark: converting the "ConvertTo-XML" output of a Select-Vm on a large
+# inventory. Compares the if/elif chain that was used before with the
+# per-type converters.
+#
+# Usage: python bench/bench_convert.py [number_of_vms]
+
+import sys
+import time
+from xml.etree import ElementTree as etree
+
+from rest.resource import Resource
+from rhevm.powershell import ObjectParser, ParseError, _convert_xml_node
+from rhevm.powershell import _resource_type, _version
+
+
+def convert_chain(node):
+    """The if/elif based converter."""
+    type = node.attrib['Type']
+    if type in ('System.Int32', 'System.Int64'):
+        return int(node.text)
+    elif type == 'System.Boolean':
+        return node.text == 'True'
+    elif type == 'System.String':
+        return node.text
+    elif type == 'System.Version':
+        return _version(node.text)
+    elif type == 'System.Management.Automation.PSCustomObject':
+        resource = Resource(_resource_type(type))
+        for child in node:
+            resource[child.attrib['Name']] = convert_chain(child)
+        return resource
+    elif type.startswith('System.'):
+        return node.text
+    elif type.startswith('RhevmCmd.'):
+        resource = Resource(_resource_type(type))
+        for child in node:
+            resource[child.attrib['Name']] = convert_chain(child)
+        return resource
+    elif type.startswith('VdcDAL.'):
+        return convert_chain(node[0])
+    elif type.endswith('[]'):
+        result = []
+        for child in node:
+            result.append(convert_chain(child))
+        return result
+    elif type:
+        raise ParseError, 'Unknown type: %s' % type
+
+
+def synthetic_vm(i):
+    """Return the XML for a VM with about 40 properties."""
+    props = [ ('Name', 'System.String', 'vm%d' % i),
+              ('VmId', 'System.String', '0d1e3c4b-6a2f-4e8d-9f6a-%012d' % i),
+              ('Description', 'System.String', 'virtual machine %d' % i),
+              ('MemorySize', 'System.Int32', '1024'),
+              ('NumOfCpus', 'System.Int32', '2'),
+              ('NumOfSockets', 'System.Int32', '1'),
+              ('HighlyAvailable', 'System.Boolean', 'False'),
+              ('CreationDate', 'System.DateTime', '1/1/2010 12:00:00 AM'),
+              ('Status', 'RhevmCmd.CLIVmStatus', 'Down'),
+              ('OperatingSystem', 'VdcDAL.VmOsType', None) ]
+    for j in range(30):
+        props.append(('Property%d' % j, 'System.String', 'value%d' % j))
+    xml = '<Property Type="RhevmCmd.CLIVm">'
+    for name, type, value in props:
+        if value is None:
+            value = '<Property Type="System.String">WindowsXP</Property>'
+        xml += '<Property Name="%s" Type="%s">%s</Property>' % (name, type,
+                                                                 value)
+    xml += '</Property>'
+    return xml
+
+
+def synthetic_output(count):
+    """Return "ConvertTo-XML" output for `count` VMs, wrapped at 120
+    columns like the console does."""
+    body = '<?xml version="1.0"?><Objects><Object Type="System.Object[]">'
+    body += ''.join([ synthetic_vm(i) for i in range(count) ])
+    body += '</Object></Objects>'
+    lines = [ body[i:i+120] for i in range(0, len(body), 120) ]
+    return '\r\n'.join(lines)
+
+
+def parse(output, convert):
+    parser = ObjectParser(convert)
+    objects = []
+    for i in range(0, len(output), 2000):
+        objects += parser.feed(output[i:i+2000])
+    objects += parser.close()
+    return objects
+
+
+def convert_all(nodes, convert):
+    return map(convert, nodes)
+
+
+def timeit(func, args, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    count = sys.argv[1:] and int(sys.argv[1]) or 10000
+    output = synthetic_output(count)
+    print 'Converting %d VMs (%.1f MB of XML)' % (count,
+                                                  len(output) / 1048576.0)
+    nodes = list(etree.fromstring(output.replace('\r\n', ''))[0])
+    c1, objects1 = timeit(convert_all, (nodes, convert_chain))
+    c2, objects2 = timeit(convert_all, (nodes, _convert_xml_node))
+    assert objects1 == objects2
+    t1, objects1 = timeit(parse, (output, convert_chain))
+    t2, objects2 = timeit(parse, (output, _convert_xml_node))
+    assert objects1 == objects2
+    print '%12s  %16s  %16s' % ('converter', 'convert only (s)',
+                                'parse+convert (s)')
+    print '%12s  %16.3f  %16.3f' % ('if/elif', c1, t1)
+    print '%12s  %16.3f  %16.3f' % ('per-type', c2, t2)
+    print '%12s  %15.2fx  %15.2fx' % ('speedup', c1 / c2, t1 / t2)
+
+
+if __name__ == '__main__':
+    main()
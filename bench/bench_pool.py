@@ -0,0 +1,114 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+# Micro-benchmark: get() and put() on a pool with many idle instances, from
+# several threads at the same time, like RequireAuthentication and
+# RhevmApplication.close() do for every request. Compares the bookkeeping
+# that was used before (sort on put, linear scan on get) with the deques.
+#
+# Usage: python bench/bench_pool.py [operations_per_thread]
+
+import sys
+import time
+import random
+import threading
+from collections import deque
+
+from rhevm.pool import Pool
+
+
+class FakeShell(object):
+
+    def __init__(self, **args):
+        self.broken = False
+
+    def terminate(self):
+        pass
+
+
+class SortedPool(Pool):
+    """A pool with the old bookkeeping."""
+
+    def _get_instance(self, key):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            idle = key in self._pool and self._pool[key][1]
+            for inst in reversed(idle or ()):
+                if now - inst.created < self.maxlife \
+                        and now - inst.last_used < self.maxival \
+                        and inst.count < self.maxcount:
+                    idle.remove(inst)
+                    self._unpool(inst)
+                    return inst
+        finally:
+            self._lock.release()
+
+    def _add_instance(self, args, instance):
+        key = instance.key
+        self._lock.acquire()
+        try:
+            if key not in self._pool:
+                self._pool[key] = (args, deque())
+            idle = list(self._pool[key][1]) + [instance]
+            idle.sort(lambda x,y: cmp(x.last_used, y.last_used))
+            self._pool[key] = (args, deque(idle))
+            instance.pooled = True
+            self._size += 1
+        finally:
+            self._lock.release()
+
+
+def create_pool(cls, keys, idle):
+    """Create a pool with `idle` idle instances for each of `keys` keys."""
+    pool = cls(FakeShell, FakeShell)
+    pool.maxperkey = pool.maxtotal = pool.maxinstances = keys * idle + 100
+    pool.maxcount = sys.maxint
+    for i in range(keys):
+        args = { 'username': 'user%d' % i }
+        instances = [ pool.get(args) for j in range(idle) ]
+        for instance in instances:
+            pool.put(instance)
+    return pool
+
+
+def run(pool, keys, threads, count):
+    """Run `count` get/put pairs in each of `threads` threads. Return the
+    number of pairs per second."""
+    def worker():
+        args = [ { 'username': 'user%d' % i } for i in range(keys) ]
+        for i in xrange(count):
+            instance = pool.get(random.choice(args))
+            pool.put(instance)
+    workers = [ threading.Thread(target=worker) for i in range(threads) ]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * count / (time.time() - start)
+
+
+def main():
+    count = sys.argv[1:] and int(sys.argv[1]) or 2000
+    keys = 20
+    print 'get/put pairs per second, %d keys' % keys
+    print '%8s  %8s  %12s  %12s' % ('idle/key', 'threads', 'sorted+scan',
+                                    'deque+heap')
+    for idle in (2, 20, 200):
+        for threads in (1, 8, 32):
+            results = []
+            for cls in (SortedPool, Pool):
+                pool = create_pool(cls, keys, idle)
+                results.append(run(pool, keys, threads, count / threads))
+            print '%8d  %8d  %12.0f  %12.0f' % ((idle, threads) +
+                                                tuple(results))
+
+
+if __name__ == '__main__':
+    main()
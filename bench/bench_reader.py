@@ -0,0 +1,91 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+# Micro-benchmark: finding the end-of-output marker in a large command
+# output. Compares the regex based approach of pexpect's expect(), which
+# searches the entire buffer again after every read, with OutputReader.
+#
+# Usage: python bench/bench_reader.py [size_in_mb ...]
+
+import re
+import sys
+import time
+
+from rhevm.powershell import OutputReader
+
+
+class FakeChild(object):
+    """A child that returns a fixed output in chunks of `maxread` bytes,
+    like winspawn does."""
+
+    maxread = 2000
+    timeout = 30
+
+    def __init__(self, output):
+        self.output = output
+        self.offset = 0
+
+    def read_nonblocking(self, size, timeout):
+        data = self.output[self.offset:self.offset+size]
+        self.offset += len(data)
+        return data
+
+
+def synthetic_output(size):
+    """Return `size` bytes of wrapped ConvertTo-XML like output followed by
+    an end marker."""
+    vm = '<Property Type="RhevmCmd.CLIVm">' + \
+         '<Property Name="Name" Type="System.String">vm</Property>' * 40 + \
+         '</Property>'
+    body = '<?xml version="1.0"?><Objects><Object Type="System.Object[]">'
+    body += vm * (size // len(vm) + 1)
+    body += '</Object></Objects>'
+    lines = [ body[i:i+120] for i in range(0, len(body), 120) ]
+    return '\r\n'.join(lines) + '\r\nEND-OF-OUTPUT-MARKER\n'
+
+
+def read_expect(child):
+    """Find the marker the way pexpect.expect() does."""
+    regex = re.compile('END-OF-OUTPUT-MARKER\r?\n')
+    buffer = ''
+    while True:
+        match = regex.search(buffer)
+        if match:
+            return len(buffer[:match.start()])
+        buffer += child.read_nonblocking(child.maxread, child.timeout)
+
+
+def read_reader(child):
+    """Find the marker with OutputReader."""
+    reader = OutputReader(child)
+    size = 0
+    for chunk in reader.iter_until('END-OF-OUTPUT-MARKER'):
+        size += len(chunk)
+    return size
+
+
+def timeit(func, output):
+    start = time.time()
+    size = func(FakeChild(output))
+    return time.time() - start, size
+
+
+def main():
+    sizes = map(float, sys.argv[1:]) or [0.5, 1, 2, 4, 8]
+    print '%8s  %12s  %12s  %8s' % ('MB', 'expect (s)', 'reader (s)',
+                                    'speedup')
+    for mb in sizes:
+        output = synthetic_output(int(mb * 1024 * 1024))
+        t1, size1 = timeit(read_expect, output)
+        t2, size2 = timeit(read_reader, output)
+        assert size1 == size2
+        print '%8.1f  %12.3f  %12.3f  %7.1fx' % (mb, t1, t2, t1 / t2)
+
+
+if __name__ == '__main__':
+    main()
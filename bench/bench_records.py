@@ -0,0 +1,119 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+# Benchmark: memory used by the result of a Select-Vm on a large inventory,
+# with objects as Resources and as Records. Every measurement is done in a
+# fresh process. Reported are the growth of the resident set size, the
+# number of bytes allocated for the containers that hold the properties
+# (the dicts, or the records and their tuples; the property values are the
+# same in both cases), and the parse time.
+#
+# Usage: python bench/bench_records.py [number_of_vms]
+
+import os
+import sys
+import gc
+import time
+import subprocess
+
+from rhevm.powershell import ObjectParser, CompactParser
+from rhevm.powershell import _convert_xml_node, _convert_xml_record
+from rhevm.record import Record
+
+
+def synthetic_xml(count):
+    """Return "ConvertTo-XML" output for `count` VMs with 40 properties."""
+    chunks = ['<?xml version="1.0"?><Objects><Object Type="System.Object[]">']
+    for i in range(count):
+        chunks.append('<Property Type="RhevmCmd.CLIVm">')
+        chunks.append('<Property Name="Name" Type="System.String">vm%d'
+                      '</Property>' % i)
+        chunks.append('<Property Name="MemorySize" Type="System.Int32">1024'
+                      '</Property>')
+        for j in range(38):
+            chunks.append('<Property Name="Property%d" Type="System.String">'
+                          'value%d-%d</Property>' % (j, i, j))
+        chunks.append('</Property>')
+    chunks.append('</Object></Objects>')
+    return ''.join(chunks)
+
+
+def synthetic_compact(count):
+    """Return compact output for `count` VMs with 40 properties."""
+    chunks = []
+    for i in range(count):
+        chunks.append('oRhevmCmd.CLIVm|kName|svm%d|kMemorySize|i1024|' % i)
+        for j in range(38):
+            chunks.append('kProperty%d|svalue%d-%d|' % (j, i, j))
+        chunks.append('e|')
+    return ''.join(chunks)
+
+
+def rss():
+    """Return the resident set size in KB."""
+    try:
+        statm = open('/proc/self/statm').read().split()
+        return int(statm[1]) * os.sysconf('SC_PAGE_SIZE') / 1024
+    except IOError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def container_size(obj):
+    """Return the size of the container(s) of an object."""
+    if isinstance(obj, Record):
+        return sys.getsizeof(obj) + sys.getsizeof(obj.values)
+    return sys.getsizeof(obj)
+
+
+def measure(format, mode, count):
+    """Parse the output and report the memory that is kept."""
+    if format == 'xml':
+        output = synthetic_xml(count)
+        if mode == 'records':
+            parser = ObjectParser(_convert_xml_record)
+        else:
+            parser = ObjectParser(_convert_xml_node)
+    else:
+        output = synthetic_compact(count)
+        parser = CompactParser(records=(mode == 'records'))
+    gc.collect()
+    rss_before = rss()
+    start = time.time()
+    result = []
+    for i in range(0, len(output), 2000):
+        result += parser.feed(output[i:i+2000])
+    result += parser.close()
+    elapsed = time.time() - start
+    del parser
+    gc.collect()
+    size = sum(map(container_size, result)) / 1024
+    print '%d %d %f' % (rss() - rss_before, size, elapsed)
+
+
+def main():
+    if sys.argv[1:2] == ['--measure']:
+        measure(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        return
+    count = sys.argv[1:] and sys.argv[1] or '10000'
+    print 'Parsing %s VMs with 40 properties each' % count
+    print '%8s  %10s  %12s  %16s  %10s' % ('format', 'mode', 'RSS (KB)',
+                                          'containers (KB)', 'time (s)')
+    for format in ('xml', 'compact'):
+        for mode in ('resources', 'records'):
+            command = [sys.executable, __file__, '--measure', format, mode,
+                       count]
+            output = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                      env=os.environ).communicate()[0]
+            size, containers, elapsed = output.split()
+            print '%8s  %10s  %12s  %16s  %10.2f' % \
+                    (format, mode, size, containers, float(elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+# Benchmark: the cost of finding the VM of a sub-resource request (like
+# GET /api/vms/:vm/nics) as the inventory grows, with the old "Select-Vm |
+# ? { $_.VmId -eq ... }" and with vm_handle(). The shell is simulated:
+# Select-Vm materializes every VM object, like RHEV-M does, and Get-Vm
+# materializes the one it finds. The times only include the cost of
+# materializing objects: the database lookups of RHEV-M and the round trips
+# to the shell are not simulated. The round trips are counted instead, as
+# the number of commands per request. Every request selects its VM twice,
+# like a handler that calls another one.
+#
+# Usage: python bench/bench_vm_handle.py [requests]
+
+import re
+import sys
+import time
+
+from rest.resource import Resource
+
+import rhevm.api
+from rhevm.util import create_filter, vm_handle
+
+
+class InventoryShell(object):
+    """A simulated shell with `count` VMs."""
+
+    version = (2, 2, 0, 1)
+    args = { 'username': 'user', 'domain': 'domain' }
+
+    def __init__(self, count):
+        self.ids = [ '%08x-0000-4000-8000-000000000000' % i
+                     for i in range(count) ]
+        self.index = set(self.ids)
+        self.commands = 0
+
+    def _create_vm(self, id):
+        vm = Resource('vm', VmId=id, Name='name-%s' % id)
+        for i in range(38):
+            vm['Property%d' % i] = 'value%d' % i
+        return vm
+
+    def execute(self, command):
+        self.commands += 1
+        if 'Get-Vm -VmId' in command:
+            id = re.search('Get-Vm -VmId "([^"]*)"', command).group(1)
+            if id in self.index:
+                return [ self._create_vm(id) ]
+            return []
+        elif command.startswith('Select-Vm'):
+            id = re.search('-eq "([^"]*)"', command).group(1)
+            vms = [ self._create_vm(vmid) for vmid in self.ids ]
+            return [ vm for vm in vms if vm['VmId'] == id ]
+        raise ValueError('Unknown command: %s' % command)
+
+
+def select_vm_filter(id):
+    """Select a VM like the handlers did before."""
+    filter = create_filter(vmid=id)
+    result = rhevm.api.powershell.execute('Select-Vm | %s'
+                                          ' | Tee-Object -Variable vm'
+                                          % filter)
+    return len(result) == 1
+
+
+def select_vm_handle(id):
+    """Select a VM with vm_handle()."""
+    return vm_handle(id) is not None
+
+
+def run(shell, select, requests):
+    """Run `requests` requests. Return the time per request in ms, and the
+    number of commands per request."""
+    rhevm.api.powershell._register(shell)
+    shell.commands = 0
+    start = time.time()
+    for i in xrange(requests):
+        shell.vm_handles = None
+        id = shell.ids[i % len(shell.ids)]
+        assert select(id) and select(id)
+    elapsed = time.time() - start
+    rhevm.api.powershell._release()
+    return 1000.0 * elapsed / requests, float(shell.commands) / requests
+
+
+def main():
+    requests = sys.argv[1:] and int(sys.argv[1]) or 20
+    print 'time (ms) to materialize objects and commands per request'
+    print '%8s  %18s  %18s' % ('vms', 'Select-Vm filter', 'vm_handle()')
+    for count in (100, 1000, 5000):
+        shell = InventoryShell(count)
+        results = run(shell, select_vm_filter, requests)
+        results += run(shell, select_vm_handle, requests)
+        print '%8d  %10.2f ms %3.0f  %10.2f ms %3.0f' % ((count,) + results)
+
+
+if __name__ == '__main__':
+    main()
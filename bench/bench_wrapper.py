@@ -0,0 +1,88 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+# Benchmark: sending the full wrapper script with every command versus
+# invoking the Invoke-Wrapped function that is defined at shell start-up.
+#
+# Without arguments, the bytes sent and the time spent wrapping are
+# measured for a transcript of typical commands. With --live, the commands
+# are also executed on a real PowerShell (Windows only) in both modes and
+# the round-trip time per command is reported.
+#
+# Usage: python bench/bench_wrapper.py [--live] [count]
+
+import sys
+import time
+
+from rhevm.powershell import PowerShell
+
+
+# Commands as issued by the API for a VM list, show and update.
+transcript = [
+    'Get-Version',
+    'Select-Vm -SearchText "" | Select-Properties @("Name","VmId")',
+    'Select-Vm | ? { $_.VmId -eq "0d1e3c4b-6a2f-4e8d-9f6a-1b2c3d4e5f60" }',
+    '$vm = Select-Vm | ? { $_.VmId -eq "0d1e3c4b-6a2f-4e8d-9f6a-1b2c3d4e5f60"}'
+        '; $vm.Description = "web server"; $vm.MemorySize = 1024; '
+        'Update-Vm -VmObject $vm',
+    'Select-Cluster | ? { $_.ClusterId -eq 1 }',
+]
+
+
+def wrap(shell, count):
+    """Wrap every command in the transcript `count` times."""
+    size = 0
+    start = time.time()
+    for i in range(count):
+        for command in transcript:
+            size += len(shell._wrap_command(command, str(i)))
+    return time.time() - start, size
+
+
+def execute(shell, count):
+    """Execute every command in the transcript `count` times."""
+    start = time.time()
+    for i in range(count):
+        shell.execute_many(['Get-Date'] * len(transcript))
+    return time.time() - start
+
+
+def main():
+    args = sys.argv[1:]
+    live = '--live' in args
+    args = [ arg for arg in args if arg != '--live' ]
+    count = args and int(args[0]) or 1000
+    ncommands = count * len(transcript)
+    modes = [('inline', False), ('preload', True)]
+    print '%8s  %8s  %14s  %14s' % ('format', 'mode', 'bytes/command',
+                                    'wrap (us/cmd)')
+    for format in ('xml', 'compact'):
+        for name, preload in modes:
+            shell = PowerShell(format=format, preload=preload)
+            elapsed, size = wrap(shell, count)
+            print '%8s  %8s  %14d  %14.1f' % (format, name, size / ncommands,
+                                              elapsed * 1e6 / ncommands)
+    if not live:
+        return
+    print
+    print '%8s  %8s  %16s' % ('format', 'mode', 'round-trip (ms)')
+    for format in ('xml', 'compact'):
+        for name, preload in modes:
+            shell = PowerShell(format=format, preload=preload)
+            shell.start()
+            try:
+                execute(shell, 1)  # warm up
+                elapsed = execute(shell, count // 10 or 1)
+            finally:
+                shell.terminate()
+            ncalls = (count // 10 or 1) * len(transcript)
+            print '%8s  %8s  %16.2f' % (format, name, elapsed * 1e3 / ncalls)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,9 @@
 # "AUTHORS" for a complete overview.
 
 from rest.proxy import ObjectProxy
+from rhevm.metrics import Metrics
 
 pool = None
+warmup = None
 powershell = ObjectProxy()
+metrics = Metrics()
@@ -10,18 +10,22 @@ import binascii
 
 from rest import InputFilter, OutputFilter, ExceptionHandler, Error
 from rest import http
-from rest.api import request, response
+from rest.api import request, response, application, collection
 from rest.protocol import FormatEntity
 from rest.resource import Resource
 
 import rhevm
 from rhevm.api import powershell
-from rhevm.powershell import PowerShellError, WindowsError
+from rhevm.pool import PoolTimeout
+from rhevm.powershell import PowerShellError, CommandTimeout, WindowsError
 
 
 class RequireAuthentication(InputFilter):
     """Require Basic authentication."""
 
+    # Value of the Retry-After header when no PowerShell is available.
+    retry_after = 10
+
     def filter(self, input):
         auth = request.header('Authorization')
         if not auth:
@@ -50,10 +54,29 @@ class RequireAuthentication(InputFilter):
                  'domain': domain }
         try:
             powershell = rhevm.api.pool.get(auth)
+        except PoolTimeout:
+            headers = [('Retry-After', str(self.retry_after))]
+            raise Error(http.SERVICE_UNAVAILABLE, headers,
+                        reason='No PowerShell available.')
         except (PowerShellError, WindowsError):
             headers = [('WWW-Authenticate', 'Basic realm=rhevm')]
             raise Error(http.UNAUTHORIZED, headers, reason='Could not logon.')
         rhevm.api.powershell._register(powershell)
+        if rhevm.api.warmup:
+            rhevm.api.warmup.start(auth)
+        return input
+
+
+class SetCommandDeadline(InputFilter):
+    """Derive the deadline for PowerShell commands from the time that is
+    left of the request budget, and set the command timeout of the
+    collection."""
+
+    def filter(self, input):
+        budget = application.request_timeout
+        if budget is not None:
+            powershell.deadline = application.started + budget
+        powershell.timeout = collection.timeout
         return input
 
 
@@ -85,7 +108,18 @@ class HandlePowerShellError(ExceptionHandler):
         raise Error(http.BAD_REQUEST, headers=headers, body=body)
 
 
+class HandleCommandTimeout(ExceptionHandler):
+    """Handle a PowerShell command timeout -> 504 GATEWAY TIMEOUT."""
+
+    def handle(self, exception):
+        if not isinstance(exception, CommandTimeout):
+            return exception
+        raise Error(http.GATEWAY_TIMEOUT, reason=str(exception))
+
+
 def setup_module(app):
     app.add_input_filter(RequireAuthentication(), priority=20)
+    app.add_input_filter(SetCommandDeadline(), priority=30)
     app.add_output_filter(AddServerIdentification())
     app.add_exception_handler(HandlePowerShellError())
+    app.add_exception_handler(HandleCommandTimeout())
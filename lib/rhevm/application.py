@@ -6,18 +6,43 @@
 # RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
 # "AUTHORS" for a complete overview.
 
+import os
+import time
+
 from rest import Application
 import rhevm.api
 from rhevm.pool import Pool
+from rhevm.broker import BrokerClient, parse_address
 from rhevm.powershell import PowerShell
 from rhevm.util import create_powershell
+from rhevm.warmup import Warmup
+
+# If a shell broker is configured, all worker processes share its shells.
+# Otherwise every process has its own pool.
+if os.environ.get('RHEVM_API_BROKER'):
+    address = parse_address(os.environ['RHEVM_API_BROKER'])
+    rhevm.api.pool = BrokerClient(address)
+else:
+    rhevm.api.pool = Pool(PowerShell, create_powershell)
 
-rhevm.api.pool = Pool(PowerShell, create_powershell)
+# If a service account ("user@domain") is configured, the lookup caches are
+# loaded for it when it logs on, and are kept warm in the background.
+if os.environ.get('RHEVM_API_WARMUP'):
+    rhevm.api.warmup = Warmup(rhevm.api.pool, os.environ['RHEVM_API_WARMUP'])
 
 
 class RhevmApplication(Application):
     """The RHEVM API application."""
 
+    # The time budget of a request in seconds. PowerShell commands are
+    # interrupted when it is exceeded.
+    request_timeout = 120
+
+    def respond(self):
+        self.started = time.time()
+        rhevm.api.pool.start()
+        return super(RhevmApplication, self).respond()
+
     def load_modules(self):
         super(RhevmApplication, self).load_modules()
         self.load_module('rhevm.appcfg')
@@ -33,10 +58,14 @@ class RhevmApplication(Application):
     def close(self):
         powershell = rhevm.api.powershell._release()
         if powershell:
+            powershell.timeout = None
+            powershell.deadline = None
+            powershell.vm_handles = None
             rhevm.api.pool.put(powershell)
-        rhevm.api.pool.maintenance()  # this is async
 
     @classmethod
     def shutdown(cls):
+        if rhevm.api.warmup:
+            rhevm.api.warmup.stop()
         if rhevm.api.pool:
-            rhevm.api.pool.clear()
+            rhevm.api.pool.drain()
@@ -0,0 +1,404 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+# A shell broker is a process that owns the pool and the PowerShell
+# processes, so that several web worker processes can share them. Workers
+# use a BrokerClient in place of a Pool. It leases shells from the broker
+# over a local TCP connection, and the commands on a leased shell are run by
+# the broker.
+#
+# The protocol is a sequence of request and reply messages, each a JSON
+# object preceded by its length as a 4-byte big endian integer. A request
+# has an "op" key:
+#
+#  - lease: lease a shell for "args" (the credentials), waiting at most
+#    "timeout" seconds. Reply: "version".
+#  - execute: run "command" with "args" on the leased shell. "timeout" is
+#    the command timeout, "deadline" the number of seconds after which the
+#    command must be interrupted, and "records" selects Records instead of
+#    Resources. Reply: "result" and "broken".
+#  - execute_many: run the list "commands". Reply: "result" and "broken".
+#  - release: return the leased shell to the pool.
+#  - stats: reply: "stats", the statistics of the pool.
+#
+# A failed request gets a reply with an "error" key. A shell that is still
+# leased when the connection is closed is returned to the pool.
+
+import sys
+import time
+import socket
+import struct
+import logging
+import SocketServer
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from rest.resource import Resource
+from rhevm.error import Error, PowerShellError, ParseError, CommandTimeout
+from rhevm.pool import Pool, PoolTimeout
+from rhevm.record import Record, get_schema
+
+
+default_address = ('127.0.0.1', 5711)
+
+
+class BrokerError(Error):
+    """The connection with the broker failed."""
+
+
+_errors = { 'PowerShellError': PowerShellError, 'ParseError': ParseError,
+            'CommandTimeout': CommandTimeout, 'PoolTimeout': PoolTimeout }
+
+
+def _encode(value):
+    """INTERNAL: convert a value to something that can be serialized."""
+    if isinstance(value, Record):
+        return { '!record': [value.type, list(value.schema.names),
+                             map(_encode, value.values)] }
+    elif isinstance(value, dict):
+        return dict(((key, _encode(value[key])) for key in value))
+    elif isinstance(value, (list, tuple)):
+        return map(_encode, value)
+    elif isinstance(value, Exception):
+        return { '!error': _encode_error(value) }
+    return value
+
+
+def _decode(value):
+    """INTERNAL: the inverse of _encode()."""
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    elif isinstance(value, list):
+        return map(_decode, value)
+    elif not isinstance(value, dict):
+        return value
+    elif '!record' in value:
+        type, names, values = _decode(value['!record'])
+        return Record(get_schema(type, tuple(names)), tuple(values))
+    elif '!error' in value:
+        return _decode_error(value['!error'])
+    result = dict(((_decode(key), _decode(value[key])) for key in value))
+    if '!type' in result:
+        return Resource(result['!type'], result)
+    return result
+
+
+def _encode_error(exception):
+    """INTERNAL: encode an exception."""
+    return { 'type': type(exception).__name__, 'message': str(exception),
+             'id': getattr(exception, 'id', None) }
+
+
+def _decode_error(error):
+    """INTERNAL: return the exception for an encoded exception."""
+    cls = _errors.get(error['type'])
+    if cls is PowerShellError:
+        return PowerShellError(error['message'], error['id'])
+    elif cls is not None:
+        return cls(error['message'])
+    return BrokerError('%s: %s' % (error['type'], error['message']))
+
+
+def send_message(sock, message):
+    """Send a message on a socket."""
+    data = json.dumps(_encode(message))
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def recv_message(sock):
+    """Receive a message from a socket. Return None if the connection was
+    closed before a message started."""
+    header = _recv_exactly(sock, 4)
+    if not header:
+        return
+    size, = struct.unpack('!I', header)
+    data = _recv_exactly(sock, size)
+    if len(data) != size:
+        raise socket.error('Connection closed in message.')
+    return _decode(json.loads(data))
+
+
+def _recv_exactly(sock, size):
+    """INTERNAL: read `size` bytes, or less if the connection is closed."""
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def parse_address(address):
+    """Parse a "host:port" address."""
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+
+class _BrokerHandler(SocketServer.BaseRequestHandler):
+    """INTERNAL: serve one client connection."""
+
+    def setup(self):
+        self.pool = self.server.pool
+        self.logger = self.server.logger
+        self.shell = None
+
+    def handle(self):
+        try:
+            while True:
+                message = recv_message(self.request)
+                if message is None:
+                    break
+                try:
+                    reply = self.dispatch(message)
+                except Exception, e:
+                    if not isinstance(e, Error):
+                        self.logger.exception('Uncaught exception in broker')
+                    reply = { 'error': _encode_error(e) }
+                send_message(self.request, reply)
+        except socket.error, e:
+            self.logger.debug('Connection error: %s' % e)
+
+    def finish(self):
+        if self.shell is not None:
+            self.release()
+
+    def dispatch(self, message):
+        op = message['op']
+        if op == 'stats':
+            return { 'stats': self.pool.stats() }
+        elif op == 'lease':
+            if self.shell is not None:
+                raise BrokerError('A shell is already leased.')
+            self.shell = self.pool.get(message['args'],
+                                       message.get('timeout'))
+            return { 'version': getattr(self.shell, 'version', None) }
+        if self.shell is None:
+            raise BrokerError('No shell is leased.')
+        if op == 'release':
+            self.release()
+            return {}
+        self.shell.timeout = message.get('timeout')
+        deadline = message.get('deadline')
+        if deadline is not None:
+            deadline += time.time()
+        self.shell.deadline = deadline
+        if op == 'execute':
+            command, args = message['command'], message.get('args', ())
+            if message.get('records'):
+                result = list(self.shell.iterexecute(command, *args,
+                                                     records=True))
+            else:
+                result = self.shell.execute(command, *args)
+        elif op == 'execute_many':
+            result = self.shell.execute_many(message['commands'])
+        else:
+            raise BrokerError('Unknown operation: %s' % op)
+        return { 'result': result, 'broken': self.shell.broken }
+
+    def release(self):
+        shell = self.shell
+        self.shell = None
+        shell.timeout = None
+        shell.deadline = None
+        self.pool.put(shell)
+
+
+class Broker(SocketServer.ThreadingTCPServer):
+    """The shell broker. Serves the shells of `pool` on `address`.
+
+    Every connection is served by its own thread. Bind to a loopback
+    address only: clients pass the credentials for their shells.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, pool, address=default_address):
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 _BrokerHandler)
+        self.pool = pool
+        self.logger = logging.getLogger('rhevm.broker')
+
+
+class RemoteShell(object):
+    """A shell that is leased from a broker. It has the same interface as
+    PowerShell, and is used in the same way."""
+
+    def __init__(self, address):
+        self.address = address
+        self.sock = None
+        self.args = None
+        self.version = None
+        self.broken = False
+        self.timeout = None
+        self.deadline = None
+
+    def _call(self, message):
+        """INTERNAL: send a request and return the reply."""
+        try:
+            send_message(self.sock, message)
+            reply = recv_message(self.sock)
+        except socket.error, e:
+            self.broken = True
+            raise BrokerError('Connection with broker failed: %s' % e)
+        if reply is None:
+            self.broken = True
+            raise BrokerError('Connection closed by broker.')
+        if 'error' in reply:
+            raise _decode_error(reply['error'])
+        self.broken = reply.get('broken', False)
+        return reply
+
+    def _command(self, message, timeout=None):
+        """INTERNAL: run a command request."""
+        if timeout is None:
+            timeout = self.timeout
+        message['timeout'] = timeout
+        if self.deadline is not None:
+            message['deadline'] = self.deadline - time.time()
+        return self._call(message)['result']
+
+    def lease(self, args, timeout=None):
+        """Lease a shell for the credentials `args`."""
+        self.sock = socket.create_connection(self.address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.args = args
+        reply = self._call({ 'op': 'lease', 'args': args,
+                             'timeout': timeout })
+        if reply['version'] is not None:
+            self.version = tuple(reply['version'])
+
+    def release(self):
+        """Return the shell to the pool of the broker."""
+        if self.sock is None:
+            return
+        try:
+            if not self.broken:
+                self._call({ 'op': 'release' })
+        finally:
+            self.sock.close()
+            self.sock = None
+
+    def execute(self, command, *args, **kwargs):
+        return self._command({ 'op': 'execute', 'command': command,
+                               'args': args }, kwargs.get('timeout'))
+
+    def execute_many(self, commands, timeout=None):
+        return self._command({ 'op': 'execute_many',
+                               'commands': commands }, timeout)
+
+    def iterexecute(self, command, *args, **kwargs):
+        # The output is transferred as a whole.
+        result = self._command({ 'op': 'execute', 'command': command,
+                                 'args': args,
+                                 'records': kwargs.get('records', False) },
+                               kwargs.get('timeout'))
+        return iter(result)
+
+
+class BrokerClient(object):
+    """A client of a broker, that can be used in place of a Pool."""
+
+    def __init__(self, address=default_address):
+        self.address = address
+        self.logger = logging.getLogger('rhevm.broker')
+
+    def get(self, args, timeout=None):
+        """Lease a shell for `args`. Raise PoolTimeout if the broker is not
+        available."""
+        shell = RemoteShell(self.address)
+        try:
+            shell.lease(args, timeout)
+        except (socket.error, BrokerError), e:
+            shell.broken = True
+            shell.release()
+            raise PoolTimeout('Broker not available: %s' % e)
+        except Exception:
+            shell.broken = True
+            shell.release()
+            raise
+        return shell
+
+    def put(self, shell):
+        """Return a shell."""
+        try:
+            shell.release()
+        except BrokerError, e:
+            self.logger.debug('Could not release shell: %s' % e)
+
+    def stats(self):
+        """Return the statistics of the pool of the broker."""
+        shell = RemoteShell(self.address)
+        shell.sock = socket.create_connection(self.address)
+        try:
+            return shell._call({ 'op': 'stats' })['stats']
+        finally:
+            shell.sock.close()
+
+    # The pool is maintained by the broker.
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def maintenance(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def drain(self, timeout=None, budget=None):
+        return 0
+
+
+def main():
+    """Run a broker."""
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-a', '--address', metavar='HOST:PORT',
+                      default='%s:%d' % default_address,
+                      help='listen on HOST:PORT [default: %default]')
+    parser.add_option('-s', '--standin', action='store_true',
+                      help='use stand-in shells instead of PowerShell')
+    parser.add_option('-d', '--debug', action='store_true',
+                      help='show debugging output')
+    opts, args = parser.parse_args()
+    logging.basicConfig(stream=sys.stdout,
+                        level=opts.debug and logging.DEBUG or logging.INFO,
+                        format='%(levelname)s [%(name)s] %(message)s')
+    if opts.standin:
+        from rhevm.standin import StandInShell, create_standin
+        pool = Pool(StandInShell, create_standin)
+    else:
+        from rhevm.powershell import PowerShell
+        from rhevm.util import create_powershell
+        pool = Pool(PowerShell, create_powershell)
+    broker = Broker(pool, parse_address(opts.address))
+    logger = logging.getLogger('rhevm.broker')
+    logger.info('Listening on %s:%d' % broker.server_address)
+    pool.start()
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    broker.server_close()
+    pool.drain()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+import time
+import threading
+
+from rhevm.api import metrics
+
+# Indexes in a cache entry, which is a link in a doubly linked list that is
+# ordered by last use.
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES = range(5)
+
+# All caches, by name.
+_caches = {}
+
+
+class Cache(object):
+    """A bounded cache. Entries expire `ttl` seconds after they were stored,
+    and if the cache holds `maxsize` entries, storing a new entry evicts the
+    least recently used one. The cache can be used from multiple threads.
+
+    Caches have a `kind`, the type of object that they store information
+    on, so that all caches for a kind can be invalidated at once when an
+    object of that kind is changed.
+    """
+
+    maxsize = 1000
+    ttl = 300
+
+    def __init__(self, name, kind=None, maxsize=None, ttl=None):
+        """Constructor."""
+        self.name = name
+        self.kind = kind
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if ttl is not None:
+            self.ttl = ttl
+        self._entries = {}
+        # The root of the list. root[_NEXT] is the least recently used
+        # entry, root[_PREV] the most recently used one.
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key, default=None):
+        """Return the value for `key`, or `default` if there is no valid
+        entry for it."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and entry[_EXPIRES] <= time.time():
+                self._unlink(entry)
+                del self._entries[key]
+                self._expirations += 1
+                entry = None
+            if entry is None:
+                self._misses += 1
+                metrics.increment('cache.%s.misses' % self.name)
+                return default
+            self._unlink(entry)
+            self._link(entry)
+            self._hits += 1
+            metrics.increment('cache.%s.hits' % self.name)
+            return entry[_VALUE]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        """Store `value` for `key`."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._unlink(entry)
+            elif len(self._entries) >= self.maxsize:
+                oldest = self._root[_NEXT]
+                self._unlink(oldest)
+                del self._entries[oldest[_KEY]]
+                self._evictions += 1
+            entry = [None, None, key, value, time.time() + self.ttl]
+            self._link(entry)
+            self._entries[key] = entry
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key):
+        """Remove the entry for `key`, if any."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Remove all entries."""
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            root = self._root
+            root[:] = [root, root, None, None, None]
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        """Return whether there is a valid entry for `key`. This does not
+        count as a use of the entry."""
+        entry = self._entries.get(key)
+        return entry is not None and entry[_EXPIRES] > time.time()
+
+    def size(self):
+        """Return the number of entries, including expired ones that have
+        not been removed yet."""
+        return len(self._entries)
+
+    def stats(self):
+        """Return a dictionary with statistics on the cache."""
+        self._lock.acquire()
+        try:
+            requests = self._hits + self._misses
+            stats = { 'size': len(self._entries), 'hits': self._hits,
+                      'misses': self._misses,
+                      'evictions': self._evictions,
+                      'expirations': self._expirations,
+                      'hit_rate': requests and
+                                  float(self._hits) / requests or 0.0 }
+        finally:
+            self._lock.release()
+        return stats
+
+    def _link(self, entry):
+        """INTERNAL: add an entry as the most recently used one."""
+        root = self._root
+        last = root[_PREV]
+        entry[_PREV] = last
+        entry[_NEXT] = root
+        last[_NEXT] = root[_PREV] = entry
+
+    def _unlink(self, entry):
+        """INTERNAL: remove an entry from the list."""
+        entry[_PREV][_NEXT] = entry[_NEXT]
+        entry[_NEXT][_PREV] = entry[_PREV]
+
+
+def create_cache(name, kind=None, maxsize=None, ttl=None):
+    """Create a cache and register it under `name`."""
+    cache = Cache(name, kind, maxsize, ttl)
+    _caches[name] = cache
+    return cache
+
+
+def get_cache(name):
+    """Return the cache `name`."""
+    return _caches[name]
+
+
+def invalidate(kind):
+    """Clear all caches for objects of type `kind`. Call this after an
+    object of that type has been created, changed or removed."""
+    for cache in _caches.values():
+        if cache.kind == kind:
+            cache.clear()
+
+
+def stats():
+    """Return the statistics of all caches, by name."""
+    return dict(((name, _caches[name].stats()) for name in _caches))
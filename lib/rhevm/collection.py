@@ -6,17 +6,24 @@
 # RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
 # "AUTHORS" for a complete overview.
 
+from argproc.parser import RuleParser
 from rest import http
 from rest.api import request
 from rest.collection import Collection
 from rest.api import request
 from rhevm.api import powershell
+from rhevm.powershell import escape
+from rhevm.record import Record, RecordList
 from rest.error import HTTPReturn
 
 
 class RhevmCollection(Collection):
     """Base class for all rhevm-api collections."""
 
+    # Timeout in seconds for the PowerShell commands of this collection.
+    # None means the default timeout.
+    timeout = None
+
     def _get_tags(self, tags, resource):
         tags.append('rhevm%d%s' % powershell.version[:2])
         if 'command' in resource:
@@ -37,3 +44,65 @@ class RhevmCollection(Collection):
             raise HTTPReturn(http.NOT_ACCEPTABLE,
                              reason='Non-integer "detail" in Accept header.')
         return detail
+
+    def _get_rules(self):
+        """Return the parsed rules of the entity transform."""
+        cls = type(self)
+        if '_rules' not in cls.__dict__:
+            cls._rules = RuleParser().parse(self.entity_transform)
+        return cls._rules
+
+    def _match_tags(self, rule, tags):
+        """Match a rule against a set of tags (like the transformer)."""
+        if rule.tags is None:
+            return True
+        for tag in rule.tags:
+            if tag.negated and tag.name not in tags:
+                return True
+            elif not tag.negated and tag.name in tags:
+                return True
+        return False
+
+    def _get_properties(self, fields=None):
+        """Return the object properties that are used to create the
+        external representation. If `fields` is provided, only return the
+        properties needed for those (external) fields."""
+        tags = self._get_tags([request.match['action']], {})
+        properties = set()
+        found = set()
+        for rule in self._get_rules():
+            if rule.direction == '=>' or not self._match_tags(rule, tags):
+                continue
+            if fields is not None:
+                matched = fields.intersection(rule.left.assigned_fields())
+                found.update(matched)
+                # Mandatory rules fail on missing properties.
+                if not matched and not rule.mandatory:
+                    continue
+            properties.update(rule.right.referenced_fields())
+        if fields is not None and found != fields:
+            unknown = ', '.join(sorted(fields - found))
+            raise HTTPReturn(http.BAD_REQUEST,
+                             reason='Unknown fields: %s' % unknown)
+        properties.discard('!type')
+        return sorted(properties)
+
+    def _select(self, command, fields=None):
+        """Execute `command`, only selecting the object properties that are
+        needed by the entity transform. `fields` is the value of the
+        "fields" query parameter, if any. Return a RecordList."""
+        if fields is not None:
+            fields = set((field.strip() for field in fields.split(',')))
+        properties = self._get_properties(fields)
+        names = ','.join(map(escape, properties))
+        # The objects are kept as Records, which are converted to Resources
+        # one by one when they are transformed.
+        objects = powershell.iterexecute('%s | Select-Properties @(%s)'
+                                         % (command, names), records=True)
+        result = RecordList()
+        for obj in objects:
+            # Select-Object returns a PSCustomObject
+            if isinstance(obj, Record) and obj.type == 'pscustomobject':
+                obj = obj.retype(self.contains)
+            result.append(obj)
+        return result
@@ -9,3 +9,22 @@
 
 class Error(Exception):
     pass
+
+
+class PowerShellError(Error):
+    """A PowerShell command exited with an error."""
+
+    def __init__(self, message=None, id=None):
+        self.message = message
+        self.id = id
+
+    def __str__(self):
+        return self.message or ''
+
+
+class ParseError(Error):
+    """Error parsing PowerShell output."""
+
+
+class CommandTimeout(ParseError):
+    """A PowerShell command did not complete in time."""
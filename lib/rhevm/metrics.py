@@ -0,0 +1,65 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+import threading
+
+
+class Metrics(object):
+    """A set of named counters that can be updated from multiple threads."""
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        """Increment the counter `name` by `value`."""
+        self._lock.acquire()
+        try:
+            self._counters[name] = self._counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def observe(self, name, value, buckets):
+        """Add `value` to the histogram `name`. The histogram is a set of
+        counters: "name.le_<bound>" for the first of the increasing bounds
+        in `buckets` that is not lower than `value` (or "name.le_inf"),
+        "name.count" and "name.sum"."""
+        for bound in buckets:
+            if value <= bound:
+                bucket = '%s.le_%s' % (name, bound)
+                break
+        else:
+            bucket = '%s.le_inf' % name
+        self._lock.acquire()
+        try:
+            for counter,increment in ((bucket, 1), (name + '.count', 1),
+                                      (name + '.sum', value)):
+                self._counters[counter] = \
+                        self._counters.get(counter, 0) + increment
+        finally:
+            self._lock.release()
+
+    def get(self, name):
+        """Return the value of the counter `name`."""
+        return self._counters.get(name, 0)
+
+    def snapshot(self):
+        """Return a dictionary with the current value of all counters."""
+        self._lock.acquire()
+        try:
+            return self._counters.copy()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Reset all counters."""
+        self._lock.acquire()
+        try:
+            self._counters.clear()
+        finally:
+            self._lock.release()
@@ -26,16 +26,17 @@ class DataCenterCollection(RhevmCollection):
         $status <= $Status
     """
 
-    def show(self, id):
+    def show(self, id, fields=None):
         filter = create_filter(datacenterid=id)
-        result = powershell.execute('Select-DataCenter | %s' % filter)
+        result = self._select('Select-DataCenter | %s' % filter, fields)
         if len(result) != 1:
             return
         return result[0]
 
     def list(self, **filter):
+        fields = filter.pop('fields', None)
         filter = create_filter(**filter)
-        result = powershell.execute('Select-DataCenter | %s' % filter)
+        result = self._select('Select-DataCenter | %s' % filter, fields)
         return result
 
     def create(self, input):
@@ -9,6 +9,7 @@
 from rest import http
 from rest.api import mapper, request, response
 from rhevm.api import powershell
+from rhevm.powershell import PowerShellError
 from rhevm.util import *
 from rhevm.collection import RhevmCollection
 
@@ -45,83 +46,86 @@ class DiskCollection(RhevmCollection):
         $boot <= boolean($Boot)
         """
 
-    def show(self, vm, id):
-        filter = create_filter(vmid=vm)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+    def show(self, vm, id, fields=None):
+        handle = vm_handle(vm)
+        if handle is None:
             return
         filter = create_filter(snapshotid=id)
-        result = powershell.execute('$vm.GetDiskImages() | %s' % filter)
+        result = self._select('%s.GetDiskImages() | %s' % (handle, filter),
+                              fields)
         if not result:
             return
         return result[0]
 
     def list(self, vm, **args):
-        filter = create_filter(vmid=vm)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+        fields = args.pop('fields', None)
+        handle = vm_handle(vm)
+        if handle is None:
             return
         filter = create_filter(**args)
-        result = powershell.execute('$vm.GetDiskImages() | %s' % filter)
+        result = self._select('%s.GetDiskImages() | %s' % (handle, filter),
+                              fields)
         return result
 
     def create(self, vm, input):
-        filter = create_filter(vmid=vm)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+        handle = vm_handle(vm)
+        if handle is None:
             raise KeyError
         # With RHEVM-2.1, when adding a disk with Add-Disk, the new SnapshotId
         # is not returned. Therefore we need to compare disk images before and
         # after to conclude what our new SnapshotId is. On RHEVM-2.2 the
         # SnapshotId seems to be returned.
-        result = powershell.execute('$vm.GetDiskImages()')
-        old = set((disk['SnapshotId'] for disk in result))
+        images = powershell.execute('%s.GetDiskImages()' % handle)
+        old = set((disk['SnapshotId'] for disk in images))
         create = { 'DiskSize': input.pop('DiskSize') }
         cmdline = create_cmdline(**create)
         updates = create_setattr('disk', **input)
-        powershell.execute('$disk = New-Disk %s; %s' % (cmdline, updates))
         if powershell.version >= (2, 2):
-            vmref = '-VmObject $vm'
+            vmref = '-VmObject %s' % handle
         else:
-            vmref = '-VmId $vm.VmId'
+            vmref = '-VmId %s' % escape(str(vm))
+        # Reset $disk so that a failing New-Disk cannot cause a disk from an
+        # earlier request to be added by Add-Disk below.
+        commands = [ '$disk = $null; $disk = New-Disk %s; %s'
+                     % (cmdline, updates) ]
         if input.get('VolumeType') == 'Preallocated':
-            result = powershell.execute('Add-Disk -DiskObject $disk %s -Async'
-                                        % vmref)
-            tasks = powershell.execute('Get-LastCommandTasks')
+            commands.append('Add-Disk -DiskObject $disk %s -Async' % vmref)
+            commands.append('Get-LastCommandTasks')
             async = True
         else:
-            result = powershell.execute('Add-Disk -DiskObject $disk %s'
-                                        % vmref)
+            commands.append('Add-Disk -DiskObject $disk %s' % vmref)
             async = False
-        result = powershell.execute('$vm.GetDiskImages()')
-        new = set((disk['SnapshotId'] for disk in result))
-        diskid = (new - old).pop()
-        filter = create_filter(snapshotid=diskid)
-        result = powershell.execute('$vm.GetDiskImages() | %s' % filter)
+        commands.append('%s.GetDiskImages()' % handle)
+        results = powershell.execute_many(commands)
+        for result in results:
+            if isinstance(result, PowerShellError):
+                raise result
+        if async:
+            tasks = results[-2]
+        new = dict(((disk['SnapshotId'], disk) for disk in results[-1]))
+        diskid = (set(new) - old).pop()
+        disk = new[diskid]
         if async:
             response.status = http.ACCEPTED
             url = mapper.url_for(collection='tasks', action='show',
                                  id=tasks[0]['TaskId'])
             response.set_header('Link', '<%s>; rel=status' % url)
         url = mapper.url_for(collection=self.name, action='show', 
-                             id=result[0]['SnapshotId'], vm=vm)
-        return url, result[0]
+                             id=disk['SnapshotId'], vm=vm)
+        return url, disk
 
     def delete(self, vm, id):
-        filter = create_filter(vmid=vm)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+        handle = vm_handle(vm)
+        if handle is None:
             raise KeyError
         filter = create_filter(snapshotid=id)
-        result = powershell.execute('$vm.GetDiskImages() | %s'
-                                    ' | Tee-Object -Variable disk' % filter)
+        result = powershell.execute('%s.GetDiskImages() | %s'
+                                    ' | Tee-Object -Variable disk'
+                                    % (handle, filter))
         if len(result) != 1:
             raise KeyError
-        powershell.execute('Remove-Disk -DiskId $disk.SnapshotId -VmId $vm.VmId')
+        powershell.execute('Remove-Disk -DiskId $disk.SnapshotId -VmId %s'
+                           % escape(str(vm)))
 
 
 def setup_module(app):
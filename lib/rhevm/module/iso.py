@@ -18,6 +18,8 @@ class IsoCollection(RhevmCollection):
 
     name = 'isos'
     contains = 'iso'
+    # Listing the ISO domain can be slow.
+    timeout = 120
     entity_transform = """
         $!type => $!type
         $!type <= "iso"
@@ -40,59 +40,56 @@ class NicCollection(RhevmCollection):
         $address <= $Address
         $id <= $Id
         """
-    def show(self, vm, id):
-        filter = create_filter(vmid=vm)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+    def show(self, vm, id, fields=None):
+        handle = vm_handle(vm)
+        if handle is None:
             return
         filter = create_filter(id=id)
-        result = powershell.execute('$vm.GetNetworkAdapters() | %s' % filter)
+        result = self._select('%s.GetNetworkAdapters() | %s'
+                              % (handle, filter), fields)
         if len(result) != 1:
             return
         return result[0]
 
     def list(self, vm, **args):
-        filter = create_filter(vmid=vm)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+        fields = args.pop('fields', None)
+        handle = vm_handle(vm)
+        if handle is None:
             return
         filter = create_filter(**args)
-        result = powershell.execute('$vm.GetNetworkAdapters() | %s' % filter)
+        result = self._select('%s.GetNetworkAdapters() | %s'
+                              % (handle, filter), fields)
         return result
 
     def create(self, vm, input):
-        filter = create_filter(vmid=vm)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+        handle = vm_handle(vm)
+        if handle is None:
             raise KeyError
         cmdline = create_cmdline(**input)
-        result = powershell.execute('Add-NetworkAdapter -VmObject $vm %s'
-                                    % cmdline)
+        result = powershell.execute('Add-NetworkAdapter -VmObject %s %s'
+                                    % (handle, cmdline))
         # On RHEV-M 2.1, i get weird output from Add-NetworkAdapter.. This is
         # not equal to the output of $vm.GetNetworkAdapters(). Re-fetch the
         # object again.
         filter = create_filter(name=input['InterfaceName'])  # This is unique
-        result = powershell.execute('$vm.GetNetworkAdapters() | %s' % filter)
+        result = powershell.execute('%s.GetNetworkAdapters() | %s'
+                                    % (handle, filter))
         url = mapper.url_for(collection=self.name, action='show',
                              id=result[0]['Id'],vm=vm)
         return url, result[0]
 
     def delete(self, vm, id):
-        filter = create_filter(vmid=vm)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+        handle = vm_handle(vm)
+        if handle is None:
             raise KeyError
         filter = create_filter(id=id)
-        result = powershell.execute('$vm.GetNetworkAdapters() | %s'
-                                    ' | Tee-Object -Variable nic' % filter)
+        result = powershell.execute('%s.GetNetworkAdapters() | %s'
+                                    ' | Tee-Object -Variable nic'
+                                    % (handle, filter))
         if len(result) != 1:
             raise KeyError
-        powershell.execute('Remove-NetworkAdapter -VmObject $vm '
-                           ' -NetworkAdapter $nic')
+        powershell.execute('Remove-NetworkAdapter -VmObject %s'
+                           ' -NetworkAdapter $nic' % handle)
 
 
 def setup_module(app):
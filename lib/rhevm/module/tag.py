@@ -29,16 +29,17 @@ class TagCollection(RhevmCollection):
         int($parent) <=> subif(int($ParentId), -1, None)
         """
 
-    def show(self, id):
+    def show(self, id, fields=None):
         cmdline = create_cmdline(Id=id)
-        result = powershell.execute('Get-Tag %s' % cmdline)
+        result = self._select('Get-Tag %s' % cmdline, fields)
         if not result:
             return
         return result[0]
 
     def list(self, **args):
+        fields = args.pop('fields', None)
         filter = create_filter(**args)
-        result = powershell.execute('Get-Tags | %s' % filter)
+        result = self._select('Get-Tags | %s' % filter, fields)
         return result
 
     def create(self, input):
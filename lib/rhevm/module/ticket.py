@@ -9,7 +9,7 @@
 from rest.api import mapper
 from rhevm.api import powershell
 from rhevm.collection import RhevmCollection
-from rhevm.util import create_filter, create_cmdline
+from rhevm.util import create_cmdline, vm_handle
 
 
 class VmTicketCollection(RhevmCollection):
@@ -24,13 +24,11 @@ class VmTicketCollection(RhevmCollection):
         """
 
     def create(self, vm, input):
-        filter = create_filter(vmid=vm)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+        handle = vm_handle(vm)
+        if handle is None:
             return
         cmdline = create_cmdline(**input)
-        powershell.execute('Set-VmTicket -VmObject $vm %s' % cmdline)
+        powershell.execute('Set-VmTicket -VmObject %s %s' % (handle, cmdline))
         url = mapper.url_for(collection='vm', action='show', id=vm)
         return url
 
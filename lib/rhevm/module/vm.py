@@ -70,18 +70,29 @@ class VmCollection(RhevmCollection):
         $query @list
         """
 
-    def show(self, id):
-        filter = create_filter(vmid=id)
-        result = powershell.execute('Select-Vm | %s' % filter)
+    # The references in a VM that the entity transform resolves, as
+    # (lookup function, properties).
+    references = [ (cluster_name, ('HostClusterId',)),
+                   (template_name, ('TemplateId',)),
+                   (host_name, ('DefaultHost', 'HostClusterId')),
+                   (host_name, ('RunningOnHost', 'HostClusterId')),
+                   (host_name, ('MigratingToHost', 'HostClusterId')),
+                   (pool_name, ('PoolId',)) ]
+
+    def show(self, id, fields=None):
+        result = self._select(select_vm_command(id), fields)
         if len(result) != 1:
             return
+        resolve_references(result, self.references)
         return result[0]
 
     def list(self, **filter):
         query = filter.pop('query', 'vms:')
+        fields = filter.pop('fields', None)
         filter = create_filter(**filter)
-        result = powershell.execute('Select-Vm -SearchText %s | %s'
-                                    % (escape(query), filter))
+        result = self._select('Select-Vm -SearchText %s | %s'
+                              % (escape(query), filter), fields)
+        resolve_references(result, self.references)
         return result
 
     def create(self, input):
@@ -97,23 +108,18 @@ class VmCollection(RhevmCollection):
         return url, result[0]
 
     def update(self, id, input):
-        filter = create_filter(vmid=id)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+        handle = vm_handle(id)
+        if handle is None:
             raise KeyError
         updates = create_setattr('vm', **input)
-        powershell.execute(updates)
+        powershell.execute('$vm = %s; %s' % (handle, updates))
         result = powershell.execute('Update-Vm -VmObject $vm')
         return result[0]
 
     def delete(self, id):
-        filter = create_filter(vmid=id)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+        if vm_handle(id) is None:
             raise KeyError
-        powershell.execute('Remove-Vm -VmId $vm.VmId')
+        powershell.execute('Remove-Vm -VmId %s' % escape(str(id)))
 
 
 def setup_module(app):
@@ -39,26 +39,27 @@ class VmControlCollection(RhevmCollection):
         """
 
     def create(self, vm, input):
-        filter = create_filter(vmid=vm)
-        result = powershell.execute('Select-Vm | %s'
-                                    ' | Tee-Object -Variable vm' % filter)
-        if len(result) != 1:
+        handle = vm_handle(vm)
+        if handle is None:
             return
         command = input.pop('command')
         if command == 'start':
             cmdline = create_cmdline(**input)
-            result = powershell.execute('Start-Vm -VmId $vm.VmId %s' % cmdline)
-        elif command == 'stop':
-            powershell.execute('Stop-Vm -VmObject $vm')
-        elif command == 'shutdown':
-            powershell.execute('Shutdown-Vm -VmObject $vm')
-        elif command == 'suspend':
-            powershell.execute('Suspend-Vm -VmObject $vm')
-        elif command == 'migrate':
-            cmdline = create_cmdline(**input)
-            powershell.execute('Migrate-Vm -VmObject $vm %s' % cmdline)
-        url = mapper.url_for(collection=self.name, action='show',
-                             id=result[0]['VmId'])
+            result = powershell.execute('Start-Vm -VmId %s %s'
+                                        % (escape(str(vm)), cmdline))
+        else:
+            if command == 'stop':
+                powershell.execute('Stop-Vm -VmObject %s' % handle)
+            elif command == 'shutdown':
+                powershell.execute('Shutdown-Vm -VmObject %s' % handle)
+            elif command == 'suspend':
+                powershell.execute('Suspend-Vm -VmObject %s' % handle)
+            elif command == 'migrate':
+                cmdline = create_cmdline(**input)
+                powershell.execute('Migrate-Vm -VmObject %s %s'
+                                   % (handle, cmdline))
+            result = powershell.execute(handle)
+        url = mapper.url_for(collection=self.name, action='show', id=vm)
         return url, result[0]
 
 
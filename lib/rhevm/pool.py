@@ -7,8 +7,41 @@
 # "AUTHORS" for a complete overview.
 
 import time
+import math
+import heapq
+import random
+import itertools
 import threading
 import logging
+from Queue import Queue, Empty
+from collections import deque
+
+from rhevm.api import metrics
+from rhevm.error import Error
+
+
+class PoolTimeout(Error):
+    """No instance became available in time."""
+
+
+class _Waiter(object):
+    """INTERNAL: a caller that waits for an instance."""
+
+    def __init__(self, key):
+        self.key = key
+        self.created = time.time()
+
+
+class _KeyStats(object):
+    """INTERNAL: demand statistics for a key."""
+
+    def __init__(self, args):
+        self.args = args
+        self.requests = 0
+        self.hits = 0
+        self.inuse = None
+        self.misses = None
+        self.last_request = None
 
 
 class Pool(object):
@@ -19,92 +52,338 @@ class Pool(object):
     # can be more responsive.
 
     # The algorithm is adaptive so there should be little reason to change
-    # these.
-    minsize = 2
+    # these. The number of instances per key follows the demand for that
+    # key, between `minsize` and `maxsize`. Demand is an exponentially
+    # weighted moving average (the newest sample has weight `alpha`) of the
+    # number of instances in use and of the miss rate. Keys that have not
+    # been used for `maxival` seconds shrink to zero.
+    minsize = 1
+    maxsize = 8
+    alpha = 0.2
     maxival = 300
     maxlife = 3600
     maxcount = 100
+
+    # Maintenance is done by a scheduler thread that is started by start().
+    # It runs every `fast_delay` seconds, give or take a random fraction
+    # `jitter`, and earlier when it is woken up by an event that needs it,
+    # like a miss. Runs are at least `min_delay` seconds apart. Shrinking
+    # the pool is done at most once every `slow_delay` seconds.
     fast_delay = 5
     slow_delay = 60
+    jitter = 0.2
+    min_delay = 1
+
+    # Idle instances that have reached this fraction of `maxcount` or
+    # `maxlife` are replaced by maintenance before they expire, so that
+    # requests do not have to wait for a new instance. The old instance is
+    # retired once the new one has been added.
+    rotate = 0.8
+
+    # Idle instances are probed by maintenance to find processes that died
+    # or sessions that were logged out: each instance at most once every
+    # `probe_interval` seconds, and at most `probe_rate` instances per run.
+    # An instance that has been idle for more than `check_idle` seconds is
+    # probed as well before it is handed out. Instances that fail a probe
+    # are terminated in the background and replaced by maintenance.
+    probe_interval = 60
+    probe_rate = 10
+    check_idle = 60
+
+    # Bounds (in seconds) of the histogram of instance creations that a
+    # request had to wait for.
+    spawn_buckets = (0.5, 1, 2, 4, 8, 16)
+
+    # The maximum number of instances that can be in use at the same time,
+    # per key and in total. Callers that would exceed this wait for an
+    # instance to be returned, in FIFO order, for at most `wait_timeout`
+    # seconds.
+    maxperkey = 10
+    maxtotal = 40
+    wait_timeout = 30
+
+    # The maximum number of instances, idle and in use, and optionally the
+    # maximum resident memory in KB that they may use together. If a key
+    # needs a new instance and the budget is exhausted, the least recently
+    # used idle instance of another key is evicted. Maintenance does not
+    # evict. `maxinstances` should not be lower than `maxtotal`.
+    maxinstances = 50
+    maxmemory = None
+
+    # The maximum number of instances that are created or terminated in
+    # parallel by maintenance and clear().
+    maxworkers = 4
+
+    # drain() waits at most `drain_timeout` seconds for the instances in use
+    # to be returned, and then terminates all instances, `drain_workers` at
+    # a time, in at most `drain_budget` seconds in total.
+    drain_timeout = 30
+    drain_budget = 10
+    drain_workers = 32
 
     def __init__(self, type, constructor):
         """Constructor"""
         self.type = type
         self.constructor = constructor
         self.logger = logging.getLogger('rhevm.pool')
+        # Idle instances per key, as (args, deque). The deques are ordered
+        # by last use, the most recently used instance is at the right.
         self._pool = {}
+        self._size = 0
+        # Expiry times of idle instances, as a heap of (expires, sequence,
+        # instance). Entries for instances that are not idle anymore or
+        # that have been put back since are skipped.
+        self._expiry = []
+        self._sequence = itertools.count()
+        # Instances to terminate at the next maintenance.
+        self._expired = []
         self._lock = threading.Lock()
-        self._thread = None
-        self._threads_to_join = []
-        self._last_maintenance = time.time()
-        self._last_full_maintenance = self._last_maintenance
+        self._cond = threading.Condition(self._lock)
+        self._waiters = []
+        self._max_waiting = 0
+        self._inuse = {}
+        self._inuse_total = 0
+        self._keys = {}
+        self._instances = {}
+        self._instances_total = 0
+        self._memory = {}
+        self._memory_total = 0
+        self._evictions = 0
+        self._spawns = 0
+        self._spawn_time = 0.0
+        self._spawn_time_max = 0.0
+        self._request_spawns = 0
+        self._rotations = 0
+        self._probes = 0
+        self._probe_failures = 0
+        self._scheduler = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._maintenance_runs = 0
+        self._last_maintenance = None
+        self._last_full_maintenance = time.time()
+        self._draining = False
 
-    def get(self, args):
-        """Return a new instance."""
-        instance = self._get_instance(args)
-        if not instance:
-            instance = self._create_instance(args)
+    def get(self, args, timeout=None):
+        """Return an instance. If the maximum number of instances in use
+        has been reached, wait at most `timeout` seconds (by default
+        `wait_timeout`) for one to be returned, and raise PoolTimeout if
+        that does not happen."""
+        if timeout is None:
+            timeout = self.wait_timeout
+        key = self._get_key(args)
+        self._lock.acquire()
+        try:
+            self._acquire(key, timeout)
+        finally:
+            self._lock.release()
+        try:
+            while True:
+                instance = self._get_instance(key)
+                if instance is None or self._validate_instance(instance):
+                    break
+            self._record_request(key, args, instance is not None)
+            if not instance:
+                # Refill in the background, for the next request.
+                self.maintenance()
+                instance = self._create_instance(args)
+                self._lock.acquire()
+                try:
+                    self._request_spawns += 1
+                finally:
+                    self._lock.release()
+                metrics.observe('pool.request_spawn_time',
+                                instance.spawn_time, self.spawn_buckets)
+        except Exception:
+            self._release(key)
+            raise
         return instance
 
     def put(self, instance):
         """Put an instance back into the pool."""
-        instance.count += 1
-        instance.last_time = time.time()
-        self._add_instance(instance.args, instance)
+        try:
+            if instance.broken:
+                self.logger.debug('Discarding broken instance of type <%s>'
+                                  % self._get_type())
+                self._discard(instance)
+                return
+            elif instance.retired or self._draining:
+                self._discard(instance)
+                return
+            instance.count += 1
+            instance.last_used = time.time()
+            self._update_memory(instance)
+            self._add_instance(instance.args, instance)
+        finally:
+            self._release(instance.key)
 
     def clear(self):
         """Clear the pool (NOT thread safe)."""
-        if self._thread:
-            self._thread.join()
-        terminate = []
-        for key in self._pool:
-            terminate += self._pool[key][1]
-        self._pool.clear()
-        for inst in terminate:
-            self._terminate_instance(inst)
+        terminate = self._remove_all()
+        self._run_parallel(self._terminate_instance, terminate)
         if terminate:
             self.logger.debug('Cleared <%s> pool (%d instances)'
                               % (self._get_type(), len(terminate)))
-        self._thread = None
+
+    def drain(self, timeout=None, budget=None):
+        """Drain the pool before shutting down. Stop handing out instances
+        and wait at most `timeout` seconds for the instances in use to be
+        returned. Then stop maintenance and terminate all instances in
+        parallel, in at most `budget` seconds. Instances that are returned
+        or created by maintenance after this are terminated. Return the
+        number of instances that were still in use."""
+        if timeout is None:
+            timeout = self.drain_timeout
+        if budget is None:
+            budget = self.drain_budget
+        self._lock.acquire()
+        try:
+            self._draining = True
+            # Wake up the waiters so that they give up.
+            self._cond.notifyAll()
+            deadline = time.time() + timeout
+            while self._inuse_total:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            inuse = self._inuse_total
+        finally:
+            self._lock.release()
+        if inuse:
+            self.logger.info('Draining <%s> pool with %d instances in use'
+                             % (self._get_type(), inuse))
+        start = time.time()
+        # A maintenance run that is in progress can still add instances.
+        if not self.stop(budget):
+            self.logger.error('Maintenance of <%s> pool did not stop in time'
+                              % self._get_type())
+        self._lock.acquire()
+        try:
+            terminate = self._remove_all()
+        finally:
+            self._lock.release()
+        remaining = max(0, budget - (time.time() - start))
+        left = self._terminate_all(terminate, remaining)
+        self.logger.info('Drained <%s> pool: terminated %d instances in '
+                         '%.2f seconds' % (self._get_type(),
+                                           len(terminate) - left,
+                                           time.time() - start))
+        if left:
+            self.logger.error('Could not terminate %d instances of type <%s> '
+                              'in time' % (left, self._get_type()))
+        return inuse
+
+    def stats(self):
+        """Return a dictionary with statistics on the pool."""
+        self._lock.acquire()
+        try:
+            keys = {}
+            for key in set(self._pool) | set(self._inuse) | set(self._keys):
+                keys[key] = info = {}
+                info['idle'] = len(self._pool.get(key, (None, []))[1])
+                info['inuse'] = self._inuse.get(key, 0)
+                info['instances'] = self._instances.get(key, 0)
+                info['memory'] = self._memory.get(key, 0)
+                demand = self._keys.get(key)
+                if demand is None:
+                    continue
+                info['requests'] = demand.requests
+                info['hit_rate'] = float(demand.hits) / demand.requests
+                info['inuse_avg'] = demand.inuse
+                info['miss_rate'] = demand.misses
+                info['target'] = self._get_target(demand)
+            stats = { 'inuse': self._inuse_total,
+                      'waiting': len(self._waiters),
+                      'max_waiting': self._max_waiting,
+                      'instances': self._instances_total,
+                      'memory': self._memory_total,
+                      'evictions': self._evictions,
+                      'spawns': self._spawns,
+                      'spawn_time': self._spawn_time,
+                      'spawn_time_max': self._spawn_time_max,
+                      'request_spawns': self._request_spawns,
+                      'rotations': self._rotations,
+                      'probes': self._probes,
+                      'probe_failures': self._probe_failures,
+                      'maintenance_runs': self._maintenance_runs,
+                      'draining': self._draining,
+                      'last_maintenance': self._last_maintenance,
+                      'keys': keys }
+        finally:
+            self._lock.release()
+        return stats
 
     def size(self):
         """Return the size of the pool."""
-        size = 0
+        return self._size
+
+    def start(self):
+        """Start the scheduler thread that maintains the pool. Does nothing
+        if it is already running."""
+        if self._scheduler is not None:
+            return
         self._lock.acquire()
         try:
-            for key in self._pool:
-                size += len(self._pool[key][1])
+            if self._scheduler is not None:
+                return
+            self._stopping.clear()
+            self._scheduler = threading.Thread(target=self._scheduler_loop)
+            self._scheduler.setDaemon(True)
+            self._scheduler.start()
         finally:
             self._lock.release()
-        return size
 
-    def maintenance(self):
-        """Perform maintenance on the pool."""
-        start = False
+    def stop(self, timeout=None):
+        """Stop the scheduler thread and wait at most `timeout` seconds for
+        it to exit. Return whether it exited."""
         self._lock.acquire()
         try:
-            if self._thread and not self._thread.isAlive():
-                self._thread.join()
-                self._thread = None
-            if self._thread is None and \
-                    time.time() - self._last_maintenance > self.fast_delay:
-                self._thread = threading.Thread(target=self._maintenance_thread)
-                start = True
+            scheduler = self._scheduler
+            self._scheduler = None
         finally:
             self._lock.release()
-        if start:
-            self._thread.start()
-    
-    def _maintenance_thread(self):
+        if scheduler is None:
+            return True
+        self._stopping.set()
+        self._wakeup.set()
+        scheduler.join(timeout)
+        return not scheduler.isAlive()
+
+    def maintenance(self):
+        """Request maintenance of the pool. It is done asynchronously by
+        the scheduler thread."""
+        self._wakeup.set()
+
+    def _scheduler_loop(self):
+        """INTERNAL: perform maintenance until the pool is stopped."""
+        self.logger.debug('Started scheduler thread.')
+        while not self._stopping.isSet():
+            delay = self.fast_delay * random.uniform(1.0 - self.jitter,
+                                                     1.0 + self.jitter)
+            self._wakeup.wait(delay)
+            if self._stopping.isSet():
+                break
+            self._wakeup.clear()
+            try:
+                self._run_maintenance()
+            except Exception:
+                self.logger.exception('Uncaught exception in maintenance')
+            self._stopping.wait(self.min_delay)
+        self.logger.debug('Stopped scheduler thread.')
+
+    def _run_maintenance(self):
         """INTERNAL: perform maintenance on the pool."""
-        self.logger.debug('Started maintenance thread.')
+        self._expire_instances()
+        self._rotate_instances()
+        self._probe_instances()
         if time.time() - self._last_full_maintenance > self.slow_delay:
-            self._expire_instances()
             self._decrease_size()
             self._last_full_maintenance = time.time()
         self._increase_size()
         self.logger.debug('Maintenance complete - pool size is now %d' \
                           % self.size())
+        self._maintenance_runs += 1
         self._last_maintenance = time.time()
 
     def _get_key(self, args):
@@ -119,104 +398,600 @@ class Pool(object):
         """INTERNAL: return a type identifier."""
         return self.type.__name__
 
-    def _create_instance(self, args):
+    def _can_acquire(self, key):
+        """INTERNAL: return whether an instance for `key` can be put in
+        use. Must be called with the lock held."""
+        return self._inuse.get(key, 0) < self.maxperkey \
+                and self._inuse_total < self.maxtotal
+
+    def _is_next(self, waiter):
+        """INTERNAL: return whether `waiter` can proceed. This is the case
+        if it can acquire an instance and no waiter before it can. Must be
+        called with the lock held."""
+        for other in self._waiters:
+            if self._can_acquire(other.key):
+                return other is waiter
+        return False
+
+    def _acquire(self, key, timeout):
+        """INTERNAL: reserve an instance for `key`, waiting in FIFO order
+        if the maximum number of instances in use has been reached. Must be
+        called with the lock held."""
+        if self._draining:
+            raise PoolTimeout('Pool is draining.')
+        waiter = _Waiter(key)
+        self._waiters.append(waiter)
+        self._max_waiting = max(self._max_waiting, len(self._waiters))
+        try:
+            if not self._is_next(waiter):
+                metrics.increment('pool.waits')
+                deadline = waiter.created + timeout
+                while not self._is_next(waiter):
+                    if self._draining:
+                        raise PoolTimeout('Pool is draining.')
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        metrics.increment('pool.wait_timeouts')
+                        raise PoolTimeout('No instance available after %d '
+                                          'seconds.' % timeout)
+                    self._cond.wait(remaining)
+                metrics.increment('pool.wait_time',
+                                  time.time() - waiter.created)
+            self._inuse[key] = self._inuse.get(key, 0) + 1
+            self._inuse_total += 1
+        finally:
+            self._waiters.remove(waiter)
+            # Our departure may allow the next waiter to proceed.
+            self._cond.notifyAll()
+
+    def _release(self, key):
+        """INTERNAL: release an instance for `key` that was in use."""
+        self._lock.acquire()
+        try:
+            self._inuse[key] -= 1
+            if not self._inuse[key]:
+                del self._inuse[key]
+            self._inuse_total -= 1
+            self._cond.notifyAll()
+        finally:
+            self._lock.release()
+
+    def _record_request(self, key, args, hit):
+        """INTERNAL: update the demand statistics of `key` for a request
+        that did (`hit`) or did not find an idle instance."""
+        self._lock.acquire()
+        try:
+            demand = self._keys.get(key)
+            if demand is None:
+                demand = self._keys[key] = _KeyStats(args)
+            demand.requests += 1
+            demand.last_request = time.time()
+            inuse = self._inuse.get(key, 0)
+            miss = float(not hit)
+            if demand.inuse is None:
+                demand.inuse = float(inuse)
+                demand.misses = miss
+            else:
+                demand.inuse += self.alpha * (inuse - demand.inuse)
+                demand.misses += self.alpha * (miss - demand.misses)
+            if hit:
+                demand.hits += 1
+        finally:
+            self._lock.release()
+        metrics.increment(hit and 'pool.hits' or 'pool.misses')
+
+    def _get_target(self, demand, now=None):
+        """INTERNAL: return the number of instances to keep for a key, in
+        use and idle."""
+        if now is None:
+            now = time.time()
+        if demand is None or now - demand.last_request > self.maxival:
+            return 0
+        # Keep the instances in use on average, plus more in proportion to
+        # the miss rate. A small tolerance keeps rounding errors in the
+        # average from adding an instance.
+        target = demand.inuse * (1.0 + demand.misses)
+        target = int(math.ceil(target - 0.01))
+        return max(self.minsize, min(self.maxsize, target))
+
+    def _run_parallel(self, func, items):
+        """INTERNAL: call `func` on every element of `items`, using at most
+        `maxworkers` threads. Return a list with the results, with the
+        exception instead of the result for calls that failed."""
+        results = [None] * len(items)
+        queue = Queue()
+        for ix in range(len(items)):
+            queue.put(ix)
+        def worker():
+            while True:
+                try:
+                    ix = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[ix] = func(items[ix])
+                except Exception, e:
+                    results[ix] = e
+        threads = []
+        for i in range(min(self.maxworkers, len(items))):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _over_budget(self):
+        """INTERNAL: return whether no instance can be added without
+        exceeding the budget. Must be called with the lock held."""
+        if self._instances_total >= self.maxinstances:
+            return True
+        if self.maxmemory and self._instances_total:
+            # Assume the new instance will use the average memory.
+            average = self._memory_total / self._instances_total
+            return self._memory_total + average > self.maxmemory
+        return False
+
+    def _find_victim(self, key):
+        """INTERNAL: return the key other than `key` that has the least
+        recently used idle instance. Must be called with the lock held."""
+        victim = None
+        for other in self._pool:
+            if other == key or not self._pool[other][1]:
+                continue
+            last_used = self._pool[other][1][0].last_used
+            if victim is None or last_used < victim[0]:
+                victim = (last_used, other)
+        return victim and victim[1]
+
+    def _reserve(self, key, evict):
+        """INTERNAL: account for a new instance for `key`. If this exceeds
+        the budget, expired instances that are waiting for maintenance are
+        reclaimed first. If that is not enough and `evict` is true, evict
+        idle instances of other keys, otherwise raise PoolTimeout."""
+        evicted = []
+        reclaimed = []
+        self._lock.acquire()
+        try:
+            # Maintenance does not create instances while draining.
+            if self._draining and not evict:
+                raise PoolTimeout('Pool is draining.')
+            if self._over_budget() and self._expired:
+                reclaimed = self._expired
+                self._expired = []
+                for inst in reclaimed:
+                    self._discount(inst.key, inst.memory)
+            while self._over_budget():
+                other = evict and self._find_victim(key)
+                if not other:
+                    raise PoolTimeout('No instance can be created within the '
+                                      'budget.')
+                victim = self._pool[other][1].popleft()
+                self._unpool(victim)
+                self._discount(other, victim.memory)
+                evicted.append(victim)
+            self._instances[key] = self._instances.get(key, 0) + 1
+            self._instances_total += 1
+            self._evictions += len(evicted)
+        finally:
+            self._lock.release()
+        if reclaimed:
+            self.logger.debug('Reclaimed %d expired instances of type <%s>'
+                              % (len(reclaimed), self._get_type()))
+        if evicted:
+            metrics.increment('pool.evictions', len(evicted))
+            self.logger.debug('Evicted %d instances of type <%s>'
+                              % (len(evicted), self._get_type()))
+        if reclaimed or evicted:
+            # Do not make the request wait for this.
+            thread = threading.Thread(target=self._run_parallel,
+                                      args=(self._stop_instance,
+                                            reclaimed + evicted))
+            thread.start()
+
+    def _discount(self, key, memory=0):
+        """INTERNAL: remove an instance for `key` that uses `memory` KB
+        from the accounting. Must be called with the lock held."""
+        self._instances[key] -= 1
+        if not self._instances[key]:
+            del self._instances[key]
+        self._instances_total -= 1
+        if memory:
+            self._memory[key] -= memory
+            if not self._memory[key]:
+                del self._memory[key]
+            self._memory_total -= memory
+
+    def _update_memory(self, instance):
+        """INTERNAL: measure the memory used by an instance."""
+        memory_usage = getattr(instance, 'memory_usage', None)
+        memory = memory_usage and memory_usage()
+        if memory is None:
+            return
+        key = instance.key
+        self._lock.acquire()
+        try:
+            delta = memory - instance.memory
+            instance.memory = memory
+            self._memory[key] = self._memory.get(key, 0) + delta
+            self._memory_total += delta
+        finally:
+            self._lock.release()
+
+    def _create_instance(self, args, evict=True):
         """INTERNAL: create a new PowerShell instance."""
-        instance = self.constructor(**args)
+        key = self._get_key(args)
+        self._reserve(key, evict)
+        start = time.time()
+        try:
+            instance = self.constructor(**args)
+        except Exception:
+            self._lock.acquire()
+            try:
+                self._discount(key)
+            finally:
+                self._lock.release()
+            raise
         instance.args = args
+        instance.key = key
+        instance.pooled = False
+        instance.last_probe = time.time()
+        instance.rotating = False
+        instance.retired = False
+        instance.memory = 0
         instance.count = 0
         instance.created = time.time()
         instance.last_used = instance.created
+        elapsed = instance.spawn_time = instance.created - start
+        self._lock.acquire()
+        try:
+            self._spawns += 1
+            self._spawn_time += elapsed
+            self._spawn_time_max = max(self._spawn_time_max, elapsed)
+        finally:
+            self._lock.release()
+        metrics.increment('pool.spawns')
+        metrics.increment('pool.spawn_time', elapsed)
+        self.logger.debug('Created instance of type <%s> in %.2f seconds'
+                          % (self._get_type(), elapsed))
+        self._update_memory(instance)
         return instance
 
-    def _terminate_instance(self, instance):
+    def _remove_all(self):
+        """INTERNAL: remove all idle and expired instances from the pool,
+        and return them."""
+        removed = self._expired
+        for key in self._pool:
+            removed += self._pool[key][1]
+        for inst in removed:
+            inst.pooled = False
+        self._pool.clear()
+        self._size = 0
+        self._expiry = []
+        self._expired = []
+        return removed
+
+    def _discard(self, instance):
+        """INTERNAL: queue an instance for termination by the scheduler,
+        so that the caller does not wait for it. If the scheduler is not
+        running, like after the pool was drained, the instance is
+        terminated in a background thread."""
+        self._lock.acquire()
+        try:
+            self._expired.append(instance)
+            scheduler = self._scheduler
+        finally:
+            self._lock.release()
+        if scheduler is not None:
+            self.maintenance()
+            return
+        thread = threading.Thread(target=self._expire_instances)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _terminate_instance(self, instance, timeout=None):
+        """INTERNAL: terminate an instance."""
+        self._lock.acquire()
         try:
-            instance.terminate()
+            self._discount(instance.key, instance.memory)
+        finally:
+            self._lock.release()
+        self._stop_instance(instance, timeout)
+
+    def _stop_instance(self, instance, timeout=None):
+        """INTERNAL: stop the process of an instance. If `timeout` is
+        given, the process is killed if it does not exit in time."""
+        try:
+            if timeout is None:
+                instance.terminate()
+            else:
+                instance.terminate(timeout)
         except Exception:
             pass
 
-    def _get_instance(self, args):
-        """INTERNAL: return an instance."""
+    def _terminate_all(self, instances, budget):
+        """INTERNAL: terminate `instances` in `drain_workers` threads, in
+        at most `budget` seconds. Return the number of instances that were
+        not terminated in time."""
+        deadline = time.time() + budget
+        queue = Queue()
+        for inst in instances:
+            queue.put(inst)
+        done = []
+        def worker():
+            while True:
+                try:
+                    inst = queue.get_nowait()
+                except Empty:
+                    return
+                # Give it half of the remaining time to exit, and keep
+                # the rest for killing it.
+                remaining = max(0, deadline - time.time())
+                self._terminate_instance(inst, remaining / 2)
+                done.append(inst)
+        threads = []
+        for i in range(min(self.drain_workers, len(instances))):
+            thread = threading.Thread(target=worker)
+            # A hanging instance must not keep the process alive.
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        return len(instances) - len(done)
+
+    def _get_instance(self, key):
+        """INTERNAL: return the most recently used idle instance for `key`,
+        or None if there is none."""
         now = time.time()
-        key = self._get_key(args)
+        instance = None
         self._lock.acquire()
         try:
-            if key not in self._pool or not self._pool[key][1]:
-                return
-            for ix,inst in enumerate(self._pool[key][1]):
-                if now - inst.created < self.maxlife \
-                        and now - inst.last_used < self.maxival \
-                        and inst.count < self.maxcount:
-                    del self._pool[key][1][ix]
-                    return inst
+            idle = key in self._pool and self._pool[key][1]
+            # Expired instances are moved out of the way. Each instance is
+            # moved once, so this is constant time on average.
+            while idle:
+                inst = idle.pop()
+                self._unpool(inst)
+                if inst.expires > now:
+                    instance = inst
+                    break
+                self._expired.append(inst)
         finally:
             self._lock.release()
+        return instance
 
     def _add_instance(self, args, instance):
         """INTERNAL: add a new instance to the pool."""
-        key = self._get_key(args)
+        key = instance.key
+        instance.expires = min(instance.created + self.maxlife,
+                               instance.last_used + self.maxival)
+        draining = False
         self._lock.acquire()
         try:
-            if key not in self._pool:
-                self._pool[key] = (args, [])
-            self._pool[key][1].append(instance)
-            self._pool[key][1].sort(lambda x,y: cmp(y.last_used, x.last_used))
+            if self._draining:
+                draining = True
+            elif instance.count >= self.maxcount:
+                self._expired.append(instance)
+            else:
+                if key not in self._pool:
+                    self._pool[key] = (args, deque())
+                self._pool[key][1].append(instance)
+                instance.pooled = True
+                self._size += 1
+                entry = (instance.expires, self._sequence.next(), instance)
+                heapq.heappush(self._expiry, entry)
+                # Drop stale entries once they are the majority, which
+                # keeps the heap linear in the pool size at constant
+                # amortized cost.
+                if len(self._expiry) > 2 * self._size + 100:
+                    self._expiry = [ entry for entry in self._expiry
+                                     if entry[2].pooled
+                                        and entry[2].expires == entry[0] ]
+                    heapq.heapify(self._expiry)
         finally:
             self._lock.release()
+        if draining:
+            # Created or probed by maintenance while the pool was drained.
+            self._terminate_instance(instance)
+
+    def _unpool(self, instance):
+        """INTERNAL: account for an instance that was taken out of the
+        pool. Must be called with the lock held."""
+        instance.pooled = False
+        self._size -= 1
 
     def _increase_size(self):
         """INTERNAL: increase the size of the pool."""
         create = []
+        now = time.time()
         self._lock.acquire()
         try:
-            for key in self._pool:
-                if len(self._pool[key][1]) < self.minsize:
-                    create.append(self._pool[key][0])
+            for key in self._keys:
+                demand = self._keys[key]
+                missing = self._get_target(demand, now)
+                missing -= self._inuse.get(key, 0)
+                if key in self._pool:
+                    missing -= len(self._pool[key][1])
+                create += [ demand.args ] * max(0, missing)
         finally:
             self._lock.release()
-        for args in create:
-            instance = self._create_instance(args)
+        start = time.time()
+        create_instance = lambda args: self._create_instance(args, False)
+        instances = self._run_parallel(create_instance, create)
+        created = 0
+        for args,instance in zip(create, instances):
+            if isinstance(instance, PoolTimeout):
+                continue
+            elif isinstance(instance, Exception):
+                self.logger.error('Could not create instance of type <%s>: '
+                                  '%s' % (self._get_type(), instance))
+                continue
             self._add_instance(args, instance)
+            created += 1
         if create:
-            self.logger.debug('Created %d instances of type <%s>' \
-                              % (len(create), self._get_type()))
+            self.logger.debug('Created %d instances of type <%s> in %.2f '
+                              'seconds' % (created, self._get_type(),
+                                           time.time() - start))
 
     def _expire_instances(self):
         """INTERNAL: expire instance."""
-        terminate = []
         now = time.time()
         self._lock.acquire()
         try:
-            for key in self._pool:
-                remove = []
-                for inst in self._pool[key][1]:
-                    if now - inst.created > self.maxlife \
-                            or now - inst.last_used > self.maxival \
-                            or inst.count > self.maxcount:
-                        remove.append(inst)
-                for inst in remove:
-                    self._pool[key][1].remove(inst)
-                terminate += remove
+            terminate = self._expired
+            self._expired = []
+            while self._expiry and self._expiry[0][0] <= now:
+                expires, sequence, inst = heapq.heappop(self._expiry)
+                if not inst.pooled or inst.expires != expires:
+                    continue
+                self._pool[inst.key][1].remove(inst)
+                self._unpool(inst)
+                terminate.append(inst)
         finally:
             self._lock.release()
-        for inst in terminate:
-            self._terminate_instance(inst)
+        self._run_parallel(self._terminate_instance, terminate)
         if terminate:
             self.logger.debug('Expired %d instances of type <%s> due to age' \
                               % (len(terminate), self._get_type()))
 
+    def _check_instance(self, instance):
+        """INTERNAL: probe an instance. Return True if it works."""
+        probe = getattr(instance, 'probe', None)
+        try:
+            healthy = probe is None or probe()
+        except Exception, e:
+            self.logger.debug('Probe raised exception: %s' % e)
+            healthy = False
+        instance.last_probe = time.time()
+        self._lock.acquire()
+        try:
+            self._probes += 1
+            if not healthy:
+                self._probe_failures += 1
+        finally:
+            self._lock.release()
+        metrics.increment('pool.probes')
+        if not healthy:
+            metrics.increment('pool.probe_failures')
+            self.logger.info('Instance of type <%s> failed probe'
+                             % self._get_type())
+        return healthy
+
+    def _validate_instance(self, instance):
+        """INTERNAL: validate an instance that is taken from the pool if it
+        has been idle for long. Return True if it can be used."""
+        idle = time.time() - max(instance.last_used, instance.last_probe)
+        if idle <= self.check_idle or self._check_instance(instance):
+            return True
+        self._lock.acquire()
+        try:
+            self._expired.append(instance)
+        finally:
+            self._lock.release()
+        self.maintenance()
+        return False
+
+    def _probe_instances(self):
+        """INTERNAL: probe idle instances that have not been probed for
+        `probe_interval` seconds."""
+        probe = []
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for key in self._pool:
+                idle = self._pool[key][1]
+                for inst in list(idle):
+                    if len(probe) == self.probe_rate:
+                        break
+                    if now - inst.last_probe > self.probe_interval:
+                        idle.remove(inst)
+                        self._unpool(inst)
+                        probe.append(inst)
+        finally:
+            self._lock.release()
+        results = self._run_parallel(self._check_instance, probe)
+        terminate = []
+        for inst,healthy in zip(probe, results):
+            if healthy is True:
+                # Put back as the most recently used: it is known to work.
+                self._add_instance(inst.args, inst)
+            else:
+                terminate.append(inst)
+        self._run_parallel(self._terminate_instance, terminate)
+
+    def _rotate_instances(self):
+        """INTERNAL: replace idle instances that are close to expiry."""
+        rotate = []
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for key in self._pool:
+                for inst in self._pool[key][1]:
+                    if inst.rotating:
+                        continue
+                    if inst.count >= self.rotate * self.maxcount or \
+                            now - inst.created >= self.rotate * self.maxlife:
+                        inst.rotating = True
+                        rotate.append(inst)
+        finally:
+            self._lock.release()
+        if not rotate:
+            return
+        create_instance = lambda inst: self._create_instance(inst.args, False)
+        instances = self._run_parallel(create_instance, rotate)
+        retire = []
+        rotated = 0
+        for old,new in zip(rotate, instances):
+            if isinstance(new, Exception):
+                if not isinstance(new, PoolTimeout):
+                    self.logger.error('Could not create instance of type '
+                                      '<%s>: %s' % (self._get_type(), new))
+                old.rotating = False
+                continue
+            self._add_instance(new.args, new)
+            self._lock.acquire()
+            try:
+                self._rotations += 1
+                rotated += 1
+                if old.pooled:
+                    self._pool[old.key][1].remove(old)
+                    self._unpool(old)
+                    retire.append(old)
+                else:
+                    # In use: retire it when it is put back.
+                    old.retired = True
+            finally:
+                self._lock.release()
+        self._run_parallel(self._terminate_instance, retire)
+        if rotated:
+            self.logger.debug('Rotated %d instances of type <%s>'
+                              % (rotated, self._get_type()))
+
     def _decrease_size(self):
         """INTERNAL: decrease size of the pool."""
         terminate = []
+        now = time.time()
         self._lock.acquire()
         try:
-            for key in self._pool:
-                if len(self._pool[key][1]) > self.minsize:
-                    terminate += self._pool[key][1][self.minsize:]
-                    del self._pool[key][1][self.minsize:]
+            for key in set(self._pool) | set(self._keys):
+                demand = self._keys.get(key)
+                target = self._get_target(demand, now)
+                keep = max(0, target - self._inuse.get(key, 0))
+                idle = key in self._pool and self._pool[key][1]
+                while idle and len(idle) > keep:
+                    inst = idle.popleft()
+                    self._unpool(inst)
+                    terminate.append(inst)
+                if key in self._pool and not idle:
+                    del self._pool[key]
+                if demand and not target and key not in self._inuse:
+                    del self._keys[key]
+                    self.logger.debug('Key %s is idle, shrinking to zero'
+                                      % key)
         finally:
             self._lock.release()
-        for inst in terminate:
-            self._terminate_instance(inst)
+        self._run_parallel(self._terminate_instance, terminate)
         if terminate:
-            self.logger.debug('Removed %d instances of <%s> due to full pool' \
-                              % (len(terminate), self._get_type()))
+            self.logger.debug('Removed %d instances of <%s> due to low '
+                              'demand' % (len(terminate), self._get_type()))
@@ -10,39 +10,591 @@ import os
 import os.path
 import re
 import stat
+import time
 import logging
 from xml.etree import ElementTree as etree
 
 from rest.resource import Resource
-from winpexpect import winspawn, TIMEOUT, WindowsError
-from rhevm.error import Error
+from winpexpect import winspawn, TIMEOUT, EOF, WindowsError
+from rhevm.api import metrics
+from rhevm.error import PowerShellError, ParseError, CommandTimeout
+from rhevm.record import Record, get_schema
+
+try:
+    from win32process import GetProcessMemoryInfo
+except ImportError:
+    # pywin32 is optional: without it, memory usage is not sampled.
+    GetProcessMemoryInfo = None
 
 
 def escape(s):
     return '"%s"' % s.replace('`', '``').replace('"', '`"')
 
 
-class PowerShellError(Error):
-    """A PowerShell command exited with an error."""
+_resource_types = {}
+
+def _resource_type(type):
+    """INTERNAL: return the Resource type for an object type name."""
+    try:
+        return _resource_types[type]
+    except KeyError:
+        pass
+    name = type
+    if name.startswith('RhevmCmd.'):
+        name = name[9:]
+    else:
+        name = name.split('.')[-1]
+    if name.startswith('CLI'):
+        name = name[3:]
+    name = name.lower()
+    _resource_types[type] = name
+    return name
+
+
+def _version(text):
+    """INTERNAL: convert a version string to a Resource."""
+    # Why isn't this done automatically??
+    parts = map(int, text.split('.'))
+    items = zip(('Major', 'Minor', 'Build', 'Revision'), parts)
+    return Resource('version', items)
+
+
+# Converters for the nodes in the output of "ConvertTo-XML". There is one
+# converter per distinct "Type" attribute. It is created the first time
+# the type is seen, and is kept for the life time of the process. Objects
+# are converted to Resources by the converters in _converters, and to
+# Records by those in _record_converters.
+_converters = {}
+_record_converters = {}
+
+def _get_converter(converters, type):
+    """INTERNAL: return the converter for `type` from `converters`."""
+    try:
+        return converters[type]
+    except KeyError:
+        converter = converters[type] = _create_converter(converters, type)
+        return converter
+
+
+def _convert_xml_node(node):
+    """INTERNAL: convert a single XML node to a Resource."""
+    return _get_converter(_converters, node.attrib['Type'])(node)
+
+
+def _convert_xml_record(node):
+    """INTERNAL: convert a single XML node to a Record."""
+    return _get_converter(_record_converters, node.attrib['Type'])(node)
+
+
+def _convert_int(node):
+    return int(node.text)
+
+def _convert_bool(node):
+    return node.text == 'True'
+
+def _convert_text(node):
+    return node.text
+
+def _convert_version(node):
+    return _version(node.text)
+
+def _convert_none(node):
+    return None
+
+
+def _create_object_converter(converters, type):
+    """INTERNAL: create a converter for objects of type `type`."""
+    name = _resource_type(type)
+    convert_text = _convert_text
+    def convert_resource(node):
+        resource = Resource(name)
+        # Slicing is much faster than iterating over a (pure Python)
+        # Element, which calls __getitem__ for every child.
+        for child in node[:]:
+            attrib = child.attrib
+            converter = converters.get(attrib['Type'])
+            if converter is None:
+                converter = _get_converter(converters, attrib['Type'])
+            # Most properties are strings, save a function call for them.
+            if converter is convert_text:
+                resource[attrib['Name']] = child.text
+            else:
+                resource[attrib['Name']] = converter(child)
+        return resource
+    def convert_record(node):
+        names = []
+        values = []
+        for child in node[:]:
+            attrib = child.attrib
+            converter = converters.get(attrib['Type'])
+            if converter is None:
+                converter = _get_converter(converters, attrib['Type'])
+            names.append(attrib['Name'])
+            if converter is convert_text:
+                values.append(child.text)
+            else:
+                values.append(converter(child))
+        return Record(get_schema(name, tuple(names)), tuple(values))
+    if converters is _record_converters:
+        return convert_record
+    return convert_resource
+
+
+def _create_converter(converters, type):
+    """INTERNAL: create a converter for XML nodes of type `type`. Nested
+    nodes are converted with the converters in `converters`."""
+    if type in ('System.Int32', 'System.Int64'):
+        return _convert_int
+    elif type == 'System.Boolean':
+        return _convert_bool
+    elif type == 'System.String':
+        return _convert_text
+    elif type == 'System.Version':
+        return _convert_version
+    elif type == 'System.Management.Automation.PSCustomObject':
+        # Output of Select-Object
+        return _create_object_converter(converters, type)
+    elif type.startswith('System.'):
+        return _convert_text
+    elif type.startswith('RhevmCmd.'):
+        return _create_object_converter(converters, type)
+    elif type.startswith('VdcDAL.'):
+        def convert_first_child(node):
+            child = node[0]
+            return _get_converter(converters, child.attrib['Type'])(child)
+        return convert_first_child
+    elif type.endswith('[]'):
+        def convert_array(node):
+            return [ _get_converter(converters, child.attrib['Type'])(child)
+                     for child in node[:] ]
+        return convert_array
+    elif type:
+        raise ParseError, 'Unknown type: %s' % type
+    return _convert_none
+
+
+class _ObjectBuilder(etree.TreeBuilder):
+    """INTERNAL: tree builder that converts the top-level objects in the
+    output of "ConvertTo-XML" as soon as they are complete."""
+
+    def __init__(self, convert):
+        super(_ObjectBuilder, self).__init__()
+        self.convert = convert
+        self.objects = []
+        self._depth = 0
+        self._item_depth = None
+        # The elements that are open, to find the parent of an element.
+        self._open = []
+
+    def start(self, tag, attrib):
+        self._depth += 1
+        if self._depth == 2:
+            # An array is output as a single object that contains the
+            # elements. Anything else is output as the object itself.
+            type = attrib.get('Type')
+            if type == 'System.Object[]' or type is None:
+                self._item_depth = 3
+            else:
+                self._item_depth = 2
+        elem = super(_ObjectBuilder, self).start(tag, attrib)
+        self._open.append(elem)
+        return elem
+
+    def end(self, tag):
+        elem = super(_ObjectBuilder, self).end(tag)
+        self._open.pop()
+        if self._depth == self._item_depth:
+            self.objects.append(self.convert(elem))
+            # Detach it from its parent so that it can be freed. It is the
+            # only child there, as its siblings were removed before.
+            self._open[-1].remove(elem)
+        self._depth -= 1
+        return elem
+
+
+class ObjectParser(object):
+    """Incremental parser for the output of "ConvertTo-XML".
+
+    Output is fed in chunks as it is read from the shell. Objects are
+    converted one by one as soon as they have been parsed completely, after
+    which their XML representation is discarded.
+    """
+
+    def __init__(self, convert):
+        self._builder = _ObjectBuilder(convert)
+        self._parser = etree.XMLParser(target=self._builder)
+        self._pending = ''
+        self.empty = True
+
+    def feed(self, data):
+        """Feed a chunk of output. Return a list of completed objects."""
+        data = self._pending + data
+        # Do not split a "\r\n" that was inserted by line wrapping.
+        if data.endswith('\r'):
+            self._pending = '\r'
+            data = data[:-1]
+        else:
+            self._pending = ''
+        data = data.replace('\r\n', '')
+        if self.empty:
+            data = data.lstrip()
+            if not data:
+                return []
+            self.empty = False
+        self._parser.feed(data)
+        return self._pop_objects()
 
-    def __init__(self, message=None, id=None):
-        self.message = message
-        self.id = id
+    def close(self):
+        """Finish parsing. Return a list of remaining objects."""
+        if not self.empty:
+            self._parser.close()
+        return self._pop_objects()
 
-    def __str__(self):
-        return self.message or ''
+    def _pop_objects(self):
+        objects = self._builder.objects
+        self._builder.objects = []
+        return objects
 
 
-class ParseError(Error):
-    """Error parsing PowerShell output."""
+class _RecordBuilder(object):
+    """INTERNAL: collects the properties of a Record."""
+
+    __slots__ = ('type', 'names', 'values')
+
+    def __init__(self, type):
+        self.type = type
+        self.names = []
+        self.values = []
+
+    def __setitem__(self, name, value):
+        self.names.append(name)
+        self.values.append(value)
+
+    def build(self):
+        schema = get_schema(self.type, tuple(self.names))
+        return Record(schema, tuple(self.values))
+
+
+class CompactParser(object):
+    """Incremental parser for the compact output format.
+
+    The compact format is written by the ConvertTo-Compact function that is
+    defined in every shell (see PowerShell.functions). It is a stream of
+    tokens that are each terminated by a "|". The first character of a
+    token is its tag, the rest is its payload, in which backslash, "|", CR and
+    LF are escaped with a backslash. The tags are:
+
+     - "i", "b", "s", "v": an integer, boolean, string or version
+     - "t": any other System.* type, in its string form
+     - "n": null
+     - "o": start of an object with the type name in the payload
+     - "k": the name of the next object property
+     - "a": start of an array
+     - "e": end of the current object or array
+     - "u": a value of an unknown type
+
+    The values are converted exactly like PowerShell._convert_xml_node()
+    converts the output of "ConvertTo-XML". If `records` is True, objects
+    are returned as Records instead of Resources.
+    """
+
+    re_escape = re.compile(r'\\(.)')
+    unescape = { '\\': '\\', 'p': '|', 'r': '\r', 'n': '\n' }
+
+    def __init__(self, records=False):
+        self.objects = []
+        self.empty = True
+        self.records = records
+        self._pending = ''
+        self._stack = []
+        self._key = None
+
+    def _unescape(self, match):
+        return self.unescape[match.group(1)]
+
+    def feed(self, data):
+        """Feed a chunk of output. Return a list of completed objects."""
+        # A partial token is kept until the next chunk. This also takes
+        # care of a "\r\n" that is split over two chunks.
+        data = (self._pending + data).replace('\r\n', '')
+        if self.empty:
+            data = data.lstrip()
+            if not data:
+                self._pending = ''
+                return []
+            self.empty = False
+        tokens = data.split('|')
+        self._pending = tokens.pop()
+        stack = self._stack
+        objects = self.objects
+        for token in tokens:
+            tag = token[:1]
+            text = token[1:]
+            if '\\' in text:
+                text = self.re_escape.sub(self._unescape, text)
+            if tag == 'k':
+                self._key = text
+                continue
+            elif tag == 's' or tag == 't':
+                value = text
+            elif tag == 'i':
+                value = int(text)
+            elif tag == 'b':
+                value = text == '1'
+            elif tag == 'o':
+                if self.records:
+                    obj = _RecordBuilder(_resource_type(text))
+                else:
+                    obj = Resource(_resource_type(text))
+                stack.append((obj, self._key))
+                continue
+            elif tag == 'a':
+                stack.append(([], self._key))
+                continue
+            elif tag == 'e':
+                value, self._key = stack.pop()
+                if isinstance(value, _RecordBuilder):
+                    value = value.build()
+            elif tag == 'n':
+                value = None
+            elif tag == 'v':
+                value = _version(text)
+            elif tag == 'u':
+                raise ParseError, 'Unknown type: %s' % text
+            else:
+                raise ParseError, 'Illegal token: %s' % token
+            if not stack:
+                objects.append(value)
+            elif isinstance(stack[-1][0], list):
+                stack[-1][0].append(value)
+            else:
+                stack[-1][0][self._key] = value
+        return self._pop_objects()
+
+    def close(self):
+        """Finish parsing. Return a list of remaining objects."""
+        if self._pending.strip() or self._stack:
+            raise ParseError, 'Truncated output.'
+        return self._pop_objects()
+
+    def _pop_objects(self):
+        objects = self.objects
+        self.objects = []
+        return objects
+
+
+class OutputReader(object):
+    """Read the output of a shell and find the markers in it.
+
+    Output is kept in a byte array and every byte is scanned for a marker
+    only once, so that reading a large output takes linear time. This is
+    unlike pexpect's expect(), which runs a regular expression over the
+    entire buffer again each time new output arrives.
+    """
+
+    def __init__(self, child):
+        self.child = child
+        self.logger = logging.getLogger('rhevm.powershell')
+        self.buffer = bytearray()
+        self.deadline = None
+
+    def _fill(self):
+        """INTERNAL: read new output from the child into the buffer."""
+        timeout = self.child.timeout
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise CommandTimeout, \
+                        'Deadline exceeded in PowerShell command.'
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        try:
+            data = self.child.read_nonblocking(self.child.maxread, timeout)
+        except TIMEOUT:
+            self.logger.debug('PExpect state: %s' % str(self.child))
+            raise CommandTimeout, 'TIMEOUT in PowerShell command.'
+        self.buffer.extend(data)
+
+    def read_until(self, marker):
+        """Read output up to and including the line containing `marker`.
+        Return a tuple (output, args), with `output` the output before the
+        marker and `args` the remainder of the marker line."""
+        start = 0
+        while True:
+            p1 = self.buffer.find(marker, start)
+            if p1 != -1:
+                p2 = self.buffer.find('\n', p1 + len(marker))
+                if p2 != -1:
+                    output = str(self.buffer[:p1])
+                    args = str(self.buffer[p1+len(marker):p2]).strip()
+                    del self.buffer[:p2+1]
+                    return output, args
+                start = p1
+            else:
+                # A partial marker may be at the end of the buffer.
+                start = max(0, len(self.buffer) - len(marker) + 1)
+            self._fill()
+
+    def iter_until(self, marker):
+        """Generate chunks of output up to the line containing `marker`.
+        Only the current chunk is held in memory."""
+        while True:
+            p1 = self.buffer.find(marker)
+            if p1 != -1:
+                p2 = self.buffer.find('\n', p1 + len(marker))
+                if p2 != -1:
+                    if p1 > 0:
+                        yield str(self.buffer[:p1])
+                    del self.buffer[:p2+1]
+                    return
+            elif len(self.buffer) >= len(marker):
+                # Keep enough output to recognize a partial marker.
+                size = len(self.buffer) - len(marker) + 1
+                yield str(self.buffer[:size])
+                del self.buffer[:size]
+            self._fill()
 
 
 class PowerShell(object):
     """Execute Windows PowerShell commands.""" 
 
-    def __init__(self):
+    # The output format: "xml" uses ConvertTo-XML, "compact" uses the
+    # ConvertTo-Compact function below which is much less verbose and is
+    # faster to parse.
+    format = 'xml'
+
+    # If True, commands are wrapped by the Invoke-Wrapped function that is
+    # defined when the shell is started, so that only a short invocation
+    # needs to be sent per command. If False, the full wrapper script is
+    # sent with every command.
+    preload = True
+
+    # Functions that are defined in every shell when it is started.
+    functions = r"""
+        function Invoke-Wrapped($nonce, $command, [switch] $compact) {
+            Write-Host "START-OF-OUTPUT-MARKER $nonce";
+            try {
+                $result = Invoke-Expression $command;
+                if ($compact) { $output = ConvertTo-Compact $result }
+                else { $output = ConvertTo-XML $result -As String -Depth 5 };
+                $success = 1;
+            } catch {
+                if ($compact) {
+                    $output = ConvertTo-Compact @($_.Exception.ToString(),
+                                                  $_.FullyQualifiedErrorId);
+                } else {
+                    # There's a circular reference in $_...
+                    $output = ConvertTo-XML $_ -As String -Depth 1;
+                };
+                $success = 0;
+            };
+            Write-Host "OUTPUT-STATUS-MARKER $nonce $success";
+            $output;
+            Write-Host "END-OF-OUTPUT-MARKER $nonce";
+        }
+        function ConvertTo-CompactText($text) {
+            $text = $text.Replace('\', '\\').Replace('|', '\p');
+            $text.Replace("`r", '\r').Replace("`n", '\n');
+        }
+        function ConvertTo-CompactValue($value, $sb, $depth) {
+            if ($null -eq $value) {
+                [void] $sb.Append('n|');
+                return;
+            }
+            $type = $value.GetType().FullName;
+            $custom = 'System.Management.Automation.PSCustomObject';
+            if ($type -eq 'System.Int32' -or $type -eq 'System.Int64') {
+                [void] $sb.Append('i').Append($value).Append('|');
+            } elseif ($type -eq 'System.Boolean') {
+                if ($value) { [void] $sb.Append('b1|') }
+                else { [void] $sb.Append('b0|') };
+            } elseif ($type -eq 'System.String') {
+                [void] $sb.Append('s').Append((ConvertTo-CompactText $value));
+                [void] $sb.Append('|');
+            } elseif ($type -eq 'System.Version') {
+                [void] $sb.Append('v').Append($value.ToString()).Append('|');
+            } elseif ($depth -le 0 -or
+                    ($type.StartsWith('System.') -and $type -ne $custom)) {
+                $text = ConvertTo-CompactText $value.ToString();
+                [void] $sb.Append('t').Append($text).Append('|');
+            } elseif ($type.EndsWith('[]')) {
+                [void] $sb.Append('a|');
+                foreach ($item in $value) {
+                    ConvertTo-CompactValue $item $sb ($depth - 1);
+                };
+                [void] $sb.Append('e|');
+            } elseif ($type.StartsWith('RhevmCmd.') -or $type -eq $custom) {
+                [void] $sb.Append('o').Append($type).Append('|');
+                foreach ($property in $value.PSObject.Properties) {
+                    [void] $sb.Append('k').Append($property.Name).Append('|');
+                    try { $item = $property.Value } catch { $item = $null };
+                    ConvertTo-CompactValue $item $sb ($depth - 1);
+                };
+                [void] $sb.Append('e|');
+            } elseif ($type.StartsWith('VdcDAL.')) {
+                $property = @($value.PSObject.Properties)[0];
+                ConvertTo-CompactValue $property.Value $sb ($depth - 1);
+            } else {
+                [void] $sb.Append('u').Append($type).Append('|');
+            }
+        }
+        function ConvertTo-Compact($result) {
+            $sb = New-Object System.Text.StringBuilder;
+            if ($null -ne $result) {
+                foreach ($value in $result) {
+                    ConvertTo-CompactValue $value $sb 5;
+                }
+            };
+            $sb.ToString();
+        }
+        function Select-Properties($names) {
+            begin { $selected = @{} }
+            process {
+                if ($_ -eq $null) { return };
+                $type = $_.GetType().FullName;
+                if (-not $selected.ContainsKey($type)) {
+                    $properties = $_.PSObject.Properties;
+                    $selected[$type] = @($names | ? { $properties[$_] });
+                };
+                if ($selected[$type].Count -gt 0) {
+                    $_ | Select-Object -Property $selected[$type];
+                } else {
+                    $_;
+                }
+            }
+        }
+    """
+
+    # Timeout for resynchronizing with the shell after a command failed to
+    # complete normally.
+    resync_timeout = 10
+
+    # Whether a running command can be interrupted with a break. A break is
+    # sent through the stdin pipe of the shell, which does not stop a
+    # running cmdlet on Windows. If a command that exceeded its deadline
+    # cannot be interrupted, the shell is marked as broken at once, instead
+    # of after waiting `resync_timeout` seconds for the command to finish.
+    interruptible = False
+
+    # A cheap command that probe() uses to check that the shell and its
+    # session work, and the timeout for it.
+    probe_command = 'Get-Version'
+    probe_timeout = 10
+
+    def __init__(self, format=None, preload=None):
         self.logger = logging.getLogger('rhevm.powershell')
         self.child = None
+        self.reader = None
+        self.sequence = 0
+        self.broken = False
+        # Default timeout for a command, and the time after which no command
+        # may run anymore (usually the end of the HTTP request budget).
+        self.timeout = None
+        self.deadline = None
+        if format is not None:
+            self.format = format
+        if preload is not None:
+            self.preload = preload
 
     def start(self, **args):
         # On Windows 2008 R2, which is always 64-bit,  the PowerShell bindings
@@ -59,92 +611,97 @@ class PowerShell(object):
                 newpath += os.environ['Path']
                 os.environ['Path'] = newpath
         self.child = winspawn('powershell.exe -Command -', **args)
+        self.reader = OutputReader(self.child)
+        self.broken = False
+        self.child.sendline(self._compact(self.functions))
 
-    def terminate(self):
-        """Close the powershell process."""
+    def terminate(self, timeout=2):
+        """Close the powershell process. If it does not exit within
+        `timeout` seconds, it is killed."""
         if not self.child:
             return
         self.child.sendline('Exit')
         try:
-            self.child.wait(timeout=2)
+            self.child.wait(timeout=timeout)
         except TIMEOUT:
             self.child.terminate()
         self.child = None
+        self.reader = None
+
+    def is_alive(self):
+        """Return whether the PowerShell process is running and usable."""
+        return self.child is not None and not self.broken \
+                and self.child.isalive()
+
+    def probe(self):
+        """Check that the shell works by running `probe_command`. Return
+        True if it does."""
+        if not self.is_alive():
+            return False
+        try:
+            self.execute(self.probe_command, timeout=self.probe_timeout)
+        except (PowerShellError, ParseError, EOF, WindowsError), e:
+            self.logger.debug('Probe failed: %s' % e)
+            return False
+        return not self.broken
+
+    def memory_usage(self):
+        """Return the resident memory of the PowerShell process in KB, or
+        None if it is not known."""
+        if GetProcessMemoryInfo is None:
+            return
+        if not self.child or not self.child.child_handle:
+            return
+        try:
+            info = GetProcessMemoryInfo(self.child.child_handle)
+        except WindowsError:
+            return
+        return info['WorkingSetSize'] // 1024
 
     def _convert_xml_node(self, node):
         """INTERNAL: convert a single XML node to a Resource."""
-        type = node.attrib['Type']
-        if type in ('System.Int32', 'System.Int64'):
-            return int(node.text)
-        elif type == 'System.Boolean':
-            return node.text == 'True'
-        elif type == 'System.String':
-            return node.text
-        elif type == 'System.Version':
-            # Why isn't this done automatically??
-            parts = map(int, node.text.split('.'))
-            items = zip(('Major', 'Minor', 'Build', 'Revision'), parts)
-            resource = Resource('version', items)
-            return resource
-        elif type.startswith('System.'):
-            return node.text
-        elif type.startswith('RhevmCmd.'):
-            type = type[9:]
-            if type.startswith('CLI'):
-                type = type[3:]
-            resource = Resource(type.lower())
-            for child in node:
-                resource[child.attrib['Name']] = self._convert_xml_node(child)
-            return resource
-        elif type.startswith('VdcDAL.'):
-            return self._convert_xml_node(node[0])
-        elif type.endswith('[]'):
-            result = []
-            for child in node:
-                result.append(self._convert_xml_node(child))
-            return result
-        elif type:
-            raise ParseError, 'Unknown type: %s' % type
-
-    def _parse_objects(self, output):
-        """INTERNAL: Parse output of "ConvertTo-XML"."""
-        xml = etree.fromstring(output)
-        assert xml.tag == 'Objects'
-        type = xml[0].attrib.get('Type')
-        if type == 'System.Object[]' or type is None:
-            xml = xml[0]
-        result = []
-        for child in xml:
-            result.append(self._convert_xml_node(child))
-        return result
+        return _convert_xml_node(node)
+
+    def _create_error(self, message, id):
+        """INTERNAL: create a PowerShellError from an exception message and
+        a fully qualified error ID."""
+        error = PowerShellError()
+        if message is not None:
+            p1 = message.find(': ')
+            if p1 == -1:
+                p1 = 0
+            else:
+                p1 += 2
+            p2 = message.find(' at System.')
+            if p2 == -1:
+                p2 = len(message)
+            error.message = message[p1:p2].strip()
+        if id is not None:
+            p1 = id.find(',')
+            if p1 == -1:
+                p1 = len(id)
+            error.id = 'rhevm.powershell.backend.%s' % id[:p1].lower()
+        return error
 
     def _parse_error(self, output):
-        """INTERNAL: Parse an XML formatted exception."""
+        """INTERNAL: Parse a formatted exception."""
+        if self.format == 'compact':
+            parser = CompactParser()
+            message, id = parser.feed(output) + parser.close()
+            return self._create_error(message, id)
         xml = etree.fromstring(output)
-        error = PowerShellError()
+        message = id = None
         for node in xml[0]:
             name = node.attrib['Name']
             if name == 'Exception':
                 message = node.text
-                p1 = message.find(': ')
-                if p1 == -1:
-                    p1 = 0
-                else:
-                    p1 += 2
-                p2 = message.find(' at System.')
-                if p2 == -1:
-                    p2 = len(message)
-                error.message = message[p1:p2].strip()
             elif name == 'FullyQualifiedErrorId':
                 id = node.text
-                p1 = id.find(',')
-                if p1 == -1:
-                    p1 = len(id)
-                error.id = 'rhevm.powershell.backend.%s' % id[:p1].lower()
-        return error
+        return self._create_error(message, id)
 
     re_comment = re.compile('#.*$', re.M)
     re_whitespace = re.compile('\s+')
+    re_newline = re.compile('\r\n|\r|\n')
 
     def _compact(self, command):
         """INTERNAL: compact a powershell command (for logging)."""
@@ -152,50 +709,254 @@ class PowerShell(object):
         command = self.re_whitespace.sub(' ', command)
         return command
         
-    def execute(self, command, *args):
-        """Execute a command. Return a string, a list of objects, or
-        raises an exception."""
-        if self.child is None:
-            self.start()
-        if args:
-            command %= tuple(map(escape, args))
+    def _next_nonce(self):
+        """INTERNAL: return a nonce that identifies the output of the next
+        command."""
+        self.sequence += 1
+        return str(self.sequence)
+
+    def _quote_command(self, command):
+        """INTERNAL: quote a command as a string expression on a single
+        line. Newlines in the command are kept, but are not sent to the
+        shell, where they would start a continuation prompt."""
+        lines = self.re_newline.split(command)
+        quoted = [ "'%s'" % line.replace("'", "''") for line in lines ]
+        if len(quoted) == 1:
+            return quoted[0]
+        return '(%s)' % ' + "`n" + '.join(quoted)
+
+    def _wrap_command(self, command, nonce):
+        """INTERNAL: wrap a command so that its output can be parsed. The
+        output markers are tagged with `nonce`."""
+        command = self._quote_command(command)
+        if self.preload:
+            # Dot-source the wrapper so that variables assigned by the
+            # command end up in the global scope.
+            script = ". Invoke-Wrapped %s %s" % (nonce, command)
+            if self.format == 'compact':
+                script += ' -Compact'
+            return script
+        if self.format == 'compact':
+            convert = 'ConvertTo-Compact $result'
+            convert_error = 'ConvertTo-Compact @($_.Exception.ToString(),' \
+                            ' $_.FullyQualifiedErrorId)'
+        else:
+            convert = 'ConvertTo-XML $result -As String -Depth 5'
+            # There's a circular reference in $_...
+            convert_error = 'ConvertTo-XML $_ -As String -Depth 1'
+        # The status is written before the output, so that the output can
+        # be parsed while it is being read.
         script = """
-            Write-Host "START-OF-OUTPUT-MARKER";
+            Write-Host "START-OF-OUTPUT-MARKER %s";
             try {
-                $result = Invoke-Expression '%s';
-                ConvertTo-XML $result -As String -Depth 5;
+                $result = Invoke-Expression %s;
+                $output = %s;
                 $success = 1;
             } catch {
-                # There's a circular reference in $_...
-                ConvertTo-XML $_ -As String -Depth 1;
+                $output = %s;
                 $success = 0;
             }
-            Write-Host "END-OF-OUTPUT-MARKER $success";
-        """ % command
+            Write-Host "OUTPUT-STATUS-MARKER %s $success";
+            $output;
+            Write-Host "END-OF-OUTPUT-MARKER %s";
+        """
+        # Compact before the command is inserted, to leave it intact.
         script = self._compact(script)
+        script %= (nonce, command, convert, convert_error, nonce, nonce)
+        return script
+
+    def _create_parser(self, records=False):
+        """INTERNAL: return an incremental parser for the output format. If
+        `records` is True, the parser returns objects as Records."""
+        if self.format == 'compact':
+            return CompactParser(records)
+        if records:
+            return ObjectParser(_convert_xml_record)
+        return ObjectParser(self._convert_xml_node)
+
+    def _read_status(self, nonce):
+        """INTERNAL: read output up to the status marker of the wrapped
+        command identified by `nonce`. Output of earlier commands is
+        skipped. Return a tuple (status, textout)."""
+        while True:
+            output, args = self.reader.read_until('START-OF-OUTPUT-MARKER')
+            if args == nonce:
+                break
+            self.logger.debug('Skipping stale output of command %s' % args)
+        textout, args = self.reader.read_until('OUTPUT-STATUS-MARKER')
+        args = args.split()
+        if len(args) != 2 or args[0] != nonce:
+            raise ParseError, 'Illegal status marker: %s' % ' '.join(args)
+        return args[1] == '1', textout
+
+    def _read_output(self, nonce):
+        """INTERNAL: read the output of one wrapped command. Return a string
+        or a list of objects, or raise an exception."""
+        try:
+            return self._read_wrapped_output(nonce)
+        except PowerShellError:
+            raise
+        except Exception, e:
+            # The state of the shell is unknown (e.g. a TIMEOUT).
+            self._recover(e)
+            raise
+
+    def _read_wrapped_output(self, nonce):
+        """INTERNAL: read the output of one wrapped command."""
+        status, textout = self._read_status(nonce)
+        chunks = self.reader.iter_until('END-OF-OUTPUT-MARKER')
+        if not status:
+            output = ''.join(chunks).replace('\r\n', '').strip()
+            error = self._parse_error(output)
+            raise error
+        parser = self._create_parser()
+        objects = []
+        for chunk in chunks:
+            objects += parser.feed(chunk)
+        objects += parser.close()
+        if parser.empty:
+            return textout
+        return objects
+
+    def _iter_objects(self, chunks, records=False):
+        """INTERNAL: parse chunks of output incrementally."""
+        parser = self._create_parser(records)
+        try:
+            for chunk in chunks:
+                for obj in parser.feed(chunk):
+                    yield obj
+            for obj in parser.close():
+                yield obj
+        except GeneratorExit:
+            # Closed early: skip the remaining output.
+            self._resync()
+            raise
+        except Exception, e:
+            self._recover(e)
+            raise
+
+    def _set_deadline(self, timeout=None):
+        """INTERNAL: set the deadline for the next command. This is the
+        earliest of the shell's deadline and the command timeout."""
+        deadline = self.deadline
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is not None:
+            expires = time.time() + timeout
+            if deadline is None or expires < deadline:
+                deadline = expires
+        self.reader.deadline = deadline
+
+    def _recover(self, exception):
+        """INTERNAL: recover the shell after a command did not complete
+        normally because of `exception`."""
+        if isinstance(exception, CommandTimeout):
+            metrics.increment('powershell.timeouts')
+            deadline = self.reader.deadline
+            if not self.interruptible and deadline is not None \
+                    and deadline <= time.time():
+                self.logger.info('PowerShell command exceeded its deadline, '
+                                 'discarding shell.')
+                metrics.increment('powershell.broken')
+                self.broken = True
+                return
+            if self.interruptible:
+                self.logger.info('PowerShell command timed out, '
+                                 'interrupting.')
+                self._interrupt()
+        self._resync()
+
+    def _interrupt(self):
+        """INTERNAL: try to interrupt the running command with a break."""
+        try:
+            self.child.sendcontrol('c')
+            self.child.sendline('')
+        except Exception, e:
+            self.logger.debug('Could not interrupt PowerShell: %s' % e)
+
+    def _resync(self):
+        """INTERNAL: resynchronize with the shell after a command did not
+        complete normally, skipping any output that is still pending. If
+        the shell does not respond, it is marked as broken."""
+        nonce = self._next_nonce()
+        self.reader.deadline = time.time() + self.resync_timeout
+        try:
+            self.child.sendline('Write-Host "SYNC-MARKER %s"' % nonce)
+            while True:
+                output, args = self.reader.read_until('SYNC-MARKER')
+                if args == nonce:
+                    break
+        except Exception, e:
+            self.logger.error('Could not resynchronize PowerShell: %s' % e)
+            metrics.increment('powershell.broken')
+            self.broken = True
+        else:
+            self.logger.debug('Resynchronized PowerShell.')
+            metrics.increment('powershell.resyncs')
+
+    def execute(self, command, *args, **kwargs):
+        """Execute a command. Return a string, a list of objects, or
+        raises an exception. The keyword argument `timeout` overrides the
+        default timeout of the command."""
+        if self.child is None:
+            self.start()
+        if args:
+            command %= tuple(map(escape, args))
+        nonce = self._next_nonce()
+        script = self._wrap_command(command, nonce)
         self.logger.debug('Executing powershell: %s' % script)
+        self._set_deadline(kwargs.get('timeout'))
+        self.child.sendline(script)
+        return self._read_output(nonce)
+
+    def execute_many(self, commands, timeout=None):
+        """Execute a list of commands in a single round trip. Return a list
+        with the result of each command, or a PowerShellError instance for
+        the commands that failed. A failed command does not stop the
+        commands after it. The timeout applies to all commands together."""
+        if self.child is None:
+            self.start()
+        nonces = [ self._next_nonce() for command in commands ]
+        scripts = map(self._wrap_command, commands, nonces)
+        for script in scripts:
+            self.logger.debug('Executing powershell: %s' % script)
+        self._set_deadline(timeout)
+        self.child.send(os.linesep.join(scripts) + os.linesep)
+        results = []
+        for nonce in nonces:
+            try:
+                result = self._read_output(nonce)
+            except PowerShellError, e:
+                result = e
+            results.append(result)
+        return results
+
+    def iterexecute(self, command, *args, **kwargs):
+        """Execute a command and return an iterator over the objects in its
+        output. The output is parsed incrementally as it is read from the
+        shell. The iterator must be exhausted or closed before the next
+        command is executed. The keyword argument `timeout` overrides the
+        default timeout of the command. If the keyword argument `records` is
+        True, objects are returned as (compact, read-only) Records instead
+        of Resources."""
+        if self.child is None:
+            self.start()
+        if args:
+            command %= tuple(map(escape, args))
+        nonce = self._next_nonce()
+        script = self._wrap_command(command, nonce)
+        self.logger.debug('Executing powershell: %s' % script)
+        self._set_deadline(kwargs.get('timeout'))
         self.child.sendline(script)
         try:
-            # Write-Host does not seem to be generating a \r ...
-            self.child.expect('START-OF-OUTPUT-MARKER\r?\n')
-            self.child.expect('END-OF-OUTPUT-MARKER (1|0)\r?\n')
-        except TIMEOUT:
-            self.logger.debug('PExpect state: %s' % str(self.child))
-            raise ParseError, 'TIMEOUT in PowerShell command.'
-        status = self.child.match.group(1) == '1'
-        output = self.child.before
-        p1 = output.find('<?xml')
-        if p1 == -1:
-            p1 = len(output)
-        textout = output[:p1]
-        xmlout = output[p1:]
-        xmlout = xmlout.replace('\r\n', '')  # line wrapping (sigh...)
-        if status:
-            if xmlout:
-                objects = self._parse_objects(xmlout)
-                return objects
-            else:
-                return textout
-        else:
-            error = self._parse_error(xmlout)
+            status, textout = self._read_status(nonce)
+            chunks = self.reader.iter_until('END-OF-OUTPUT-MARKER')
+            if not status:
+                output = ''.join(chunks).replace('\r\n', '').strip()
+                error = self._parse_error(output)
+        except Exception, e:
+            self._recover(e)
+            raise
+        if not status:
             raise error
+        return self._iter_objects(chunks, kwargs.get('records', False))
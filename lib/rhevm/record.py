@@ -0,0 +1,134 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+from rest.resource import Resource
+
+
+class Schema(object):
+    """The type and property names of a group of records. Schemas are
+    shared by all records with the same type and property names."""
+
+    __slots__ = ('type', 'names', 'index')
+
+    def __init__(self, type, names):
+        self.type = type
+        self.names = names
+        self.index = dict(((name, ix) for ix,name in enumerate(names)))
+
+
+_schemas = {}
+
+def get_schema(type, names):
+    """Return the schema for `type` and the tuple of property names
+    `names`."""
+    key = (type, names)
+    try:
+        return _schemas[key]
+    except KeyError:
+        schema = _schemas[key] = Schema(type, names)
+        return schema
+
+
+def to_resource(value):
+    """Convert records in `value` to Resources."""
+    if isinstance(value, Record):
+        return value.to_resource()
+    elif isinstance(value, list):
+        return map(to_resource, value)
+    return value
+
+
+class Record(object):
+    """A compact, read-only object.
+
+    The property values are stored in a tuple, and the property names in a
+    schema that is shared with other records. A record can be used as a
+    read-only mapping, with the type in the '!type' key like a Resource.
+    Use to_resource() to convert it to a Resource.
+    """
+
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, values):
+        self.schema = schema
+        self.values = values
+
+    @property
+    def type(self):
+        return self.schema.type
+
+    def retype(self, type):
+        """Return a record with the same values but type `type`."""
+        return Record(get_schema(type, self.schema.names), self.values)
+
+    def to_resource(self):
+        """Convert to a Resource. Nested records are converted as well."""
+        values = map(to_resource, self.values)
+        return Resource(self.schema.type, zip(self.schema.names, values))
+
+    def __getitem__(self, name):
+        if name == '!type':
+            return self.schema.type
+        return self.values[self.schema.index[name]]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return name == '!type' or name in self.schema.index
+
+    def keys(self):
+        return ['!type'] + list(self.schema.names)
+
+    def items(self):
+        return [('!type', self.schema.type)] + \
+                zip(self.schema.names, self.values)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.values) + 1
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_resource()
+        return self.to_resource() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Record(%r)' % self.to_resource()
+
+
+class RecordList(list):
+    """A list of records that are converted to Resources when they are
+    accessed. Converted elements replace the records, so the conversion is
+    done once and the records can be freed one by one."""
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ self[ix] for ix in range(*index.indices(len(self))) ]
+        value = list.__getitem__(self, index)
+        if isinstance(value, Record):
+            value = value.to_resource()
+            list.__setitem__(self, index, value)
+        return value
+
+    def __getslice__(self, i, j):
+        return self[max(0, i):max(0, j):]
+
+    def __iter__(self):
+        for ix in range(len(self)):
+            yield self[ix]
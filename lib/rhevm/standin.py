@@ -0,0 +1,134 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+import time
+import logging
+
+from rest.resource import Resource
+from rhevm.error import PowerShellError, CommandTimeout
+from rhevm.record import Record, get_schema
+
+
+class StandInShell(object):
+    """A stand-in for PowerShell that needs neither Windows nor RHEV-M.
+
+    It implements the interface of PowerShell that the pool and the broker
+    use, and runs a few commands from an in-memory table. This is enough to
+    run the pool and the broker on any platform, for testing.
+    """
+
+    version = (2, 2, 0, 1)
+
+    # The number of VMs returned by Select-Vm.
+    vms = 3
+
+    def __init__(self):
+        self.logger = logging.getLogger('rhevm.standin')
+        self.started = False
+        self.broken = False
+        self.timeout = None
+        self.deadline = None
+        self.commands = { 'Get-Version': self._get_version,
+                          'Login-User': self._login_user,
+                          'Select-Vm': self._select_vm,
+                          'Start-Sleep': self._start_sleep }
+
+    def start(self, **args):
+        self.started = True
+        self.broken = False
+
+    def terminate(self, timeout=None):
+        self.started = False
+
+    def is_alive(self):
+        return self.started and not self.broken
+
+    def probe(self):
+        return self.is_alive()
+
+    def memory_usage(self):
+        return None
+
+    def _get_version(self, args, records):
+        names = ('Major', 'Minor', 'Build', 'Revision')
+        return [ Resource('version', zip(names, self.version)) ]
+
+    def _login_user(self, args, records):
+        # Like RHEV-M, any password but an empty one.
+        if '-password ""' in args:
+            raise PowerShellError('Login failed.', 'LoginFailed')
+        return []
+
+    def _select_vm(self, args, records):
+        schema = get_schema('vm', ('Name', 'VmId', 'MemorySize'))
+        result = []
+        for i in range(self.vms):
+            values = ('vm%d' % i, '00000000-0000-0000-0000-%012d' % i, 512)
+            if records:
+                result.append(Record(schema, values))
+            else:
+                result.append(Resource('vm', zip(schema.names, values)))
+        return result
+
+    def _start_sleep(self, args, records):
+        seconds = float(args.split()[-1])
+        deadline = self.deadline
+        if self.timeout is not None:
+            deadline = min(deadline or time.time() + self.timeout,
+                           time.time() + self.timeout)
+        if deadline is not None and time.time() + seconds > deadline:
+            time.sleep(max(0, deadline - time.time()))
+            raise CommandTimeout('Deadline exceeded in PowerShell command.')
+        time.sleep(seconds)
+        return []
+
+    def _run(self, command, args, timeout=None, records=False):
+        """INTERNAL: run one command."""
+        if not self.started:
+            self.start()
+        if args:
+            command %= tuple(('"%s"' % arg for arg in args))
+        self.logger.debug('Executing stand-in: %s' % command)
+        name, rest = (command.split(None, 1) + [''])[:2]
+        if name not in self.commands:
+            raise PowerShellError('The term \'%s\' is not recognized as a '
+                                  'cmdlet.' % name, 'CommandNotFoundException')
+        saved = self.timeout
+        if timeout is not None:
+            self.timeout = timeout
+        try:
+            return self.commands[name](rest, records)
+        finally:
+            self.timeout = saved
+
+    def execute(self, command, *args, **kwargs):
+        return self._run(command, args, kwargs.get('timeout'))
+
+    def execute_many(self, commands, timeout=None):
+        results = []
+        for command in commands:
+            try:
+                result = self._run(command, (), timeout)
+            except PowerShellError, e:
+                result = e
+            results.append(result)
+        return results
+
+    def iterexecute(self, command, *args, **kwargs):
+        return iter(self._run(command, args, kwargs.get('timeout'),
+                              kwargs.get('records', False)))
+
+
+def create_standin(username=None, password=None, domain=None):
+    """Create a stand-in shell, like create_powershell() does for a real
+    one."""
+    shell = StandInShell()
+    shell.start()
+    shell.execute('Login-User -username "%s" -password "%s" -domain "%s"'
+                  % (username, password or '', domain))
+    return shell
@@ -0,0 +1,112 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+import time
+import socket
+import threading
+
+from nose.tools import assert_raises
+
+from rest.resource import Resource
+from rhevm.error import PowerShellError, CommandTimeout
+from rhevm.pool import Pool, PoolTimeout
+from rhevm.record import Record
+from rhevm.standin import StandInShell, create_standin
+from rhevm.broker import Broker, BrokerClient, send_message, recv_message
+from rhevm.test.test_pool import wait_for
+
+
+class TestBroker(object):
+
+    def setup(self):
+        self.pool = Pool(StandInShell, create_standin)
+        self.broker = Broker(self.pool, ('127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.broker.serve_forever)
+        self.thread.start()
+        self.client = BrokerClient(self.broker.server_address)
+        self.args = { 'username': 'user', 'password': 'pass',
+                      'domain': 'domain' }
+
+    def teardown(self):
+        self.broker.shutdown()
+        self.thread.join()
+        self.broker.server_close()
+        self.pool.clear()
+
+    def test_execute(self):
+        shell = self.client.get(self.args)
+        assert shell.version == (2, 2, 0, 1)
+        result = shell.execute('Get-Version')
+        assert isinstance(result[0], Resource)
+        assert result[0] == { '!type': 'version', 'Major': 2, 'Minor': 2,
+                              'Build': 0, 'Revision': 1 }
+        self.client.put(shell)
+
+    def test_records(self):
+        shell = self.client.get(self.args)
+        result = list(shell.iterexecute('Select-Vm', records=True))
+        assert len(result) == 3
+        assert isinstance(result[0], Record)
+        assert result[0].schema is result[1].schema
+        assert result[2]['Name'] == 'vm2'
+        result = list(shell.iterexecute('Select-Vm'))
+        assert isinstance(result[0], Resource)
+        self.client.put(shell)
+
+    def test_errors(self):
+        shell = self.client.get(self.args)
+        try:
+            shell.execute('Foo-Bar')
+        except PowerShellError, e:
+            assert e.id == 'CommandNotFoundException'
+        else:
+            raise AssertionError('PowerShellError not raised')
+        result = shell.execute_many(['Get-Version', 'Foo-Bar'])
+        assert result[0][0]['Major'] == 2
+        assert isinstance(result[1], PowerShellError)
+        self.client.put(shell)
+        args = dict(self.args, password='')
+        assert_raises(PowerShellError, self.client.get, args)
+        assert self.pool.stats()['inuse'] == 0
+
+    def test_deadline(self):
+        shell = self.client.get(self.args)
+        shell.deadline = time.time() + 0.1
+        assert_raises(CommandTimeout, shell.execute, 'Start-Sleep 1')
+        shell.deadline = None
+        assert_raises(CommandTimeout, shell.execute, 'Start-Sleep 1',
+                      timeout=0.1)
+        shell.execute('Start-Sleep 0')
+        self.client.put(shell)
+
+    def test_shared(self):
+        other = BrokerClient(self.broker.server_address)
+        shell = self.client.get(self.args)
+        self.client.put(shell)
+        shell = other.get(self.args)
+        other.put(shell)
+        stats = self.client.stats()
+        assert stats['spawns'] == 1
+        assert stats['keys'].values()[0]['hit_rate'] == 0.5
+
+    def test_disconnect(self):
+        sock = socket.create_connection(self.broker.server_address)
+        send_message(sock, { 'op': 'lease', 'args': self.args })
+        assert recv_message(sock)['version'] == [2, 2, 0, 1]
+        assert self.pool.stats()['inuse'] == 1
+        sock.close()
+        wait_for(lambda: self.pool.stats()['inuse'] == 0)
+        assert self.pool.size() == 1
+
+    def test_unavailable(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        address = sock.getsockname()
+        sock.close()
+        client = BrokerClient(address)
+        assert_raises(PoolTimeout, client.get, self.args)
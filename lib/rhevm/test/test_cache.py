@@ -0,0 +1,101 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+import time
+
+import rhevm.api
+from rhevm.cache import Cache, create_cache, invalidate
+from rhevm.util import cached
+
+
+class FakeShell(object):
+
+    def __init__(self, username):
+        self.args = { 'username': username, 'domain': 'domain' }
+
+
+class TestCache(object):
+
+    def test_get_put(self):
+        cache = Cache('test')
+        assert cache.get('foo') is None
+        cache.put('foo', 1)
+        assert cache.get('foo') == 1
+        cache.put('foo', 2)
+        assert cache.get('foo') == 2
+        assert cache.size() == 1
+        stats = cache.stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 1
+
+    def test_lru(self):
+        cache = Cache('test', maxsize=2)
+        cache.put('foo', 1)
+        cache.put('bar', 2)
+        cache.get('foo')
+        cache.put('baz', 3)
+        assert cache.get('bar') is None
+        assert cache.get('foo') == 1
+        assert cache.get('baz') == 3
+        assert cache.size() == 2
+        assert cache.stats()['evictions'] == 1
+
+    def test_ttl(self):
+        cache = Cache('test', ttl=0.05)
+        cache.put('foo', 1)
+        assert cache.get('foo') == 1
+        time.sleep(0.1)
+        assert cache.get('foo', 'missing') == 'missing'
+        assert cache.size() == 0
+        assert cache.stats()['expirations'] == 1
+
+    def test_invalidate(self):
+        cache = create_cache('test_invalidate', 'thing')
+        other = create_cache('test_invalidate_other', 'other')
+        cache.put('foo', 1)
+        cache.put('bar', 2)
+        other.put('foo', 1)
+        cache.invalidate('foo')
+        assert cache.get('foo') is None
+        assert cache.get('bar') == 2
+        invalidate('thing')
+        assert cache.size() == 0
+        assert other.size() == 1
+        cache.put('foo', 3)
+        assert cache.get('foo') == 3
+
+
+class TestCached(object):
+
+    def setup(self):
+        self.calls = []
+        def lookup(name):
+            self.calls.append(name)
+            return name.upper()
+        self.lookup = cached('test')(lookup)
+
+    def teardown(self):
+        rhevm.api.powershell._release()
+
+    def test_cached(self):
+        rhevm.api.powershell._register(FakeShell('user'))
+        assert self.lookup('foo') == 'FOO'
+        assert self.lookup('foo') == 'FOO'
+        assert self.calls == ['foo']
+        invalidate('test')
+        assert self.lookup('foo') == 'FOO'
+        assert self.calls == ['foo', 'foo']
+
+    def test_scoped(self):
+        rhevm.api.powershell._register(FakeShell('user'))
+        self.lookup('foo')
+        rhevm.api.powershell._register(FakeShell('other'))
+        self.lookup('foo')
+        self.lookup('foo')
+        assert self.calls == ['foo', 'foo']
+        assert self.lookup.cache.size() == 2
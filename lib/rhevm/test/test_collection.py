@@ -0,0 +1,83 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+from nose.tools import assert_raises
+
+import rest.api
+from rest import http
+from rest.error import HTTPReturn
+
+import rhevm.api
+from rhevm.module.vm import VmCollection
+from rhevm.record import Record, get_schema
+
+
+class FakeRequest(object):
+
+    def __init__(self, action):
+        self.match = { 'action': action }
+
+
+class FakeShell(object):
+    """A shell that returns one projected VM."""
+
+    version = (2, 2, 0, 1)
+
+    def __init__(self):
+        self.commands = []
+
+    def iterexecute(self, command, records=False):
+        self.commands.append(command)
+        schema = get_schema('pscustomobject', ('Name', 'MemorySize'))
+        return iter([ Record(schema, ('vm1', 512)) ])
+
+
+class TestProjection(object):
+
+    def setup(self):
+        self.shell = FakeShell()
+        rhevm.api.powershell._register(self.shell)
+        rest.api.request._register(FakeRequest('list'))
+        self.collection = VmCollection()
+
+    def teardown(self):
+        rhevm.api.powershell._release()
+        rest.api.request._release()
+
+    def test_all_properties(self):
+        properties = self.collection._get_properties()
+        assert 'Name' in properties
+        assert 'VmId' in properties
+        assert 'HostClusterId' in properties
+        assert '!type' not in properties
+        assert properties == sorted(properties)
+
+    def test_fields(self):
+        properties = self.collection._get_properties(set(['name', 'memory']))
+        assert 'Name' in properties
+        assert 'MemorySize' in properties
+        assert 'VmId' not in properties
+
+    def test_unknown_field(self):
+        try:
+            self.collection._get_properties(set(['name', 'foo']))
+        except HTTPReturn, e:
+            assert e.status == http.BAD_REQUEST
+        else:
+            raise AssertionError('No HTTPReturn raised.')
+
+    def test_select(self):
+        result = self.collection._select('Select-Vm', 'name, memory')
+        assert len(self.shell.commands) == 1
+        command = self.shell.commands[0]
+        assert command.startswith('Select-Vm | Select-Properties @(')
+        assert '"Name"' in command and '"MemorySize"' in command
+        assert '"VmId"' not in command
+        assert len(result) == 1
+        assert result[0]['!type'] == 'vm'
+        assert result[0]['Name'] == 'vm1'
@@ -0,0 +1,29 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+from rhevm.metrics import Metrics
+
+
+class TestMetrics(object):
+
+    def test_increment(self):
+        metrics = Metrics()
+        metrics.increment('foo')
+        metrics.increment('foo', 2)
+        assert metrics.get('foo') == 3
+        assert metrics.get('bar') == 0
+        metrics.clear()
+        assert metrics.snapshot() == {}
+
+    def test_observe(self):
+        metrics = Metrics()
+        for value in (0.5, 1, 3, 100):
+            metrics.observe('spawn', value, (1, 2, 4))
+        assert metrics.snapshot() == { 'spawn.le_1': 2, 'spawn.le_4': 1,
+                                       'spawn.le_inf': 1, 'spawn.count': 4,
+                                       'spawn.sum': 104.5 }
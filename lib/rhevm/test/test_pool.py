@@ -0,0 +1,542 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+import time
+import threading
+
+from nose.tools import assert_raises
+
+from rhevm.pool import Pool, PoolTimeout
+
+
+class FakeShell(object):
+
+    fail = False
+    delay = 0
+    exit_delay = 0
+
+    def __init__(self, **args):
+        if self.fail:
+            raise ValueError('Could not start.')
+        time.sleep(self.delay)
+        self.broken = False
+        self.terminated = False
+        self.rss = 100
+        self.healthy = True
+        self.probes = 0
+
+    def memory_usage(self):
+        return self.rss
+
+    def probe(self):
+        self.probes += 1
+        return self.healthy
+
+    def terminate(self, timeout=None):
+        # Like a process that hangs on exit.
+        time.sleep(self.exit_delay)
+        self.terminated = True
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end
+        time.sleep(0.01)
+
+
+class TestPool(object):
+
+    def setup(self):
+        self.pool = Pool(FakeShell, FakeShell)
+        self.args = { 'username': 'user', 'password': 'pass' }
+
+    def teardown(self):
+        self.pool.stop()
+        self.pool.clear()
+
+    def test_get_put(self):
+        shell = self.pool.get(self.args)
+        assert isinstance(shell, FakeShell)
+        assert self.pool.stats()['inuse'] == 1
+        self.pool.put(shell)
+        assert self.pool.stats()['inuse'] == 0
+        assert self.pool.get(self.args) is shell
+
+    def test_broken(self):
+        shell = self.pool.get(self.args)
+        shell.broken = True
+        self.pool.put(shell)
+        wait_for(lambda: shell.terminated)
+        assert self.pool.size() == 0
+        assert self.pool.stats()['inuse'] == 0
+
+    def test_broken_not_waited_for(self):
+        self.pool.start()
+        shell = self.pool.get(self.args)
+        shell.broken = True
+        FakeShell.exit_delay = 0.5
+        try:
+            start = time.time()
+            self.pool.put(shell)
+            assert time.time() - start < 0.2
+            assert self.pool.stats()['inuse'] == 0
+            wait_for(lambda: shell.terminated)
+        finally:
+            FakeShell.exit_delay = 0
+
+    def test_create_error(self):
+        FakeShell.fail = True
+        try:
+            assert_raises(ValueError, self.pool.get, self.args)
+        finally:
+            FakeShell.fail = False
+        assert self.pool.stats()['inuse'] == 0
+
+    def test_wait(self):
+        self.pool.maxperkey = 1
+        shell = self.pool.get(self.args)
+        result = []
+        def get():
+            result.append(self.pool.get(self.args))
+        thread = threading.Thread(target=get)
+        thread.start()
+        wait_for(lambda: self.pool.stats()['waiting'] == 1)
+        # Another key is not affected by the per-key limit.
+        other = self.pool.get({ 'username': 'other' })
+        self.pool.put(other)
+        self.pool.put(shell)
+        thread.join()
+        assert result == [shell]
+
+    def test_timeout(self):
+        self.pool.maxtotal = 1
+        shell = self.pool.get(self.args)
+        assert_raises(PoolTimeout, self.pool.get, { 'username': 'other' },
+                      timeout=0.1)
+        assert self.pool.stats()['waiting'] == 0
+        self.pool.put(shell)
+
+    def test_fifo(self):
+        self.pool.maxtotal = 1
+        shell = self.pool.get(self.args)
+        order = []
+        def get(i):
+            shell = self.pool.get({ 'username': 'user%d' % i })
+            order.append(i)
+            self.pool.put(shell)
+        threads = []
+        for i in range(5):
+            thread = threading.Thread(target=get, args=(i,))
+            thread.start()
+            threads.append(thread)
+            wait_for(lambda: self.pool.stats()['waiting'] == i + 1)
+        self.pool.put(shell)
+        for thread in threads:
+            thread.join()
+        assert order == range(5)
+        assert self.pool.stats()['max_waiting'] == 5
+
+    def test_parallel_refill(self):
+        for i in range(4):
+            self.pool.put(self.pool.get({ 'username': 'user%d' % i }))
+        self.pool.minsize = 2
+        self.pool.maxworkers = 4
+        FakeShell.delay = 0.2
+        try:
+            start = time.time()
+            self.pool._increase_size()
+            elapsed = time.time() - start
+        finally:
+            FakeShell.delay = 0
+        assert self.pool.size() == 8
+        # 4 instances are created, in parallel
+        assert elapsed < 0.6
+        stats = self.pool.stats()
+        assert stats['spawns'] == 8
+        assert stats['spawn_time_max'] >= 0.2
+
+    def test_refill_error(self):
+        self.pool.put(self.pool.get(self.args))
+        FakeShell.fail = True
+        try:
+            self.pool._increase_size()
+        finally:
+            FakeShell.fail = False
+        assert self.pool.size() == 1
+
+    def test_adaptive_target(self):
+        shells = [ self.pool.get(self.args) for i in range(4) ]
+        for shell in shells:
+            self.pool.put(shell)
+        stats = self.pool.stats()['keys'].values()[0]
+        assert stats['requests'] == 4
+        assert stats['hit_rate'] == 0.0
+        # Up to four concurrent users that all missed.
+        assert 2 < stats['target'] <= 4 * 2
+        for i in range(50):
+            self.pool.put(self.pool.get(self.args))
+        stats = self.pool.stats()['keys'].values()[0]
+        assert stats['hit_rate'] > 0.9
+        assert stats['target'] == 1
+        self.pool._decrease_size()
+        assert self.pool.size() == 1
+
+    def test_increase_to_target(self):
+        shells = [ self.pool.get(self.args) for i in range(3) ]
+        self.pool.put(shells[0])
+        self.pool._increase_size()
+        target = self.pool.stats()['keys'].values()[0]['target']
+        assert target > 3
+        # 2 instances are in use, the others are idle
+        assert self.pool.size() == target - 2
+        for shell in shells[1:]:
+            self.pool.put(shell)
+
+    def test_shrink_idle_key(self):
+        self.pool.put(self.pool.get(self.args))
+        self.pool._increase_size()
+        assert self.pool.size() == 2
+        demand = self.pool._keys.values()[0]
+        demand.last_request -= self.pool.maxival + 1
+        self.pool._decrease_size()
+        assert self.pool.size() == 0
+        assert self.pool.stats()['keys'] == {}
+
+    def test_accounting(self):
+        shell = self.pool.get(self.args)
+        other = self.pool.get({ 'username': 'other' })
+        shell.rss = 150
+        self.pool.put(shell)
+        stats = self.pool.stats()
+        assert stats['instances'] == 2
+        assert stats['memory'] == 250
+        assert stats['keys'][self.pool._get_key(self.args)]['memory'] == 150
+        other.broken = True
+        self.pool.put(other)
+        wait_for(lambda: other.terminated)
+        stats = self.pool.stats()
+        assert stats['instances'] == 1
+        assert stats['memory'] == 150
+
+    def test_evict_lru(self):
+        self.pool.maxinstances = 2
+        shells = [ self.pool.get({ 'username': 'user%d' % i })
+                   for i in range(2) ]
+        for shell in shells:
+            self.pool.put(shell)
+        shell = self.pool.get({ 'username': 'user2' })
+        wait_for(lambda: shells[0].terminated)
+        assert not shells[1].terminated
+        assert self.pool.stats()['instances'] == 2
+        assert self.pool.stats()['evictions'] == 1
+        # Maintenance does not evict
+        self.pool._increase_size()
+        assert not shells[1].terminated
+        assert self.pool.stats()['instances'] == 2
+        self.pool.put(shell)
+
+    def test_reclaim_expired(self):
+        self.pool.maxinstances = 2
+        self.pool.maxcount = 1
+        shells = [ self.pool.get({ 'username': 'user%d' % i })
+                   for i in range(2) ]
+        # Expired, but not terminated yet by maintenance.
+        for shell in shells:
+            self.pool.put(shell)
+        assert self.pool.size() == 0
+        assert self.pool.stats()['instances'] == 2
+        shell = self.pool.get({ 'username': 'user2' })
+        wait_for(lambda: shells[0].terminated and shells[1].terminated)
+        stats = self.pool.stats()
+        assert stats['instances'] == 1
+        assert stats['evictions'] == 0
+        self.pool._expire_instances()
+        assert self.pool.stats()['instances'] == 1
+        self.pool.put(shell)
+
+    def test_memory_budget(self):
+        self.pool.maxmemory = 250
+        shells = [ self.pool.get({ 'username': 'user%d' % i })
+                   for i in range(2) ]
+        # No idle instance to evict
+        assert_raises(PoolTimeout, self.pool.get, { 'username': 'user2' })
+        assert self.pool.stats()['inuse'] == 2
+        self.pool.put(shells[0])
+        shell = self.pool.get({ 'username': 'user2' })
+        wait_for(lambda: shells[0].terminated)
+        assert self.pool.stats()['memory'] == 200
+        self.pool.put(shell)
+        self.pool.put(shells[1])
+
+    def test_most_recently_used(self):
+        shells = [ self.pool.get(self.args) for i in range(3) ]
+        for shell in shells:
+            self.pool.put(shell)
+        assert shells[2].last_used >= shells[0].last_used
+        assert self.pool.size() == 3
+        assert self.pool.get(self.args) is shells[2]
+        assert self.pool.size() == 2
+        self.pool.put(shells[2])
+
+    def test_expire(self):
+        shells = [ self.pool.get(self.args) for i in range(2) ]
+        self.pool.put(shells[0])
+        self.pool.maxival = 0.1
+        self.pool.put(shells[1])
+        time.sleep(0.15)
+        self.pool._expire_instances()
+        assert shells[1].terminated
+        assert not shells[0].terminated
+        assert self.pool.size() == 1
+        assert self.pool.stats()['instances'] == 1
+
+    def test_expired_on_get(self):
+        shell = self.pool.get(self.args)
+        self.pool.maxival = 0
+        self.pool.put(shell)
+        other = self.pool.get(self.args)
+        assert other is not shell
+        assert self.pool.size() == 0
+        self.pool._expire_instances()
+        assert shell.terminated
+        self.pool.put(other)
+
+    def test_maxcount(self):
+        self.pool.maxcount = 2
+        shell = self.pool.get(self.args)
+        self.pool.put(shell)
+        assert self.pool.get(self.args) is shell
+        self.pool.put(shell)
+        assert self.pool.size() == 0
+        self.pool._expire_instances()
+        assert shell.terminated
+
+    def test_expiry_heap_bounded(self):
+        self.pool.maxcount = 2000
+        shell = self.pool.get(self.args)
+        for i in range(1000):
+            self.pool.put(shell)
+            assert self.pool.get(self.args) is shell
+        assert len(self.pool._expiry) < 200
+        self.pool.put(shell)
+
+    def test_rotate(self):
+        self.pool.maxcount = 10
+        shell = self.pool.get(self.args)
+        for i in range(6):
+            self.pool.put(shell)
+            assert self.pool.get(self.args) is shell
+        self.pool.put(shell)
+        self.pool._rotate_instances()
+        assert self.pool.stats()['rotations'] == 0
+        assert self.pool.get(self.args) is shell
+        self.pool.put(shell)
+        self.pool._rotate_instances()
+        assert shell.terminated
+        assert self.pool.size() == 1
+        assert self.pool.stats()['rotations'] == 1
+        assert self.pool.get(self.args) is not shell
+
+    def test_rotate_in_use(self):
+        self.pool.maxlife = 1
+        shell = self.pool.get(self.args)
+        self.pool.put(shell)
+        shell.created -= 0.9
+        FakeShell.delay = 0.2
+        try:
+            thread = threading.Thread(target=self.pool._rotate_instances)
+            thread.start()
+            time.sleep(0.05)
+            # Taken while the replacement is being created
+            assert self.pool.get(self.args) is shell
+            thread.join()
+        finally:
+            FakeShell.delay = 0
+        assert not shell.terminated
+        assert self.pool.size() == 1
+        self.pool.put(shell)
+        wait_for(lambda: shell.terminated)
+        assert self.pool.size() == 1
+
+    def test_request_spawns(self):
+        from rhevm.api import metrics
+        metrics.clear()
+        self.pool.put(self.pool.get(self.args))
+        self.pool.put(self.pool.get(self.args))
+        assert self.pool.stats()['request_spawns'] == 1
+        assert metrics.get('pool.request_spawn_time.count') == 1
+        assert metrics.get('pool.request_spawn_time.le_0.5') == 1
+
+    def test_probe(self):
+        self.pool.probe_interval = 0
+        shells = [ self.pool.get(self.args) for i in range(2) ]
+        for shell in shells:
+            self.pool.put(shell)
+        shells[0].healthy = False
+        self.pool._probe_instances()
+        assert shells[0].terminated
+        assert not shells[1].terminated
+        assert shells[1].probes == 1
+        assert self.pool.size() == 1
+        stats = self.pool.stats()
+        assert stats['probes'] == 2
+        assert stats['probe_failures'] == 1
+        assert stats['instances'] == 1
+
+    def test_probe_rate(self):
+        self.pool.probe_interval = 0
+        self.pool.probe_rate = 2
+        shells = [ self.pool.get(self.args) for i in range(3) ]
+        for shell in shells:
+            self.pool.put(shell)
+        self.pool._probe_instances()
+        assert sum([ shell.probes for shell in shells ]) == 2
+        self.pool.probe_interval = 60
+        self.pool._probe_instances()
+        assert sum([ shell.probes for shell in shells ]) == 2
+
+    def test_check_on_checkout(self):
+        shells = [ self.pool.get(self.args) for i in range(2) ]
+        for shell in shells:
+            self.pool.put(shell)
+        assert self.pool.get(self.args) is shells[1]
+        assert shells[1].probes == 0
+        self.pool.put(shells[1])
+        self.pool.check_idle = 0
+        time.sleep(0.01)
+        shells[1].healthy = False
+        assert self.pool.get(self.args) is shells[0]
+        assert shells[1].probes == 1
+        assert self.pool.stats()['keys'].values()[0]['requests'] == 4
+        self.pool._expire_instances()
+        assert shells[1].terminated
+        self.pool.put(shells[0])
+
+    def test_scheduler_wakeup(self):
+        self.pool.fast_delay = 60
+        self.pool.min_delay = 0
+        self.pool.start()
+        self.pool.put(self.pool.get(self.args))
+        # The miss woke up the scheduler, which refills the pool.
+        wait_for(lambda: self.pool.stats()['maintenance_runs'] >= 1)
+        wait_for(lambda: self.pool.size() == 2)
+
+    def test_scheduler_interval(self):
+        self.pool.fast_delay = 0.05
+        self.pool.min_delay = 0
+        self.pool.start()
+        wait_for(lambda: self.pool.stats()['maintenance_runs'] >= 3)
+
+    def test_scheduler_stop(self):
+        self.pool.start()
+        scheduler = self.pool._scheduler
+        self.pool.start()
+        assert self.pool._scheduler is scheduler
+        self.pool.stop()
+        assert not scheduler.isAlive()
+        self.pool.stop()
+        self.pool.start()
+        assert self.pool._scheduler.isAlive()
+
+    def test_drain(self):
+        shell = self.pool.get(self.args)
+        self.pool.put(self.pool.get(self.args))
+        def put():
+            time.sleep(0.1)
+            self.pool.put(shell)
+        thread = threading.Thread(target=put)
+        thread.start()
+        assert self.pool.drain() == 0
+        thread.join()
+        assert shell.terminated
+        assert self.pool.size() == 0
+        assert self.pool.stats()['instances'] == 0
+        assert self.pool.stats()['draining']
+        assert_raises(PoolTimeout, self.pool.get, self.args)
+
+    def test_drain_waiters(self):
+        self.pool.maxtotal = 1
+        shell = self.pool.get(self.args)
+        errors = []
+        def get():
+            try:
+                self.pool.get(self.args, timeout=10)
+            except PoolTimeout:
+                errors.append(True)
+        thread = threading.Thread(target=get)
+        thread.start()
+        wait_for(lambda: self.pool.stats()['waiting'] == 1)
+        start = time.time()
+        assert self.pool.drain(timeout=0.1) == 1
+        thread.join()
+        assert errors
+        assert time.time() - start < 1
+        # Returned too late: terminated.
+        self.pool.put(shell)
+        wait_for(lambda: shell.terminated)
+        assert self.pool.stats()['inuse'] == 0
+
+    def test_drain_maintenance(self):
+        created = []
+        def constructor(**args):
+            shell = FakeShell(**args)
+            created.append(shell)
+            return shell
+        self.pool = Pool(FakeShell, constructor)
+        self.pool.minsize = 3
+        self.pool.fast_delay = 60
+        self.pool.min_delay = 0
+        self.pool.put(self.pool.get(self.args))
+        FakeShell.delay = 0.3
+        try:
+            self.pool.start()
+            self.pool.maintenance()
+            # Drain while the pool is being refilled.
+            time.sleep(0.1)
+            self.pool.drain()
+        finally:
+            FakeShell.delay = 0
+        assert len(created) == 3
+        assert self.pool.size() == 0
+        assert self.pool.stats()['instances'] == 0
+        for shell in created:
+            assert shell.terminated
+
+    def test_drain_stop_budget(self):
+        self.pool.fast_delay = 60
+        self.pool.min_delay = 0
+        self.pool.put(self.pool.get(self.args))
+        self.pool.minsize = 2
+        FakeShell.delay = 1
+        try:
+            self.pool.start()
+            self.pool.maintenance()
+            time.sleep(0.1)
+            start = time.time()
+            self.pool.drain(budget=0.2)
+            assert time.time() - start < 0.6
+            # Created after the pool was drained.
+            wait_for(lambda: self.pool.stats()['spawns'] == 2)
+            wait_for(lambda: self.pool.stats()['instances'] == 0)
+            assert self.pool.size() == 0
+        finally:
+            FakeShell.delay = 0
+
+    def test_drain_budget(self):
+        shells = [ self.pool.get(self.args) for i in range(3) ]
+        for shell in shells:
+            self.pool.put(shell)
+        FakeShell.exit_delay = 2
+        try:
+            start = time.time()
+            self.pool.drain(budget=0.2)
+            assert time.time() - start < 1
+            assert self.pool.size() == 0
+        finally:
+            FakeShell.exit_delay = 0
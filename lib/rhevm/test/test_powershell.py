@@ -6,13 +6,287 @@
 # RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
 # "AUTHORS" for a complete overview.
 
+import os
+import time
+
 from nose import SkipTest
 from nose.tools import assert_raises
 
 from rhevm import *
+from rhevm.api import metrics
+from rhevm.powershell import PowerShell, PowerShellError, ParseError, TIMEOUT
+from rhevm.powershell import CommandTimeout, ObjectParser, _convert_xml_node
+from rhevm.powershell import OutputReader, CompactParser
 from rhevm.test.base import RhevmTest, local_only, require_rhev
 
 
+class FakeChild(object):
+
+    maxread = 7
+    timeout = 1
+
+    def __init__(self, output):
+        self.output = output
+
+    def read_nonblocking(self, size, timeout):
+        self.last_timeout = timeout
+        if not self.output:
+            raise TIMEOUT('Timeout exceeded.')
+        data = self.output[:size]
+        self.output = self.output[size:]
+        return data
+
+
+class FakeShell(FakeChild):
+    """A child that answers resynchronization requests."""
+
+    def __init__(self, output, responsive=True):
+        super(FakeShell, self).__init__(output)
+        self.responsive = responsive
+        self.interrupted = False
+
+    def sendcontrol(self, char):
+        self.interrupted = True
+
+    def sendline(self, line):
+        if self.responsive and line.startswith('Write-Host "SYNC-MARKER'):
+            self.output += '%s\n' % line[12:-1]
+
+
+class TestOutputReader(object):
+
+    def test_read_until(self):
+        reader = OutputReader(FakeChild('garbage\nSTART-MARKER\ntext\r\n'
+                                        'STATUS-MARKER 1\nrest'))
+        output, args = reader.read_until('START-MARKER')
+        assert output == 'garbage\n'
+        assert args == ''
+        output, args = reader.read_until('STATUS-MARKER')
+        assert output == 'text\r\n'
+        assert args == '1'
+
+    def test_deadline_without_timeout(self):
+        child = FakeChild('START-MARKER\n')
+        child.timeout = None
+        reader = OutputReader(child)
+        reader.deadline = time.time() + 5
+        reader.read_until('START-MARKER')
+        assert 0 < child.last_timeout <= 5
+
+    def test_iter_until(self):
+        output = 'x' * 1000 + 'END-MARKER\nSTART-MARKER\n'
+        reader = OutputReader(FakeChild(output))
+        chunks = list(reader.iter_until('END-MARKER'))
+        assert len(chunks) > 1
+        assert ''.join(chunks) == 'x' * 1000
+        output, args = reader.read_until('START-MARKER')
+        assert output == ''
+
+
+class TestResync(object):
+
+    def _create_shell(self, output, responsive=True):
+        shell = PowerShell(format='compact')
+        shell.child = FakeShell(output, responsive)
+        shell.reader = OutputReader(shell.child)
+        return shell
+
+    def test_stale_output(self):
+        output = 'START-OF-OUTPUT-MARKER 1\nOUTPUT-STATUS-MARKER 1 1\n' \
+                 'i1|\r\nEND-OF-OUTPUT-MARKER 1\n' \
+                 'START-OF-OUTPUT-MARKER 2\nOUTPUT-STATUS-MARKER 2 1\n' \
+                 'i2|\r\nEND-OF-OUTPUT-MARKER 2\n'
+        shell = self._create_shell(output)
+        shell.sequence = 1
+        assert shell.execute('foo') == [2]
+
+    def test_resync(self):
+        output = 'START-OF-OUTPUT-MARKER 1\nOUTPUT-STATUS-MARKER 1 1\ni1|'
+        shell = self._create_shell(output)
+        assert_raises(ParseError, shell.execute, 'foo')
+        assert not shell.broken
+        shell.child.output += 'i2|\r\nEND-OF-OUTPUT-MARKER 1\n' \
+                              'START-OF-OUTPUT-MARKER 3\n' \
+                              'OUTPUT-STATUS-MARKER 3 1\ni3|\r\n' \
+                              'END-OF-OUTPUT-MARKER 3\n'
+        assert shell.execute('bar') == [3]
+
+    def test_iterexecute_closed(self):
+        output = 'START-OF-OUTPUT-MARKER 1\nOUTPUT-STATUS-MARKER 1 1\n' \
+                 'i1|i2|\r\nEND-OF-OUTPUT-MARKER 1\n'
+        shell = self._create_shell(output)
+        result = shell.iterexecute('foo')
+        assert result.next() == 1
+        result.close()
+        assert not shell.broken
+        assert shell.reader.buffer == ''
+
+    def test_deadline(self):
+        output = 'START-OF-OUTPUT-MARKER 1\n'
+        shell = self._create_shell(output)
+        shell.interruptible = True
+        shell.deadline = time.time() - 1
+        timeouts = metrics.get('powershell.timeouts')
+        assert_raises(CommandTimeout, shell.execute, 'foo')
+        assert shell.child.interrupted
+        assert metrics.get('powershell.timeouts') == timeouts + 1
+        assert not shell.broken
+
+    def test_deadline_not_interruptible(self):
+        output = 'START-OF-OUTPUT-MARKER 1\n'
+        shell = self._create_shell(output)
+        shell.deadline = time.time() - 1
+        start = time.time()
+        assert_raises(CommandTimeout, shell.execute, 'foo')
+        assert time.time() - start < 1
+        assert not shell.child.interrupted
+        assert shell.broken
+
+    def test_command_timeout(self):
+        shell = self._create_shell('')
+        shell.deadline = time.time() + 100
+        shell._set_deadline(10)
+        assert shell.reader.deadline < time.time() + 11
+        shell.timeout = 1000
+        shell._set_deadline()
+        assert shell.reader.deadline == shell.deadline
+
+    def test_broken(self):
+        output = 'START-OF-OUTPUT-MARKER 1\n'
+        shell = self._create_shell(output, responsive=False)
+        assert_raises(ParseError, shell.execute, 'foo')
+        assert shell.broken
+
+
+class TestMemoryUsage(object):
+
+    def test_without_pywin32(self):
+        import rhevm.powershell
+        shell = PowerShell()
+        shell.child = FakeChild('')
+        shell.child.child_handle = os.getpid()
+        saved = rhevm.powershell.GetProcessMemoryInfo
+        rhevm.powershell.GetProcessMemoryInfo = None
+        try:
+            assert shell.memory_usage() is None
+        finally:
+            rhevm.powershell.GetProcessMemoryInfo = saved
+
+
+class TestWrapper(object):
+
+    def test_multiline(self):
+        command = "$vm.Description = 'it''s\r\nmulti-line'\nUpdate-Vm"
+        quoted = "('$vm.Description = ''it''''s' + \"`n\" + " \
+                 "'multi-line''' + \"`n\" + 'Update-Vm')"
+        for preload in (True, False):
+            shell = PowerShell(preload=preload)
+            script = shell._wrap_command(command, '1')
+            assert '\n' not in script and '\r' not in script
+            assert quoted in script
+
+    def test_comment(self):
+        shell = PowerShell(preload=False)
+        script = shell._wrap_command('$vm.Description = "#1"', '1')
+        assert '\'$vm.Description = "#1"\';' in script
+        assert 'END-OF-OUTPUT-MARKER 1' in script
+
+
+class TestObjectParser(object):
+
+    def test_convert(self):
+        output = '<?xml version="1.0"?><Objects>' \
+            '<Object Type="System.Object[]">' \
+            '<Property Type="RhevmCmd.CLIVm">' \
+            '<Property Name="Name" Type="System.String">vm1</Property>' \
+            '<Property Name="Memory" Type="System.Int64">512</Property>' \
+            '<Property Name="HA" Type="System.Boolean">True</Property>' \
+            '<Property Name="Date" Type="System.DateTime">today</Property>' \
+            '<Property Name="Os" Type="VdcDAL.VmOsType">' \
+            '<Property Type="System.String">Unassigned</Property>' \
+            '</Property>' \
+            '<Property Name="Ids" Type="System.Guid[]">' \
+            '<Property Type="System.Int32">1</Property>' \
+            '</Property>' \
+            '<Property Name="Nets" Type="Network[]">' \
+            '<Property Type="System.Int32">1</Property>' \
+            '</Property>' \
+            '<Property Name="Ver" Type="System.Version">2.2.0.1</Property>' \
+            '</Property></Object></Objects>'
+        parser = ObjectParser(_convert_xml_node)
+        result = parser.feed(output) + parser.close()
+        assert len(result) == 1
+        vm = result[0]
+        assert vm['!type'] == 'vm'
+        assert vm['Name'] == 'vm1'
+        assert vm['Memory'] == 512
+        assert vm['HA'] is True
+        assert vm['Date'] == 'today'
+        assert vm['Os'] == 'Unassigned'
+        assert vm['Ids'] is None
+        assert vm['Nets'] == [1]
+        assert vm['Ver'] == { '!type': 'version', 'Major': 2, 'Minor': 2,
+                              'Build': 0, 'Revision': 1 }
+
+    def test_discard(self):
+        parser = ObjectParser(_convert_xml_node)
+        parser.feed('<?xml version="1.0"?><Objects>'
+                    '<Object Type="System.Object[]">')
+        for i in range(10):
+            result = parser.feed('<Property Type="RhevmCmd.CLIVm">'
+                                 '<Property Name="Name" Type="System.String">'
+                                 'vm%d</Property></Property>' % i)
+            assert result[0]['Name'] == 'vm%d' % i
+            # The converted objects are not kept in the tree.
+            assert len(parser._builder._open[-1]) == 0
+        assert parser.feed('</Object></Objects>') + parser.close() == []
+
+    def test_unknown_type(self):
+        output = '<?xml version="1.0"?><Objects>' \
+                 '<Object Type="Foo.Bar">baz</Object></Objects>'
+        parser = ObjectParser(_convert_xml_node)
+        assert_raises(ParseError, parser.feed, output)
+
+
+class TestCompactParser(object):
+
+    def test_values(self):
+        parser = CompactParser()
+        output = 'i10|b1|b0|sfoo\\p\\\\bar|v2.2.0.1|tSystem.Foo|n|a|i1|i2|e|'
+        result = parser.feed(output) + parser.close()
+        assert result[:3] == [10, True, False]
+        assert result[3] == 'foo|\\bar'
+        assert result[4]['!type'] == 'version'
+        assert result[4]['Minor'] == 2
+        assert result[5] == 'System.Foo'
+        assert result[6] is None
+        assert result[7] == [1, 2]
+
+    def test_objects(self):
+        parser = CompactParser()
+        output = 'oRhevmCmd.CLIVm|kName|svm1|kList|a|oRhevmCmd.Tag|kId|i1|e|' \
+                 'e|kStatus|sUp|e|oRhevmCmd.CLIVm|kName|svm2|e|'
+        result = []
+        # Feed in small chunks, and insert line wrapping.
+        for i in range(0, len(output), 5):
+            result += parser.feed(output[i:i+5] + '\r\n')
+        result += parser.close()
+        assert len(result) == 2
+        assert result[0]['!type'] == 'vm'
+        assert result[0]['Name'] == 'vm1'
+        assert result[0]['List'][0]['!type'] == 'tag'
+        assert result[0]['List'][0]['Id'] == 1
+        assert result[0]['Status'] == 'Up'
+        assert result[1]['Name'] == 'vm2'
+
+    def test_errors(self):
+        parser = CompactParser()
+        assert_raises(ParseError, parser.feed, 'uFoo.Bar|')
+        parser = CompactParser()
+        parser.feed('oRhevmCmd.CLIVm|kName|svm1|')
+        assert_raises(ParseError, parser.close)
+
+
 class TestPowerShell(RhevmTest):
 
     @local_only
@@ -76,3 +350,78 @@ class TestPowerShell(RhevmTest):
             assert len(e.id) > 0
         else:
             raise AssertionError, 'Test did not raise exception.'
+
+    @local_only
+    def test_execute_many(self):
+        result = self.powershell.execute_many(['Get-Version',
+                                               'Add-DataCenter -foo bar',
+                                               'Select-Event | '
+                                               'Select-Object -First 2'])
+        assert len(result) == 3
+        assert len(result[0]) == 1
+        assert 'Major' in result[0][0]
+        assert isinstance(result[1], PowerShellError)
+        assert len(result[1].message) > 0
+        assert len(result[2]) == 2
+
+    @local_only
+    def test_iterexecute(self):
+        result = self.powershell.iterexecute('Select-Event | '
+                                             'Select-Object -First 10')
+        count = 0
+        for event in result:
+            assert 'Id' in event
+            count += 1
+        assert count == 10
+        # Closing early should leave the shell in a usable state.
+        result = self.powershell.iterexecute('Select-Event | '
+                                             'Select-Object -First 10')
+        result.next()
+        result.close()
+        result = self.powershell.execute('Get-Version')
+        assert len(result) == 1
+        assert 'Major' in result[0]
+
+    @local_only
+    def test_iterexecute_error(self):
+        assert_raises(PowerShellError, self.powershell.iterexecute,
+                      'Add-DataCenter -foo bar')
+
+    @local_only
+    def test_compact_format(self):
+        compact = PowerShell(format='compact')
+        compact.execute('Login-User -UserName %s -Domain %s -Password %s'
+                        % (self.config['username'], self.config['domain'],
+                           self.config['password']))
+        try:
+            command = 'Select-Event | Select-Object -First 10'
+            result = compact.execute(command)
+            assert result == self.powershell.execute(command)
+            command = 'Select-DataCenter'
+            result = compact.execute(command)
+            assert result == self.powershell.execute(command)
+            assert_raises(PowerShellError, compact.execute,
+                          'Add-DataCenter -foo bar')
+        finally:
+            compact.terminate()
+
+    @local_only
+    def test_variable_scope(self):
+        self.powershell.execute('$value = "it\'s global"')
+        result = self.powershell.execute('$value')
+        assert result == ["it's global"]
+
+    @local_only
+    def test_inline_wrapper(self):
+        inline = PowerShell(preload=False)
+        inline.execute('Login-User -UserName %s -Domain %s -Password %s'
+                       % (self.config['username'], self.config['domain'],
+                          self.config['password']))
+        try:
+            command = 'Select-Event | Select-Object -First 10'
+            result = inline.execute(command)
+            assert result == self.powershell.execute(command)
+            assert_raises(PowerShellError, inline.execute,
+                          'Add-DataCenter -foo bar')
+        finally:
+            inline.terminate()
@@ -0,0 +1,92 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+from nose.tools import assert_raises
+
+from rest.resource import Resource
+from rhevm.record import Record, RecordList, get_schema
+from rhevm.powershell import ObjectParser, CompactParser, _convert_xml_record
+
+
+class TestRecord(object):
+
+    def test_mapping(self):
+        schema = get_schema('vm', ('Name', 'MemorySize'))
+        record = Record(schema, ('vm1', 512))
+        assert record['!type'] == 'vm'
+        assert record['Name'] == 'vm1'
+        assert record['MemorySize'] == 512
+        assert_raises(KeyError, record.__getitem__, 'foo')
+        assert record.get('foo') is None
+        assert 'Name' in record
+        assert 'foo' not in record
+        assert len(record) == 3
+        assert sorted(record.keys()) == ['!type', 'MemorySize', 'Name']
+
+    def test_schema_is_shared(self):
+        schema1 = get_schema('vm', ('Name', 'MemorySize'))
+        schema2 = get_schema('vm', ('Name', 'MemorySize'))
+        assert schema1 is schema2
+        record = Record(schema1, ('vm1', 512)).retype('foo')
+        assert record['!type'] == 'foo'
+        assert record.schema.names == schema1.names
+
+    def test_to_resource(self):
+        inner = Record(get_schema('version', ('Major',)), (2,))
+        record = Record(get_schema('vm', ('Name', 'Versions')),
+                        ('vm1', [inner]))
+        resource = record.to_resource()
+        assert isinstance(resource, Resource)
+        assert isinstance(resource['Versions'][0], Resource)
+        assert resource == { '!type': 'vm', 'Name': 'vm1',
+                             'Versions': [ { '!type': 'version',
+                                             'Major': 2 } ] }
+        assert record == resource
+
+    def test_record_list(self):
+        schema = get_schema('vm', ('Name',))
+        result = RecordList([ Record(schema, ('vm%d' % i,))
+                              for i in range(3) ])
+        assert isinstance(list.__getitem__(result, 1), Record)
+        assert isinstance(result[1], Resource)
+        assert isinstance(list.__getitem__(result, 1), Resource)
+        assert isinstance(list.__getitem__(result, 0), Record)
+        names = [ obj['Name'] for obj in result ]
+        assert names == ['vm0', 'vm1', 'vm2']
+        for obj in result[:2]:
+            assert isinstance(obj, Resource)
+
+
+class TestRecordParsers(object):
+
+    def test_compact(self):
+        parser = CompactParser(records=True)
+        output = 'oRhevmCmd.CLIVm|kName|svm1|kVer|v2.2.0.1|kNets|a|' \
+                 'oRhevmCmd.CLINetwork|kName|snet1|e|e|e|'
+        result = parser.feed(output) + parser.close()
+        assert isinstance(result[0], Record)
+        assert isinstance(result[0]['Nets'][0], Record)
+        assert result[0]['Nets'][0]['!type'] == 'network'
+        assert result[0]['Ver']['Major'] == 2
+
+    def test_xml(self):
+        output = '<?xml version="1.0"?><Objects>' \
+                 '<Object Type="System.Object[]">' \
+                 '<Property Type="RhevmCmd.CLIVm">' \
+                 '<Property Name="Name" Type="System.String">vm1</Property>' \
+                 '<Property Name="Memory" Type="System.Int32">512</Property>' \
+                 '</Property><Property Type="RhevmCmd.CLIVm">' \
+                 '<Property Name="Name" Type="System.String">vm2</Property>' \
+                 '<Property Name="Memory" Type="System.Int32">256</Property>' \
+                 '</Property></Object></Objects>'
+        parser = ObjectParser(_convert_xml_record)
+        result = parser.feed(output) + parser.close()
+        assert len(result) == 2
+        assert isinstance(result[0], Record)
+        assert result[0].schema is result[1].schema
+        assert result[1]['Memory'] == 256
@@ -0,0 +1,261 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+from nose.tools import assert_raises
+from rest.resource import Resource
+
+import rhevm.api
+from rhevm.cache import invalidate
+from rhevm.util import cluster_id, cluster_name, host_id, host_name
+from rhevm.util import resolve_references, load_references, template_object
+from rhevm.util import vm_handle, select_vm_command
+from rhevm.powershell import PowerShellError
+
+
+class FakeShell(object):
+    """A shell that knows two clusters and two hosts."""
+
+    args = { 'username': 'user', 'domain': 'domain' }
+
+    def __init__(self):
+        self.commands = []
+
+    def execute_many(self, commands, timeout=None):
+        results = []
+        for command in commands:
+            self.commands.append(command)
+            if command.startswith('Select-Cluster'):
+                results.append([ Resource('cluster', ClusterID=i,
+                                          Name='cluster%d' % i)
+                                 for i in (1, 2) ])
+            elif command.startswith('Select-Host'):
+                results.append([ Resource('host', HostId=i, HostClusterId=1,
+                                          Name='host%d' % i)
+                                 for i in (1, 2) ])
+            else:
+                results.append([])
+        return results
+
+    def execute(self, command):
+        raise AssertionError('Not resolved in bulk: %s' % command)
+
+
+class TemplateShell(object):
+    """A shell that knows one template."""
+
+    args = { 'username': 'user', 'domain': 'domain' }
+    version = (2, 2, 0, 1)
+
+    def __init__(self):
+        self.commands = []
+        self.removed = False
+        self.error = None
+
+    def execute(self, command):
+        self.commands.append(command)
+        if self.error:
+            raise PowerShellError(self.error)
+        if command.startswith('Select-Template'):
+            if 'template1' not in command:
+                return []
+            return [ Resource('template', TemplateId='t1', Name='template1') ]
+        elif self.removed:
+            # Piping $null into Select-Properties would fail.
+            if 'if ($templates[' not in command:
+                raise PowerShellError('Null-valued expression.')
+            return []
+        return [ Resource('template', TemplateId='t1') ]
+
+
+VM1 = '6b4cd4a6-5a5f-4f2b-9c8e-1b2a3c4d5e6f'
+VM2 = '0f6e5d4c-3b2a-4c1d-8e9f-a0b1c2d3e4f5'
+
+
+class VmShell(object):
+    """A shell that knows one VM."""
+
+    args = { 'username': 'user', 'domain': 'domain' }
+    version = (2, 2, 0, 1)
+
+    def __init__(self):
+        self.commands = []
+
+    def execute(self, command):
+        self.commands.append(command)
+        if '"%s"' % VM1 in command:
+            return [ Resource('vm', VmId=VM1) ]
+        # Piping $null into Select-Properties would fail.
+        if 'if ($vms[' not in command:
+            raise PowerShellError('Null-valued expression.')
+        return []
+
+
+class TestReferences(object):
+
+    references = [ (cluster_name, ('HostClusterId',)),
+                   (host_name, ('RunningOnHost', 'HostClusterId')) ]
+
+    def setup(self):
+        self.shell = FakeShell()
+        rhevm.api.powershell._register(self.shell)
+
+    def teardown(self):
+        rhevm.api.powershell._release()
+        invalidate('cluster')
+        invalidate('host')
+        invalidate('template')
+        invalidate('pool')
+
+    def test_load(self):
+        assert load_references() == 8
+        assert len(self.shell.commands) == 4
+        assert cluster_id('cluster1') == 1
+        assert cluster_name(2) == 'cluster2'
+        assert host_id('host2') == 2
+        assert host_name(1, 1) == 'host1'
+
+    def test_load_resolve(self):
+        load_references()
+        commands = len(self.shell.commands)
+        # The IDs of the VMs are strings, those of the objects numbers.
+        vms = [ Resource('vm', HostClusterId='1', RunningOnHost='2') ]
+        resolve_references(vms, self.references)
+        assert len(self.shell.commands) == commands
+        assert cluster_name('1') == 'cluster1'
+        assert host_name('2', '1') == 'host2'
+
+    def test_resolve(self):
+        vms = [ Resource('vm', HostClusterId=1 + i % 2,
+                         RunningOnHost=1 + i % 2) for i in range(100) ]
+        vms.append(Resource('vm', HostClusterId=1, RunningOnHost=-1))
+        resolve_references(vms, self.references)
+        assert len(self.shell.commands) == 2
+        assert cluster_name(1) == 'cluster1'
+        assert cluster_name(2) == 'cluster2'
+        assert host_name(1, 1) == 'host1'
+        # Host 2 is not in cluster 2: resolved by the lookup function.
+        self.shell.execute = lambda command: []
+        assert host_name(2, 2) is None
+        assert host_name(-1, 1) is None
+        # Everything is cached now.
+        resolve_references(vms, self.references)
+        assert len(self.shell.commands) == 2
+
+    def test_resolve_grouped(self):
+        vms = [ Resource('vm', HostClusterId=1, RunningOnHost=2,
+                         DedicatedHost='host1') ]
+        references = self.references + [ (host_id, ('DedicatedHost',)) ]
+        resolve_references(vms, references)
+        hosts = [ command for command in self.shell.commands
+                  if command.startswith('Select-Host') ]
+        assert len(hosts) == 1
+        assert '@("host1") -contains $_.Name' in hosts[0]
+        assert ' -or ' in hosts[0]
+        assert host_id('host1') == 1
+        assert host_name(2, 1) == 'host2'
+
+
+class TestTemplateObject(object):
+
+    def setup(self):
+        self.shell = TemplateShell()
+        rhevm.api.powershell._register(self.shell)
+
+    def teardown(self):
+        rhevm.api.powershell._release()
+        invalidate('template')
+
+    def test_template_object(self):
+        handle = template_object('template1')
+        assert handle == '($templates["t1"])'
+        assert len(self.shell.commands) == 2
+        assert 'Get-Template -TemplateId "t1"' in self.shell.commands[1]
+        # The handle is reused by the shell.
+        assert template_object('template1') == handle
+        assert len(self.shell.commands) == 2
+        # Another shell needs one targeted call.
+        self.shell = TemplateShell()
+        rhevm.api.powershell._register(self.shell)
+        assert template_object('template1') == handle
+        assert len(self.shell.commands) == 1
+        assert_raises(KeyError, template_object, 'template2')
+
+    def test_removed(self):
+        template_object('template1')
+        self.shell = TemplateShell()
+        self.shell.removed = True
+        rhevm.api.powershell._register(self.shell)
+        assert_raises(KeyError, template_object, 'template1')
+        assert 'if ($templates["t1"]) {' in self.shell.commands[0]
+        # The template ID is looked up again.
+        assert_raises(KeyError, template_object, 'template1')
+        assert self.shell.commands[1].startswith('Select-Template')
+
+    def test_error(self):
+        template_object('template1')
+        self.shell = TemplateShell()
+        self.shell.error = 'Timeout.'
+        rhevm.api.powershell._register(self.shell)
+        assert_raises(PowerShellError, template_object, 'template1')
+        # The template ID is still cached.
+        self.shell.error = None
+        template_object('template1')
+        assert len(self.shell.commands) == 2
+        assert 'Get-Template' in self.shell.commands[1]
+
+    def test_old_version(self):
+        self.shell.version = (2, 1, 0, 0)
+        template_object('template1')
+        assert 'Select-Template | ? { $_.TemplateId -eq "t1" }' \
+                in self.shell.commands[1]
+
+
+class TestVmHandle(object):
+
+    def setup(self):
+        self.shell = VmShell()
+        rhevm.api.powershell._register(self.shell)
+
+    def teardown(self):
+        rhevm.api.powershell._release()
+
+    def test_vm_handle(self):
+        handle = '($vms["%s"])' % VM1
+        assert vm_handle(VM1) == handle
+        assert len(self.shell.commands) == 1
+        command = self.shell.commands[0]
+        assert command.startswith('$vms = @{};')
+        assert 'Get-Vm -VmId "%s"' % VM1 in command
+        assert 'Select-Vm' not in command
+        # Reused within the request, also when not found.
+        assert vm_handle(VM1) == handle
+        assert vm_handle(VM2) is None
+        assert vm_handle(VM2) is None
+        assert len(self.shell.commands) == 2
+        assert not self.shell.commands[1].startswith('$vms = @{};')
+        # The next request.
+        self.shell.vm_handles = None
+        assert vm_handle(VM1) == handle
+        assert len(self.shell.commands) == 3
+        assert self.shell.commands[2].startswith('$vms = @{};')
+
+    def test_missing(self):
+        assert vm_handle(VM2) is None
+        assert 'if ($vms["%s"]) {' % VM2 in self.shell.commands[0]
+
+    def test_malformed_id(self):
+        assert vm_handle('vm1') is None
+        assert vm_handle('"; Remove-Vm') is None
+        assert self.shell.commands == []
+        assert select_vm_command('vm1') == '@()'
+
+    def test_old_version(self):
+        self.shell.version = (2, 1, 0, 0)
+        assert vm_handle(VM1) == '($vms["%s"])' % VM1
+        assert 'Select-Vm | ? { $_.VmId -eq "%s" }' % VM1 \
+                in self.shell.commands[0]
@@ -78,3 +78,18 @@ class TestVm(RhevmTest):
         client.request('DELETE', url.path, headers=headers)
         response = client.getresponse()
         assert response.status == http.NOT_FOUND
+
+    def test_fields(self):
+        client = self.client
+        headers = self.headers
+        client.request('GET', '/api/vms?fields=name,memory', headers=headers)
+        response = client.getresponse()
+        assert response.status == http.OK
+        result = yaml.load(response.read())
+        for entry in result:
+            assert 'name' in entry
+            assert 'memory' in entry
+            assert 'description' not in entry
+        client.request('GET', '/api/vms?fields=foo', headers=headers)
+        response = client.getresponse()
+        assert response.status == http.BAD_REQUEST
@@ -0,0 +1,64 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+import rhevm.api
+from rhevm.cache import invalidate
+from rhevm.util import cluster_name
+from rhevm.warmup import Warmup
+from rhevm.test.test_pool import wait_for
+from rhevm.test.test_util import FakeShell
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.shell = FakeShell()
+        self.inuse = 0
+
+    def get(self, args, timeout=None):
+        self.inuse += 1
+        return self.shell
+
+    def put(self, shell):
+        self.inuse -= 1
+
+
+class TestWarmup(object):
+
+    def setup(self):
+        self.pool = FakePool()
+        self.warmup = Warmup(self.pool, 'user@domain')
+        self.auth = { 'username': 'user', 'domain': 'domain',
+                      'password': 'pass' }
+
+    def teardown(self):
+        self.warmup.stop()
+        invalidate('cluster')
+        invalidate('host')
+
+    def test_start(self):
+        self.warmup.start({ 'username': 'other', 'domain': 'domain' })
+        assert self.warmup._thread is None
+        self.warmup.start(self.auth)
+        thread = self.warmup._thread
+        self.warmup.start(self.auth)
+        assert self.warmup._thread is thread
+        wait_for(lambda: self.warmup.stats()['loads'] == 1)
+        assert self.pool.inuse == 0
+        rhevm.api.powershell._register(self.pool.shell)
+        try:
+            assert cluster_name(1) == 'cluster1'
+        finally:
+            rhevm.api.powershell._release()
+        self.warmup.stop()
+        assert not thread.isAlive()
+
+    def test_refresh(self):
+        self.warmup.interval = 0.05
+        self.warmup.start(self.auth)
+        wait_for(lambda: self.warmup.stats()['loads'] >= 3)
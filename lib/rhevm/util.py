@@ -6,10 +6,13 @@
 # RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
 # "AUTHORS" for a complete overview.
 
+import re
 import sys
+import time
 import logging
 
 from rhevm.api import powershell
+from rhevm.cache import create_cache, invalidate
 from rhevm.powershell import PowerShell, escape
 
 
@@ -45,17 +48,44 @@ def create_powershell(username, password, domain):
     return powershell
 
 
-def cached(func):
-    """Decorator that caches the result of a function."""
-    cache = {}
-    def cached_result(*args):
-        try:
-            return cache[args]
-        except KeyError:
-            ret = func(*args)
-            cache[args] = ret
+def _get_scope():
+    """INTERNAL: return the credentials of the current PowerShell."""
+    args = getattr(powershell, 'args', None) or {}
+    return (args.get('username'), args.get('domain'))
+
+def _normalize(args):
+    """INTERNAL: return the cache key for the arguments `args`. IDs can be
+    numbers or strings depending on where they come from, and as they
+    are compared as strings in PowerShell, they are keyed as strings."""
+    return tuple((isinstance(arg, basestring) and arg or str(arg)
+                  for arg in args))
+
+
+def cached(kind, scoped=True, maxsize=None, ttl=None):
+    """Decorator that caches the result of a lookup function for objects
+    of type `kind` in a bounded cache. If `scoped` is true, the results are
+    cached per user, as users may see different objects. The cache is
+    available as the `cache` attribute of the decorated function."""
+    def decorator(func):
+        cache = create_cache(func.__name__, kind, maxsize, ttl)
+        missing = object()
+        def get_key(args):
+            if scoped:
+                return _get_scope() + _normalize(args)
+            return _normalize(args)
+        def cached_result(*args):
+            key = get_key(args)
+            ret = cache.get(key, missing)
+            if ret is missing:
+                ret = func(*args)
+                cache.put(key, ret)
             return ret
-    return cached_result
+        cached_result.__name__ = func.__name__
+        cached_result.__doc__ = func.__doc__
+        cached_result.cache = cache
+        cached_result.get_key = get_key
+        return cached_result
+    return decorator
 
 def create_filter(**kwargs):
     conditions = ['1']
@@ -94,7 +124,7 @@ def create_setattr(obj, **kwargs):
     statement = ';'.join(statements) + ';'
     return statement
 
-@cached
+@cached('cluster')
 def cluster_id(name):
     """Return the cluster ID for a cluster name."""
     filter = create_filter(name=name)
@@ -103,7 +133,7 @@ def cluster_id(name):
         raise KeyError, 'Cluster not found.'
     return result[0]['ClusterID']
 
-@cached
+@cached('cluster')
 def cluster_name(id):
     """Retur the cluster name for a given ID."""
     filter = create_filter(clusterid=id)
@@ -112,16 +142,101 @@ def cluster_name(id):
         raise KeyError, 'Cluster not found.'
     return result[0]['Name']
 
-def template_object(name):
+@cached('template')
+def template_id(name):
     """Return the template ID for a template name."""
     filter = create_filter(name=name)
     result = powershell.execute('Select-Template | %s' % filter)
     if len(result) != 1:
-        raise KeyError, 'Template not found'
-    powershell.execute('$template = Select-Template | %s' % filter)
-    return '$template'
+        raise KeyError, 'Template not found.'
+    return result[0]['TemplateId']
+
+# The commands that select a VM or a template by ID, by the RHEV-M version
+# that they need. The first one that the RHEV-M version supports is used.
+# Older versions can only filter all objects.
+_vm_selectors = [
+    ((2, 2), 'Get-Vm -VmId %s -ErrorAction SilentlyContinue'),
+    ((), 'Select-Vm | ? { $_.VmId -eq %s }')
+]
+_template_selectors = [
+    ((2, 2), 'Get-Template -TemplateId %s -ErrorAction SilentlyContinue'),
+    ((), 'Select-Template | ? { $_.TemplateId -eq %s }')
+]
+
+# Object IDs are GUIDs.
+re_guid = re.compile('^[0-9a-fA-F]{8}(-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}$')
+
+def _select_command(selectors, id):
+    """INTERNAL: return the first command of `selectors` that the shell
+    supports, for the object with ID `id`."""
+    for version, command in selectors:
+        if powershell.version >= version:
+            return command % escape(str(id))
+
+def select_vm_command(id):
+    """Return the fastest command that selects the VM with ID `id`. An ID
+    that is not a GUID selects nothing, as Get-Vm would not accept it."""
+    if not re_guid.match(str(id)):
+        return '@()'
+    return _select_command(_vm_selectors, id)
+
+def template_object(name):
+    """Return an expression for the template object of a template name.
 
-@cached
+    The template objects are kept in the $templates hash table in the
+    session of the shell, by ID, for as long as the template IDs are
+    cached. Only the first use on a shell needs a command. The objects
+    that have been loaded are tracked on the shell object, which with a
+    broker is a RemoteShell that only lives for one request, so there
+    every use needs a command.
+    """
+    id = template_id(name)
+    loaded = getattr(powershell, 'templates', None)
+    if loaded is None:
+        loaded = powershell.templates = {}
+    handle = '$templates[%s]' % escape(str(id))
+    if time.time() - loaded.get(id, 0) > template_id.cache.ttl:
+        # Nothing is selected if the template does not exist anymore.
+        select = _select_command(_template_selectors, id)
+        result = powershell.execute('if (-not $templates) '
+                                    '{ $templates = @{} }; %s = %s; '
+                                    'if (%s) { %s'
+                                    ' | Select-Properties @("TemplateId") }'
+                                    % (handle, select, handle, handle))
+        if len(result) != 1:
+            # The template was removed since its ID was cached.
+            loaded.pop(id, None)
+            template_id.cache.invalidate(template_id.get_key((name,)))
+            raise KeyError, 'Template not found.'
+        loaded[id] = time.time()
+    return '(%s)' % handle
+
+def vm_handle(id):
+    """Return an expression for the object of the VM with ID `id`, or None
+    if there is no such VM.
+
+    The VM objects are kept in the $vms hash table in the session of the
+    shell for the rest of the request, so that a VM is selected at most
+    once per request. RhevmApplication.close() forgets them.
+    """
+    handles = getattr(powershell, 'vm_handles', None)
+    if handles is None:
+        handles = powershell.vm_handles = {}
+    handle = '$vms[%s]' % escape(str(id))
+    if id not in handles and not re_guid.match(str(id)):
+        handles[id] = False
+    elif id not in handles:
+        # The first VM of a request drops those of earlier requests.
+        reset = not handles and '$vms = @{}; ' or ''
+        result = powershell.execute('%s%s = %s; if (%s) { %s'
+                                    ' | Select-Properties @("VmId") }'
+                                    % (reset, handle, select_vm_command(id),
+                                       handle, handle))
+        handles[id] = len(result) == 1
+    if handles[id]:
+        return '(%s)' % handle
+
+@cached('template')
 def template_name(id):
     """Retur the template name for a given ID."""
     filter = create_filter(templateid=id)
@@ -130,7 +245,7 @@ def template_name(id):
         raise KeyError, 'Template not found.'
     return result[0]['Name']
 
-@cached
+@cached('host')
 def host_id(name):
     """Return the host ID for a host name."""
     filter = create_filter(name=name)
@@ -139,7 +254,7 @@ def host_id(name):
         raise KeyError, 'Host not found.'
     return result[0]['HostID']
 
-@cached
+@cached('host')
 def host_name(id, cluster):
     """Retur the host name for a given ID."""
     if id in ('-1', None):
@@ -150,7 +265,7 @@ def host_name(id, cluster):
         return
     return result[0]['Name']
 
-@cached
+@cached('pool')
 def pool_id(name):
     """Return the pool ID for a pool name."""
     filter = create_filter(name=name)
@@ -159,7 +274,7 @@ def pool_id(name):
         raise KeyError, 'Pool not found.'
     return result[0]['PoolID']
 
-@cached
+@cached('pool')
 def pool_name(id):
     """Retur the pool name for a given ID."""
     if id == -1:
@@ -170,6 +285,103 @@ def pool_name(id):
         raise KeyError, 'Pool not found.'
     return result[0]['Name']
 
+# The lookup functions that can be loaded in bulk: the command that selects
+# the objects, the properties of those objects that correspond to the
+# arguments of the function, and the property that is its result.
+_bulk_lookups = {
+    'cluster_id': ('Select-Cluster', ('Name',), 'ClusterId'),
+    'cluster_name': ('Select-Cluster', ('ClusterId',), 'Name'),
+    'template_id': ('Select-Template', ('Name',), 'TemplateId'),
+    'template_name': ('Select-Template', ('TemplateId',), 'Name'),
+    'host_id': ('Select-Host', ('Name',), 'HostId'),
+    'host_name': ('Select-Host', ('HostId', 'HostClusterId'), 'Name'),
+    'pool_id': ('Select-VmPool', ('Name',), 'PoolId'),
+    'pool_name': ('Select-VmPool', ('PoolId',), 'Name')
+}
+
+def _get_values(obj, names):
+    """INTERNAL: return the values of the properties `names` of `obj`."""
+    # Property names are not case sensitive in PowerShell.
+    values = dict(((name.lower(), obj[name]) for name in obj))
+    return tuple((values.get(name.lower()) for name in names))
+
+def resolve_references(objects, references):
+    """Resolve the references in `objects` in bulk, so that the lookup
+    functions that the entity transform calls for them are served from
+    their caches. `references` is a list of (function, properties): the
+    values of the properties of an object are the arguments of the lookup
+    function. The referenced objects of all types are selected in a single
+    round trip, and each type is selected once."""
+    # The missing arguments of the lookup functions, by command.
+    missing = {}
+    for func, properties in references:
+        args = set()
+        # Do not convert records to Resources here.
+        for obj in list.__iter__(objects):
+            values = _normalize((obj.get(prop) for prop in properties))
+            if values[0] not in ('None', '-1'):
+                args.add(values)
+        args = [ value for value in args
+                 if func.get_key(value) not in func.cache ]
+        if args:
+            command = _bulk_lookups[func.__name__][0]
+            missing.setdefault(command, []).append((func, args))
+    if not missing:
+        return
+    commands = sorted(missing)
+    selects = []
+    for command in commands:
+        conditions = []
+        selected = set()
+        for func, args in missing[command]:
+            properties, result = _bulk_lookups[func.__name__][1:]
+            ids = ','.join(set((escape(value[0]) for value in args)))
+            conditions.append('@(%s) -contains $_.%s' % (ids, properties[0]))
+            selected.update(properties + (result,))
+        selects.append('%s | ? { %s } | Select-Properties @(%s)'
+                       % (command, ' -or '.join(conditions),
+                          ','.join(map(escape, sorted(selected)))))
+    results = powershell.execute_many(selects)
+    for command, objects in zip(commands, results):
+        if isinstance(objects, Exception):
+            continue
+        for func, args in missing[command]:
+            properties, result = _bulk_lookups[func.__name__][1:]
+            index = {}
+            for obj in objects:
+                values = _get_values(obj, properties + (result,))
+                index[_normalize(values[:-1])] = values[-1]
+            for value in args:
+                if value in index:
+                    func.cache.put(func.get_key(value), index[value])
+
+def load_references():
+    """Load all clusters, hosts, templates and pools into the caches of
+    the lookup functions, in a single round trip. Return the number of
+    entries that were loaded."""
+    funcs = (cluster_id, cluster_name, template_id, template_name, host_id,
+             host_name, pool_id, pool_name)
+    selected = {}
+    for func in funcs:
+        command, properties, result = _bulk_lookups[func.__name__]
+        selected.setdefault(command, set()).update(properties + (result,))
+    commands = sorted(selected)
+    results = powershell.execute_many([ '%s | Select-Properties @(%s)'
+            % (command, ','.join(map(escape, sorted(selected[command]))))
+            for command in commands ])
+    results = dict(zip(commands, results))
+    count = 0
+    for func in funcs:
+        command, properties, result = _bulk_lookups[func.__name__]
+        objects = results[command]
+        if isinstance(objects, Exception):
+            continue
+        for obj in objects:
+            values = _get_values(obj, properties + (result,))
+            func.cache.put(func.get_key(values[:-1]), values[-1])
+            count += 1
+    return count
+
 def lower(s):
     # XXX: hack, function should not be called for an int
     if isinstance(s, int):
@@ -0,0 +1,101 @@
+#
+# This file is part of RHEVM-API. RHEVM-API is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# RHEVM-API is copyright (c) 2010 by the RHEVM-API authors. See the file
+# "AUTHORS" for a complete overview.
+
+import time
+import threading
+import logging
+
+import rhevm.api
+from rhevm.cache import Cache
+from rhevm.util import load_references
+
+
+class Warmup(object):
+    """Load the lookup caches for a service account in the background.
+
+    The caches are loaded when the account logs on for the first time,
+    which is when the pool creates the first shell for it, and are
+    refreshed every `interval` seconds after that. The interval is shorter
+    than the time to live of the cache entries, so that requests of the
+    account keep finding them.
+    """
+
+    interval = Cache.ttl * 0.8
+
+    def __init__(self, pool, account):
+        """Create a warm-up for `pool` and the account "user@domain"."""
+        self.pool = pool
+        self.username, self.domain = account.split('@')
+        self.logger = logging.getLogger('rhevm.warmup')
+        self._auth = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._loads = 0
+        self._last_load = None
+
+    def start(self, auth):
+        """Start the warm-up if `auth` are the credentials of the service
+        account. Does nothing if it was already started."""
+        if auth.get('username') != self.username or \
+                auth.get('domain') != self.domain:
+            return
+        self._lock.acquire()
+        try:
+            if self._thread is not None:
+                return
+            self._auth = auth.copy()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        """Stop refreshing the caches."""
+        self._lock.acquire()
+        try:
+            thread = self._thread
+            self._thread = None
+        finally:
+            self._lock.release()
+        if thread is None:
+            return
+        self._stopping.set()
+        thread.join()
+
+    def load(self):
+        """Load the caches now."""
+        start = time.time()
+        shell = self.pool.get(self._auth)
+        rhevm.api.powershell._register(shell)
+        try:
+            count = load_references()
+        finally:
+            rhevm.api.powershell._release()
+            self.pool.put(shell)
+        self._loads += 1
+        self._last_load = time.time()
+        self.logger.debug('Loaded %d cache entries for %s@%s in %.2f seconds'
+                          % (count, self.username, self.domain,
+                             time.time() - start))
+
+    def stats(self):
+        """Return a dictionary with statistics on the warm-up."""
+        return { 'loads': self._loads, 'last_load': self._last_load }
+
+    def _run(self):
+        """INTERNAL: load the caches every `interval` seconds."""
+        while not self._stopping.isSet():
+            try:
+                self.load()
+            except Exception:
+                self.logger.exception('Could not load the caches for %s@%s'
+                                      % (self.username, self.domain))
+            self._stopping.wait(self.interval)
@@ -70,7 +70,8 @@ setup(
     test_suite = 'nose.collector',
     entry_points = { 'console_scripts': [
             'rhevm-api-cmdline = rhevm.server:main',
-            'rhevm-api-isapi = rhevm.iis:main'] },
+            'rhevm-api-isapi = rhevm.iis:main',
+            'rhevm-api-broker = rhevm.broker:main'] },
     install_requires = ['winpexpect >= 1.4', 'python-rest >= 1.3',
                         'pyyaml >= 3.09'],
     cmdclass = { 'build': mybuild },